@@ -43,11 +43,13 @@ import os
 import time
 import getopt
 import threading
+import traceback
 import numpy as np
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from azure.datalake.store import core, lib, multithread
+import storage
 from numpy import inf
 
 if sys.version_info[0] < 3: 
@@ -55,17 +57,26 @@ if sys.version_info[0] < 3:
 else:
     from io import StringIO
 
-adl_name = os.environ['DATALAKESTORE_NAME']
-tenant_id = os.environ['TENANT_ID']
-client_id = os.environ['CLIENT_ID']
-client_secret = os.environ['CLIENT_SECRET']
-
 raw_data_folder_sales = 'rawdata'
 raw_data_folder_orders = 'orders'
 configuration_folder = 'configuration'
+forecast_index_folder = 'index'  # under demand_forecasts: one file per forecast date with the first forecast of every (store, product)
+metric_aggregates_folder = 'metric_aggregates'  # daily sums and counts of the metric file, and their totals over the summary windows
+policy_records_folder = 'policies'  # under rawdata: inventory and sales log of every simulated policy
+public_parameters_folder = 'publicparameters'  # attributes of the stores and products published by the simulator
+
+# summary windows: number of days before today and evaluation period
+summary_windows = [(7, '(I) LastWeek'), (30, '(II) LastMonth'), (91, '(III) LastQuarter')]
+
+# columns of the metric aggregates; metric and turnover ratio are averaged, the others summed
+mean_columns = ['Metric', 'TurnoverRatio']
+aggregate_columns = ['Rows'] + [column + part for column in mean_columns for part in ['Sum', 'Count', 'PosInf', 'NegInf']] + ['TotalRevenue', 'NumStockout']
+
+# number of worker processes evaluating stores in parallel (1 = evaluate stores one after another)
+n_workers = 1
 
-n_stores = 6
-n_products = 20
+# number of partial order and demand forecast files fetched and parsed concurrently
+n_file_readers = 16
 
 
 def read_file(file_name, timecolumns):
@@ -80,136 +91,295 @@ def write_file(file, file_name):
         f.write(file.to_csv(index=False, date_format='%Y-%m-%d %H:%M:%S').encode('utf-8'))
 
         
-def read_partial_orders(store_id):
+def read_store_products():
+    """
+    Read the products of every store from the store attributes published by the 
+    simulator, so the evaluation covers the stores and products of the hierarchy. 
+    Return a table of StoreID, ProductID and ProductNumber, the number of the 
+    product in its store (from 1, in the order of the hierarchy).
+    """
+    file_name = '{}/store_product_supplier.csv'.format(public_parameters_folder)
+    with adl.open(file_name, blocksize=2 ** 20) as f:
+        store_products = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", dtype={'StoreID':str, 'ProductID':str})
+    store_products = store_products[['StoreID', 'ProductID']].drop_duplicates().reset_index(drop=True)
+    store_products['ProductNumber'] = store_products.groupby('StoreID').cumcount() + 1
+    return store_products
+
+
+def read_partial_orders(store_ids):
+    """
+    Read the partial orders of all policies for every store in store_ids in one 
+    go, fetching the files concurrently. Return the orders of each store in a 
+    dictionary keyed by store id.
+    """
     cols = ['PolicyID', 'StoreID', 'ProductID', 'SupplierID', 'Quantity','OrderTimestamp', 'ETA', 'ConfidenceInterval', 'Fulfilled']
-    partial_orders_master = pd.DataFrame(columns=cols)
     policy_folders = adl.ls(raw_data_folder_orders)
-     
-    for policy in policy_folders:
-        file_name = '{}/partial_orders_{}.csv'.format(policy, store_id)
-        if adl.exists(file_name):
-            with adl.open(file_name, blocksize=2 ** 20) as f:
-                policy_orders = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", 
-                                            parse_dates=['ETA'], 
-                                            dtype={'PolicyID':str, 'StoreID':str, 'ProductID':str, 
-                                                   'SupplierID':str, 'Quantity':int})
-                policy_orders.columns = cols
-                partial_orders_master = pd.concat([partial_orders_master, policy_orders])
-                partial_orders_master = partial_orders_master.reset_index().iloc[:,1:]
-    partial_orders_master['OrderTimestamp'] = pd.to_datetime(partial_orders_master['OrderTimestamp'], format='%Y-%m-%d %H:%M:%S')
-    return partial_orders_master
+    file_names = [(store_id, '{}/partial_orders_{}.csv'.format(policy, store_id)) for store_id in store_ids for policy in policy_folders]
+    
+    def read_policy_orders(file_name):
+        if not adl.exists(file_name):
+            return None
+        with adl.open(file_name, blocksize=2 ** 20) as f:
+            policy_orders = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", 
+                                        parse_dates=['ETA'], 
+                                        dtype={'PolicyID':str, 'StoreID':str, 'ProductID':str, 
+                                               'SupplierID':str, 'Quantity':int})
+        policy_orders.columns = cols
+        return policy_orders
+    
+    with ThreadPoolExecutor(max_workers=n_file_readers) as executor:
+        policy_orders = list(executor.map(read_policy_orders, [file_name for store_id, file_name in file_names]))
+    
+    partial_orders = {}
+    for store_id in store_ids:
+        store_orders = [orders for (order_store_id, file_name), orders in zip(file_names, policy_orders) 
+                        if order_store_id == store_id and orders is not None]
+        partial_orders_master = pd.concat([pd.DataFrame(columns=cols)] + store_orders)
+        partial_orders_master = partial_orders_master.reset_index().iloc[:,1:]
+        partial_orders_master['OrderTimestamp'] = pd.to_datetime(partial_orders_master['OrderTimestamp'], format='%Y-%m-%d %H:%M:%S')
+        partial_orders[store_id] = partial_orders_master
+    return partial_orders
+
+
+def read_demand_forecasts(store_products, forecast_date):
+    """
+    Read the predicted demand of every product in store_products from the forecasts 
+    written on forecast_date: the first row of each forecast, listed in the 
+    forecast index of the day. Forecasts indexed without their demand (written 
+    by older versions of the simulator) are read from their own files, fetched 
+    concurrently. Return a table of StoreID, ProductID and Demand.
+    """
+    cols = ['StoreID', 'ProductID', 'Demand']
+    index_file_name = '{}/demand_forecasts/{}/{}.csv'.format(raw_data_folder_sales, forecast_index_folder, forecast_date)
+    if adl.exists(index_file_name):
+        with adl.open(index_file_name, blocksize=2 ** 20) as f:
+            forecasts = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", dtype={'StoreID':str, 'ProductID':str})
+        if 'Demand' in forecasts.columns:
+            return forecasts.loc[forecasts['StoreID'].isin(store_products['StoreID'].unique()), cols].reset_index(drop=True)
+    
+    def read_first_demand(file_name):
+        if not adl.exists(file_name):
+            return None
+        return read_file(file_name, 'DateTime')['Demand'][0]
+    
+    keys = list(zip(store_products['StoreID'], store_products['ProductID']))
+    file_names = ['{}/demand_forecasts/{}/{}/{}.csv'.format(raw_data_folder_sales, key[0], key[1], forecast_date) for key in keys]
+    with ThreadPoolExecutor(max_workers=n_file_readers) as executor:
+        demand = list(executor.map(read_first_demand, file_names))
+    return pd.DataFrame([key + (value,) for key, value in zip(keys, demand) if value is not None], columns=cols)
+
+    
+def match_sales_to_orders(sales_temp, orders_temp):
+    """
+    FIFO attribution of sales to orders, done separately for every policy.
+    Sales with a PolicyID (the sales logs of the policies simulated side by side)
+    are matched to the orders of their policy only; otherwise the same sales are
+    replayed against the orders of every policy. Each sale takes one unit from the earliest order (by ETA) of the same product
+    that arrived before the sale and still has units left; a spoilage clears up
+    to its units from that order. Because orders are consumed in ETA order, the
+    units taken from a (policy, product) so far are always a prefix of the
+    cumulative order quantities, so matching reduces to np.searchsorted on the
+    cumulative sums. Sales in between two spoilages are resolved at once and the
+    loop below only runs once per spoilage of a product.
+    Return the matched rows (sales order, then policy order) and the remaining
+    quantity of every order.
+    """
+    policy_codes, policies = pd.factorize(orders_temp['PolicyID'].values, sort=True)
+    product_codes, products = pd.factorize(np.concatenate([orders_temp['ProductID'].values, 
+                                                           sales_temp['ProductID'].values]))
+    n_orders, n_sales = orders_temp.shape[0], sales_temp.shape[0]
+    n_items = len(products)
+    n_groups = len(policies) * n_items
+    order_product, sale_product = product_codes[:n_orders], product_codes[n_orders:]
+    
+    # Rank order ETAs and sale times on a common scale 
+    eta = orders_temp['ETA'].values.astype('datetime64[ns]')
+    sale_time = sales_temp['TransactionDateTime'].values.astype('datetime64[ns]')
+    times, time_rank = np.unique(np.concatenate([eta, sale_time]), return_inverse=True)
+    eta_rank, sale_rank = time_rank[:n_orders], time_rank[n_orders:]
+    n_times = len(times) + 1
+    
+    # Orders of every (policy, product) group by ETA and their cumulative quantities
+    order_group = policy_codes * n_items + order_product
+    o_sort = np.lexsort((eta_rank, order_group))
+    o_group = order_group[o_sort]
+    o_key = o_group * n_times + eta_rank[o_sort]
+    quantity = orders_temp['Quantity'].values.astype(np.int64)
+    o_quantity = np.maximum(quantity[o_sort], 0)
+    cum = np.concatenate([[0], np.cumsum(o_quantity)])
+    group_base = cum[np.searchsorted(o_group, np.arange(n_groups), side='left')]
+    
+    # The sales stream of every policy by product and time
+    if 'PolicyID' in sales_temp.columns:
+        sale_policy = pd.Index(policies).get_indexer(sales_temp['PolicyID'].values)
+        ev_sale = np.lexsort((sale_rank, sale_product, sale_policy))
+        ev_sale = ev_sale[sale_policy[ev_sale] >= 0]
+        ev_policy = sale_policy[ev_sale]
+    else:
+        s_by_product = np.lexsort((sale_rank, sale_product))
+        ev_sale = np.tile(s_by_product, len(policies))
+        ev_policy = np.repeat(np.arange(len(policies)), n_sales)
+    ev_group = ev_policy * n_items + sale_product[ev_sale]
+    ev_spoil = (sales_temp['Price'].values == 0)[ev_sale]
+    ev_units = sales_temp['Units'].values.astype(np.int64)[ev_sale]
+    # Units received by the group strictly before the sale 
+    ev_cap = cum[np.searchsorted(o_key, ev_group * n_times + sale_rank[ev_sale], side='left')] - group_base[ev_group]
+    # Number of earlier spoilages of the group splits its sales into runs
+    ev_first = np.ones(len(ev_group), dtype=bool)
+    ev_first[1:] = ev_group[1:] != ev_group[:-1]
+    spoiled_before = np.cumsum(ev_spoil) - ev_spoil
+    ev_run = spoiled_before - spoiled_before[ev_first][np.cumsum(ev_first) - 1]
+    
+    taken = np.zeros(n_groups, dtype=np.int64)
+    ev_order = np.full(len(ev_group), -1, dtype=np.int64)
+    for run in range(ev_run.max() + 1 if len(ev_run) else 0):
+        # Sales: the j-th sale of a run takes a unit iff one is in stock, i.e.
+        # taken_j = min(taken_j-1 + 1, cap_j) = j + min(taken_0, min_i<=j (cap_i - i))
+        sel = np.flatnonzero((ev_run == run) & ~ev_spoil)
+        if len(sel):
+            g = ev_group[sel]
+            first = np.concatenate([[True], g[1:] != g[:-1]])
+            segment = np.cumsum(first) - 1
+            starts = np.flatnonzero(first)
+            j = np.arange(len(sel)) - starts[segment] + 1
+            # shift every segment below the previous one so the running minimum restarts 
+            offset = segment * (ev_cap[sel].max() + len(sel) + 1)
+            low = np.minimum.accumulate(ev_cap[sel] - j - offset) + offset
+            after = j + np.minimum(taken[g], low)
+            before = np.concatenate([[0], after[:-1]])
+            before[first] = taken[g[first]]
+            sold = np.flatnonzero(after > before)
+            ev_order[sel[sold]] = np.searchsorted(cum, group_base[g[sold]] + before[sold], side='right') - 1
+            last = np.concatenate([starts[1:] - 1, [len(sel) - 1]])
+            taken[g[last]] = after[last]
+        
+        # Spoilages: clear up to the spoiled units from the order holding the next unit
+        sel = np.flatnonzero((ev_run == run) & ev_spoil)
+        sel = sel[taken[ev_group[sel]] < ev_cap[sel]]
+        g = ev_group[sel]
+        position = group_base[g] + taken[g]
+        k = np.searchsorted(cum, position, side='right') - 1
+        taken[g] += np.minimum(ev_units[sel], cum[k + 1] - position)
+        ev_order[sel] = k
+    
+    # Remaining quantity of every order after the units taken from its group
+    remaining = quantity.copy()
+    remaining[o_sort] -= np.clip(group_base[o_group] + taken[o_group] - cum[:-1], 0, o_quantity)
+    
+    # Matched rows in the order of the sales, then of the policies
+    sale_position = np.empty(n_sales, dtype=np.int64)
+    sale_position[np.lexsort((np.arange(n_sales), sale_rank))] = np.arange(n_sales)
+    matched = np.flatnonzero(ev_order >= 0)
+    matched = matched[np.lexsort((ev_policy[matched], sale_position[ev_sale[matched]]))]
+    sales_orders = sales_temp.iloc[ev_sale[matched]].reset_index(drop=True)
+    sales_orders['OrderETA'] = eta[o_sort[ev_order[matched]]]
+    sales_orders['PolicyID'] = policies[ev_policy[matched]]
+    sales_orders['Spoilage'] = ev_spoil[matched]
+    return sales_orders, remaining
 
     
 def compute_metric(sales_temp, orders_temp):
     """  
-    Go through sales_temp table row by row and find first matching order, if found
-    reduce order quantity by one and write order timestamp to sales_temp. Break,
-    as no need to look further. Final sales_temp will have the matching order dates
-    per row. Return metric per policy and orders_temp table that will be used for 
-    next days run as partial orders.    
+    Attribute every sale to its order with match_sales_to_orders(), which also 
+    gives the unsold quantity of each order. Return metric per policy and 
+    orders_temp table that will be used for next days run as partial orders.    
+    The metric is None when no sale could be attributed to an order.
     """    
     
-    # Sort the two tables by date ascending  
-    orders_temp = orders_temp.sort_values(['PolicyID', 'ETA'])   
-    sales_temp = sales_temp.sort_values('TransactionDateTime')    ; 
-    sales_orders = pd.DataFrame(columns = sales_temp.columns.tolist() + ['OrderETA','PolicyID'])
-    policies = orders_temp.PolicyID.unique() 
-    
-    for index_s, row_s in sales_temp.iterrows():
-        if row_s['Price'] != 0: #not spoilage
-            for policy_id in policies:
-                orders_policy = orders_temp[orders_temp['PolicyID'] == policy_id]
-                for index_o, row_o in orders_policy.iterrows():
-                    if ((row_s['ProductID'] == row_o['ProductID']) & (row_o['Quantity'] > 0) & (row_s['TransactionDateTime'] > row_o['ETA'])):
-                        #if policy_id == 'Sim' and row_s['ProductID'] == '1_1':
-                            #print('+++++++++++++++++++++')
-                            #print(orders_temp.ix[index_o,'Quantity'])
-                        orders_temp.ix[index_o,'Quantity'] = row_o['Quantity'] - 1
-                        temp_row = sales_temp.loc[index_s].copy()
-                        temp_row['OrderETA'] = row_o['ETA']
-                        temp_row['OrderETA'] = pd.to_datetime(temp_row['OrderETA'], format='%Y-%m-%d %H:%M:%S') #this is to fix strange behaviour with timestamp
-                        temp_row['PolicyID'] = row_o['PolicyID']
-                        # Add a lable for spoilage
-                        temp_row['Spoilage'] = False
-                        sales_orders = sales_orders.append(temp_row)    
-                        break
-
-        else: #spoilage
-            for policy_id in policies:
-                orders_policy = orders_temp[orders_temp['PolicyID'] == policy_id]
-                for index_o, row_o in orders_policy.iterrows():
-                    if ((row_s['ProductID'] == row_o['ProductID']) & (row_o['Quantity'] > 0) & (row_s['TransactionDateTime'] > row_o['ETA'])):
-                        orders_temp.ix[index_o,'Quantity'] = max(row_o['Quantity'] - row_s['Units'], 0) # may cause negative value
-                        #orders_temp.ix[index_o,'Quantity'] = row_o['Quantity'] - row_s['Units']
-                        temp_row = sales_temp.loc[index_s].copy()
-                        temp_row['OrderETA'] = row_o['ETA']
-                        temp_row['OrderETA'] = pd.to_datetime(temp_row['OrderETA'], format='%Y-%m-%d %H:%M:%S')
-                        temp_row['PolicyID'] = row_o['PolicyID']
-                        # Add a lable for spoilage
-                        temp_row['Spoilage'] = True
-                        sales_orders = sales_orders.append(temp_row)  
-                        break
-                    
-    sales_orders = sales_orders.reset_index().iloc[:,1:]   
+    policies = np.sort(orders_temp['PolicyID'].unique())
+    sales_orders, remaining = match_sales_to_orders(sales_temp, orders_temp)
+    orders_temp = orders_temp.copy()
+    orders_temp['Quantity'] = remaining
     if sales_orders.shape[0] == 0:
-        sys.exit(0)
+        return None, orders_temp, sales_orders
     # Create column for number of days to sale as day fraction
-    sales_orders['DaysToSale'] = sales_orders['TransactionDateTime'] - sales_orders['OrderETA'].apply(lambda x: pd.to_datetime(x, format='%Y-%m-%d %H:%M:%S').replace(minute=0, hour=0, second=0))
-    sales_orders['DaysToSale'] = sales_orders['DaysToSale'].dt.total_seconds()/(24*60*60)
-    sales_orders['DaysToSale'] = sales_orders['DaysToSale'].apply(lambda x: max(x,1)) 
+    order_day = sales_orders['OrderETA'].values.astype('datetime64[D]')
+    days_to_sale = (sales_orders['TransactionDateTime'].values - order_day) / np.timedelta64(1, 'D')
+    days_to_sale = np.maximum(days_to_sale, 1)
     
     # For spoilages multiply spoilage quantity with DaysToSale 
-    sales_orders.loc[sales_orders['Price'] == 0,'DaysToSale'] = sales_orders[sales_orders['Price'] == 0]['DaysToSale'] * sales_orders[sales_orders['Price'] == 0]['Units']
+    spoiled = (sales_orders['Price'] == 0).values
+    days_to_sale[spoiled] = days_to_sale[spoiled] * sales_orders['Units'].values[spoiled]
+    sales_orders['DaysToSale'] = days_to_sale
     
     # Calculate metric per policy 
     metric_date_time = datetime(sales_orders['TransactionDateTime'][0].year,sales_orders['TransactionDateTime'][0].month, sales_orders['TransactionDateTime'][0].day)
-    rows = []
-    for policy_id in policies:
-        sales_orders_policy = sales_orders[sales_orders['PolicyID'] == policy_id]
-        #print(sales_orders_policy.head(n=5))
-        if sales_orders_policy['DaysToSale'].sum() > 0:
-            #metric_policy = (sales_orders_policy['Price'].sum()/sales_orders_policy['DaysToSale'].sum())
-            sales_orders_policy['NormRevenue'] = sales_orders_policy['Price'] / sales_orders_policy['DaysToSale']
-            metric_policy = sales_orders_policy['NormRevenue'].sum()            
-            # compute total revenue
-            total_revenue_policy = sales_orders_policy['Price'].sum()
-            #print("---------------------------")
-            #print(sales_orders_policy[sales_orders_policy['ProductID']=='1_1'].shape[0])
-        else:
-            metric_policy = 0
-            total_revenue_policy = 0
-        metrics_dict ={}
-        metrics_dict['PolicyID'] = policy_id
-        metrics_dict['MetricDateTime'] = metric_date_time
-        metrics_dict['Metric'] = metric_policy       
-        metrics_dict['TotalRevenue'] = total_revenue_policy   
-
-        rows.append(metrics_dict)      
-    
-    metrics_df = pd.DataFrame(rows, columns = ['PolicyID','MetricDateTime','Metric','TotalRevenue'])   
+    revenue = pd.DataFrame({'PolicyID': sales_orders['PolicyID'], 
+                            'DaysToSale': days_to_sale, 
+                            'NormRevenue': sales_orders['Price'].values / days_to_sale,
+                            'Price': sales_orders['Price'].values})
+    revenue = revenue.groupby('PolicyID').sum().reindex(policies).fillna(0)
+    has_sales = (revenue['DaysToSale'] > 0).values
+    metrics_df = pd.DataFrame({'PolicyID': policies, 
+                               'MetricDateTime': metric_date_time,
+                               'Metric': np.where(has_sales, revenue['NormRevenue'].values, 0), 
+                               'TotalRevenue': np.where(has_sales, revenue['Price'].values, 0)}, 
+                              columns = ['PolicyID','MetricDateTime','Metric','TotalRevenue'])   
     orders_temp.sort_index(inplace=True) # keep the index of the order table same 
     return metrics_df, orders_temp, sales_orders       
 
     
-def read_compute_write(store_id, file_date_format):    
-    # Read sales for the day
-    sales_file_name = '{}/sales_store{}_{}.csv'.format(raw_data_folder_sales, store_id, file_date_format)
+def read_configuration():
+    # Read configuration file to get the policy directory info
+    adl.download(configuration_folder + '/Configurations.xlsx', '.\Configurations.xlsx')
+    return pd.read_excel('.\Configurations.xlsx', sheetname='InventoryPolicyConfig')
+
+
+class EvaluationContext:
+    """
+    Inputs shared by the evaluation of all stores, loaded once per run: the 
+    stores, the policy configuration, the partial orders and the demand 
+    forecasts of every store. Both metric computations of a store take the partial orders from 
+    here; after the partial orders for the next day are written, they are 
+    updated in memory too.
+    """
+    
+    def __init__(self, store_products, today_date):
+        self.store_ids = store_products['StoreID'].unique().tolist()
+        self.store_products = store_products
+        self.conf = read_configuration()
+        start_time = time.time()
+        self.partial_orders = read_partial_orders(self.store_ids)
+        print("read_partial_orders() took %s seconds" % (time.time() - start_time))
+        # Use the previous day demand because today's sales file actually stores yesterday's sales
+        forecast_date = (today_date - pd.DateOffset(1)).strftime('%Y-%m-%d_%H_%M_%S')
+        start_time = time.time()
+        self.demand_forecasts = read_demand_forecasts(store_products, forecast_date)
+        print("read_demand_forecasts() took %s seconds" % (time.time() - start_time))
+
+        
+    def for_store(self, store_id):
+        """
+        Copy of the context restricted to one store, sent to a worker process
+        """
+        context = EvaluationContext.__new__(EvaluationContext)
+        context.store_ids = [store_id]
+        context.store_products = self.store_products.loc[self.store_products['StoreID'] == str(store_id)]
+        context.conf = self.conf
+        context.partial_orders = {store_id: self.partial_orders[store_id]}
+        context.demand_forecasts = self.demand_forecasts.loc[self.demand_forecasts['StoreID'] == str(store_id)]
+        return context
+
+    
+def read_compute_write(store_id, file_date_format, context):    
+    # Read sales for the day, preferably the sales log of every policy
+    sales_file_name = '{}/{}/sales_store{}_{}.csv'.format(raw_data_folder_sales, policy_records_folder, store_id, file_date_format)
+    if not adl.exists(sales_file_name):
+        sales_file_name = '{}/sales_store{}_{}.csv'.format(raw_data_folder_sales, store_id, file_date_format)
     if not adl.exists(sales_file_name):
         return
     sales_f = read_file(sales_file_name, 'TransactionDateTime')
     if sales_f.empty:
         return
                 
-     # Read configuration file to get the policy directory info
-    multithread.ADLDownloader(adl, lpath='.\Configurations.xlsx', 
-                                   rpath=configuration_folder + '/Configurations.xlsx', overwrite=True)
-    conf = pd.read_excel('.\Configurations.xlsx', sheetname='InventoryPolicyConfig')
-                
-    # Read partial orders 
-    orders = read_partial_orders(store_id)   
+    # Get partial orders 
+    orders = context.partial_orders[store_id]
+    conf = context.conf
             
     # Compute metric
     metrics_df, partial_orders_master, sales_orders = compute_metric(sales_f, orders) # change orders_to_date to orders when in real time mode
+    if metrics_df is None:
+        return
     #write_file(sales_orders, '{}/sales_orders{}_{}.csv'.format(raw_data_folder_orders, store_id, file_date_format))     
 
     # Write partial orders for next day with unsold quantities for each order in history
@@ -222,88 +392,129 @@ def read_compute_write(store_id, file_date_format):
         partial_orders_policy['ConfidenceInterval'] = partial_orders_policy['ConfidenceInterval'].astype(int)
         partial_orders_policy.sort_index(inplace=True)
         write_file(partial_orders_policy, partial_orders_file_name)   
+    partial_orders_master['Quantity'] = partial_orders_master['Quantity'].astype(int)
+    context.partial_orders[store_id] = partial_orders_master
     return metrics_df, sales_orders
 
     
-def get_num_stockout(store_id, sales_orders, today_date):
+def managed_products(policy_id, n_products):
+    # Temporary solution for handling different products managed by different policies: numbers of the products of a store
+    if policy_id == "s_Q_perishable":
+        return range(1, int(n_products/2) + 1)
+    if policy_id == "s_Q":
+        return range(int(n_products/2) + 1, n_products + 1)
+    return range(1, n_products + 1)
+
+    
+def get_num_stockout(store_id, sales_orders, today_date, orders_temp, demand_forecasts, store_products):
     """
-    Get the number of stockout events on a certain day for each store under all policies
+    Get the number of stockout events on a certain day for each store under all policies,
+    given the partial orders of the store after today's sales, the demand forecasts and 
+    the products of the store. Inventory, sales and predicted demand of the managed products 
+    are joined in one table; a product with no inventory is short of the demand it did not sell.
     """
-    file_date_format = today_date.strftime('%Y_%m_%d_%H_%M_%S')
-    file_date_format_forecast = today_date.strftime('%Y-%m-%d_%H_%M_%S') 
-    print("file_date_format_forecast")
-    print(file_date_format_forecast)
-    
-    # Read sales for the day
-    #sales_file_name = '{}/sales_store{}_{}.csv'.format(raw_data_folder_sales, store_id, file_date_format)
-    #sales_temp = read_file(sales_file_name, 'TransactionDateTime')
     sales_temp = sales_orders[sales_orders['Spoilage']==False]
+    policies = np.sort(orders_temp['PolicyID'].unique())
+    today = datetime(today_date.year, today_date.month, today_date.day)
     
-    # Read partial orders 
-    start_time = time.time()
-    orders_temp = read_partial_orders(store_id)   
-    print("read_partial_orders() took %s seconds" % (time.time() - start_time))
-    
-    # Sort the two tables by date ascending  
-    orders_temp = orders_temp.sort_values(['PolicyID', 'ETA'])
-    sales_temp = sales_temp.sort_values('TransactionDateTime')
-    #sales_orders = pd.DataFrame(columns = sales_temp.columns.tolist() + ['OrderETA','PolicyID'])
-    policies = orders_temp.PolicyID.unique() 
-    
-    # Calculate number of stockout items per policy 
-    rows = []
-    rows_inventory = []
-    for policy_id in policies:
-        metrics_dict ={}
-        metrics_dict['NumStockout'] = 0
-        print(policy_id)
-        #inventory_df = orders_temp.loc[(orders_temp['PolicyID']==policy_id) & (orders_temp['ETA'].apply(lambda x: x.date()) <= pd.to_datetime(file_date_format, format='%Y_%m_%d_%H_%M_%S').date())]
-        file_date_format_round = pd.to_datetime(file_date_format, format='%Y_%m_%d_%H_%M_%S') 
-        file_date_format_round = datetime(file_date_format_round.year, file_date_format_round.month, file_date_format_round.day, 0, 0, 0)
-        inventory_df = orders_temp.loc[(orders_temp['PolicyID']==policy_id) & (orders_temp['ETA'] <= (pd.to_datetime(file_date_format_round, format='%Y_%m_%d_%H_%M_%S') + pd.DateOffset(1)))]
-        #print(inventory_df) 
-        
-        # Temporary solution for handling different products managed by different policies
-        if policy_id == "Sim":
-            managed_products = range(1, n_products + 1)
-        if policy_id == "s_Q_perishable":
-            managed_products = range(1, int(n_products/2) + 1)
-        if policy_id == "s_Q":
-            managed_products = range(int(n_products/2) + 1, n_products + 1)
-            
-        for product_id in managed_products: 
-            inventory_df_product = inventory_df.loc[inventory_df['ProductID']==str(product_id)+'_1']     
-            cur_inventory = inventory_df_product['Quantity'].sum()      
-            rows_inventory.append({'PolicyID': policy_id, 'DateTime': pd.to_datetime(file_date_format, format='%Y_%m_%d_%H_%M_%S').date(), 'StoreID': store_id, 'ProductID': product_id, 'Inventory': cur_inventory})                  
-            # Check the demand and sales if current inventory is empty                                
-            if cur_inventory == 0:
-                # Get predicted demand (use the previous day demand because today's sales file actually stores yesterday's sales)
-                prev_date = pd.to_datetime(file_date_format_forecast, format='%Y-%m-%d_%H_%M_%S') -  pd.DateOffset(1)
-                prev_date = prev_date.strftime('%Y-%m-%d_%H_%M_%S')
-                demand_file_name = '{}/demand_forecasts/{}/{}_1/{}.csv'.format(raw_data_folder_sales, store_id, product_id, prev_date)
-                demand_df = read_file(demand_file_name, 'DateTime')
-                cur_demand = demand_df['Demand'][0] 
-                # Get current sales
-                sales_temp_policy = sales_temp.loc[sales_temp['PolicyID']==policy_id]
-                cur_sales = sales_temp_policy.loc[sales_temp_policy['ProductID']==str(product_id)+'_1']['Units'].sum()
-                metrics_dict['NumStockout'] += max(int(cur_demand) - cur_sales, 0)
-                print(cur_demand)
-                print(cur_sales)
-                print('*********')                       
-        rows.append(metrics_dict)      
-    
-    num_stockout_df = pd.DataFrame(rows, columns = ['NumStockout'])   
-    orders_temp.sort_index(inplace=True) # keep the index of the order table same 
-    inventory_store = pd.DataFrame(rows_inventory, columns = ['PolicyID','DateTime','StoreID','ProductID','Inventory'])
+    # Inventory received by tomorrow, sales and predicted demand of every managed product
+    product_ids = store_products.set_index('ProductNumber')['ProductID']
+    products = [(policy_id, product_number) for policy_id in policies for product_number in managed_products(policy_id, len(product_ids))]
+    stock = pd.DataFrame({'PolicyID': [policy_id for policy_id, product_number in products], 
+                          'ProductID': product_ids.loc[[product_number for policy_id, product_number in products]].values}, 
+                         columns = ['PolicyID','ProductID'])
+    received = orders_temp.loc[orders_temp['ETA'] <= today + pd.DateOffset(1)]
+    inventory = received.groupby(['PolicyID','ProductID'])['Quantity'].sum().rename('Inventory').reset_index()
+    sales = sales_temp.groupby(['PolicyID','ProductID'])['Units'].sum().rename('Sales').reset_index()
+    stock = stock.merge(inventory, how='left', on=['PolicyID','ProductID'])
+    stock = stock.merge(sales, how='left', on=['PolicyID','ProductID'])
+    stock = stock.merge(demand_forecasts[['ProductID','Demand']], how='left', on='ProductID')
+    stock['Inventory'] = stock['Inventory'].fillna(0).astype(int)
+    stock['Sales'] = stock['Sales'].fillna(0).astype(int)
+    
+    # Check the demand and sales if current inventory is empty                                
+    stockout = (stock['Inventory'] == 0).values
+    no_forecast = stockout & stock['Demand'].isnull().values
+    if no_forecast.any():
+        raise Exception('No demand forecast for store {}, products {}'.format(store_id, stock.loc[no_forecast, 'ProductID'].unique().tolist()))
+    shortage = np.maximum(stock['Demand'].fillna(0).values.astype(int) - stock['Sales'].values, 0)
+    num_stockout = pd.Series(np.where(stockout, shortage, 0)).groupby(stock['PolicyID'].values).sum()
+    num_stockout_df = pd.DataFrame({'NumStockout': num_stockout.reindex(policies).fillna(0).astype(int).values}, columns = ['NumStockout'])   
     
+    inventory_store = pd.DataFrame({'PolicyID': stock['PolicyID'], 
+                                    'DateTime': today.date(), 
+                                    'StoreID': store_id, 
+                                    'ProductID': [product_number for policy_id, product_number in products], 
+                                    'Inventory': stock['Inventory']}, 
+                                   columns = ['PolicyID','DateTime','StoreID','ProductID','Inventory'])
     return num_stockout_df, inventory_store 
 
 
+def evaluate_store(storage, context, store_id, today_date):
+    """
+    Evaluate one store: metric, total revenue and number of stockout events of 
+    every policy, and the inventory of the managed products. Also writes the 
+    partial orders of the store for the next day. Runs in a worker process, 
+    which gets its own connection to the storage. Return None if the store 
+    has no sales for the day.
+    """
+    global adl
+    adl = storage
+    file_date_format = today_date.strftime('%Y_%m_%d_%H_%M_%S') 
+    # Get normalized revenue and total revenue
+    start_time = time.time()
+    result = read_compute_write(store_id, file_date_format, context)
+    print("read_compute_write() took %s seconds" % (time.time() - start_time))
+    if result is None:
+        return
+    metrics_df, sales_orders = result
+    # Get number of stockout events
+    start_time = time.time()
+    num_stockout_store, inventory_store = get_num_stockout(store_id, sales_orders, today_date, context.partial_orders[store_id], 
+                                                           context.demand_forecasts.loc[context.demand_forecasts['StoreID'] == str(store_id)],
+                                                           context.store_products.loc[context.store_products['StoreID'] == str(store_id)])
+    print("get_num_stockout() took %s seconds" % (time.time() - start_time))
+    metrics_df['NumStockout'] = num_stockout_store
+    adl.flush()
+    return metrics_df, inventory_store
+
+
+def evaluate_stores(store_ids, today_date, context, workers):
+    """
+    Evaluate the stores one after another, or fan them out to a pool of worker 
+    processes. A store that fails is reported and left out; the other stores 
+    are still evaluated. Return (store_id, metrics_df, inventory_store) of the 
+    stores with sales, in the order of store_ids.
+    """
+    results = []
+    def collect(store_id, get_result):
+        try:
+            result = get_result()
+        except Exception:
+            print("--- Evaluation of store {} failed ---".format(store_id))
+            traceback.print_exc()
+            return
+        if result is not None:
+            results.append((store_id,) + result)
+
+    if workers <= 1:
+        for store_id in store_ids:
+            collect(store_id, lambda: evaluate_store(adl, context, store_id, today_date))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(store_id, executor.submit(evaluate_store, adl, context.for_store(store_id), store_id, today_date)) 
+                       for store_id in store_ids]
+            for store_id, future in futures:
+                collect(store_id, future.result)
+    return results
+
+
 def metric_today(today_date):
     print("Compute metric of today")
+    metric_file_name = '{}/metric.csv'.format(raw_data_folder_orders)
     inventory_file_name = '{}/inventory.csv'.format(raw_data_folder_orders)
     cols = ['PolicyID','DateTime','StoreID','ProductID','Inventory']
-    inventory_master = pd.DataFrame(columns=cols)    
+    inventory_avg_by_stores = None
     if adl.exists(inventory_file_name):
         with adl.open(inventory_file_name, 'rb') as f:
             inventory_file = pd.read_csv(f, error_bad_lines=False)  
@@ -311,41 +522,28 @@ def metric_today(today_date):
                 print("Inventory file exists and contains records.")
                 inventory_avg_by_stores = inventory_file.groupby('PolicyID')['Inventory'].mean()
         
-    for store_id in range(1, n_stores + 1): 
-            sales_file_name = '{}/sales_store{}_{}.csv'.format(raw_data_folder_sales, store_id, today_date.strftime('%Y_%m_%d_%H_%M_%S'))
-            if not adl.exists(sales_file_name):
-                return
-            sales_check = read_file(sales_file_name, 'TransactionDateTime')
-            print("Check if sales file is empty")
-            print('{}/sales_store{}_{}.csv'.format(raw_data_folder_sales, store_id, today_date.strftime('%Y_%m_%d_%H_%M_%S')))
-            print(sales_check.empty)
-            if not sales_check.empty:                       
-                file_date_format = today_date.strftime('%Y_%m_%d_%H_%M_%S') 
-                # Get normalized revenue and total revenue
-                start_time = time.time()
-                metrics_df, sales_orders = read_compute_write(store_id, file_date_format)
-                print("read_compute_write() took %s seconds" % (time.time() - start_time))
-                # Get number of stockout events
-                file_date_format_forecast = today_date.strftime('%Y-%m-%d_%H_%M_%S')
-                start_time = time.time()
-                num_stockout_store, inventory_store = get_num_stockout(store_id, sales_orders, today_date)
-                print("get_num_stockout() took %s seconds" % (time.time() - start_time))
-                inventory_master = pd.concat([inventory_master, inventory_store])
-                metrics_df['NumStockout'] = num_stockout_store
-                # Get turnover ratio
-                if not adl.exists(inventory_file_name):
-                    inventory_avg_by_stores = inventory_store.groupby('PolicyID')['Inventory'].mean()
-                else:
-                    with adl.open(inventory_file_name, 'rb') as f:
-                        inventory_file = pd.read_csv(f, error_bad_lines=False)  
-                    if inventory_file.shape[0] == 0:
-                        inventory_avg_by_stores = inventory_store.groupby('PolicyID')['Inventory'].mean()
-
-                metrics_df['TurnoverRatio'] = metrics_df['TotalRevenue'].values / inventory_avg_by_stores.values 
-                metrics_df['StoreID'] = store_id                
-                # Write metrics_df to metric file
-                with adl.open(metric_file_name, 'ab') as f:
-                    f.write(metrics_df.to_csv(index=False, header=False).encode('utf-8'))
+    context = EvaluationContext(read_store_products(), today_date)
+    results = evaluate_stores(context.store_ids, today_date, context, n_workers)
+    
+    metrics_master = []
+    inventory_master = pd.DataFrame(columns=cols)    
+    for store_id, metrics_df, inventory_store in results:
+        inventory_master = pd.concat([inventory_master, inventory_store])
+        # Get turnover ratio, from the inventory of the store until the inventory file has records
+        if inventory_avg_by_stores is None:
+            metrics_df['TurnoverRatio'] = metrics_df['TotalRevenue'].values / inventory_store.groupby('PolicyID')['Inventory'].mean().values 
+        else:
+            metrics_df['TurnoverRatio'] = metrics_df['TotalRevenue'].values / inventory_avg_by_stores.values 
+        metrics_df['StoreID'] = store_id                
+        metrics_master.append(metrics_df)
+        
+    # Write the metrics of all stores to metric file
+    if len(metrics_master) > 0:
+        metrics_master = pd.concat(metrics_master)
+        with adl.open(metric_file_name, 'ab') as f:
+            f.write(metrics_master.to_csv(index=False, header=False).encode('utf-8'))
+    else:
+        metrics_master = pd.DataFrame(columns = ['PolicyID','MetricDateTime','Metric','TotalRevenue','NumStockout','TurnoverRatio','StoreID'])
                     
     # reate an inventory file if it doesn't exist
     if not adl.exists(inventory_file_name):
@@ -355,6 +553,7 @@ def metric_today(today_date):
     # Write inventory_master to inventory file
     with adl.open(inventory_file_name, 'ab') as f:
         f.write(inventory_master.to_csv(index=False, header=False).encode('utf-8')) 
+    return metrics_master
         
          
 def get_metric_change(summary_metric):
@@ -388,73 +587,166 @@ def get_metric_change(summary_metric):
     return metric_change
 
     
-def write_summary_metric(today_date):
-    days_per_week = 7
-    days_per_month = 30 
-    days_per_quarter = 91
+def aggregate_metric(metric_df, keys):
+    """
+    Partial aggregates of metric rows per keys, which can be added and taken 
+    out again: the number of rows, the sums of total revenue and stockout 
+    events, and for the averaged metric and turnover ratio the sum of the 
+    finite values, the number of values that are not NaN and the numbers of 
+    infinite values.
+    """
+    aggregates = pd.DataFrame({'Rows': np.ones(metric_df.shape[0], dtype=int)}, index=metric_df.index)
+    for column in mean_columns:
+        values = metric_df[column].astype(float)
+        aggregates[column + 'Sum'] = values.where(np.isfinite(values), 0)
+        aggregates[column + 'Count'] = values.notnull().astype(int)
+        aggregates[column + 'PosInf'] = (values == inf).astype(int)
+        aggregates[column + 'NegInf'] = (values == -inf).astype(int)
+    aggregates['TotalRevenue'] = metric_df['TotalRevenue'].astype(float).fillna(0)
+    aggregates['NumStockout'] = metric_df['NumStockout'].fillna(0).astype(int)
+    return aggregates.groupby([metric_df[key] for key in keys]).sum()[aggregate_columns]
+
+
+def add_aggregates(aggregates, other, sign=1):
+    """
+    Add (sign 1) or take out (sign -1) the aggregates of other, aligned on the (PolicyID, StoreID) index
+    """
+    total = aggregates.add(other * sign, fill_value=0)
+    for column in aggregate_columns:
+        if not column.endswith('Sum') and column != 'TotalRevenue':
+            total[column] = total[column].round().astype(int)
+    # a policy and store with no rows left in the window is not summarized
+    return total.loc[total['Rows'] > 0, aggregate_columns]
+
+
+def aggregate_mean(aggregates, column):
+    mean = aggregates[column + 'Sum'] / aggregates[column + 'Count']
+    mean[aggregates[column + 'PosInf'] > 0] = inf
+    mean[aggregates[column + 'NegInf'] > 0] = -inf
+    mean[(aggregates[column + 'PosInf'] > 0) & (aggregates[column + 'NegInf'] > 0)] = np.nan
+    return mean
+
+
+def read_aggregates(file_name):
+    with adl.open(file_name, 'rb') as f:
+        aggregates = pd.read_csv(f, dtype={'PolicyID':str})
+    return aggregates.set_index(['PolicyID','StoreID'])[aggregate_columns]
+
+
+def daily_aggregates_file_name(date):
+    return '{}/daily/{}.csv'.format(metric_aggregates_folder, date.strftime('%Y-%m-%d'))
+
+    
+def rebuild_metric_aggregates(today):
+    """
+    Aggregate the whole metric file (first run, or an earlier day evaluated 
+    again): write the daily aggregates of the days that can still be in a 
+    window, and return the aggregates of every window ending today.
+    """
     metric_file_name = '{}/metric.csv'.format(raw_data_folder_orders)
     with adl.open(metric_file_name, 'rb') as f:
-        metric_file = pd.read_csv(f, error_bad_lines=False) 
+        metric_file = pd.read_csv(f, error_bad_lines=False, dtype={'PolicyID':str}) 
+    metric_file['MetricDateTime'] = pd.to_datetime(metric_file['MetricDateTime']).dt.normalize()
+    
+    daily = aggregate_metric(metric_file, ['MetricDateTime','PolicyID','StoreID'])
+    for date, aggregates in daily.groupby(level='MetricDateTime'):
+        if date >= today - pd.DateOffset(max(days for days, eval_period in summary_windows)):
+            write_file(aggregates.reset_index(level='MetricDateTime', drop=True).reset_index(), daily_aggregates_file_name(date))
+    
+    windows = {}
+    dates = daily.index.get_level_values('MetricDateTime')
+    for days, eval_period in summary_windows:
+        in_window = (dates >= today - pd.DateOffset(days)) & (dates <= today)
+        windows[days] = daily.loc[in_window].groupby(level=['PolicyID','StoreID']).sum()
+    return windows
+
+
+def update_metric_aggregates(today, metrics_df):
+    """
+    Bring the aggregates of every window up to today: add the metric rows of 
+    today, then the days that entered the window and take out the days that 
+    left it, from the daily aggregates. Return None if the aggregates have to 
+    be rebuilt from the metric file.
+    """
+    windows_file_name = '{}/windows.csv'.format(metric_aggregates_folder)
+    if not adl.exists(windows_file_name):
+        return None
+    with adl.open(windows_file_name, 'rb') as f:
+        windows_file = pd.read_csv(f, dtype={'PolicyID':str}, parse_dates=['WindowDate'])
+    if windows_file.shape[0] == 0 or windows_file['WindowDate'].iat[0] > today:
+        return None
+    window_date = windows_file['WindowDate'].iat[0]
+    
+    # Add the rows of today to the daily aggregates, and to the windows as they are now 
+    windows = {days: windows_file.loc[windows_file['Days'] == days].set_index(['PolicyID','StoreID'])[aggregate_columns] 
+               for days, eval_period in summary_windows}
+    metrics_df = metrics_df.copy()
+    metrics_df['MetricDateTime'] = pd.to_datetime(metrics_df['MetricDateTime']).dt.normalize()
+    new = aggregate_metric(metrics_df, ['MetricDateTime','PolicyID','StoreID'])
+    for date, aggregates in new.groupby(level='MetricDateTime'):
+        aggregates = aggregates.reset_index(level='MetricDateTime', drop=True)
+        for days, eval_period in summary_windows:
+            if window_date - pd.DateOffset(days) <= date <= window_date:
+                windows[days] = add_aggregates(windows[days], aggregates)
+        file_name = daily_aggregates_file_name(date)
+        if adl.exists(file_name):
+            aggregates = add_aggregates(read_aggregates(file_name), aggregates)
+        write_file(aggregates.reset_index(), file_name)
+    
+    # Move the windows from window_date to today
+    daily = {}
+    def daily_aggregates(date):
+        if date not in daily:
+            file_name = daily_aggregates_file_name(date)
+            daily[date] = read_aggregates(file_name) if adl.exists(file_name) else None
+        return daily[date]
+    
+    for days, eval_period in summary_windows:
+        for date in pd.date_range(window_date + pd.DateOffset(1), today):
+            if daily_aggregates(date) is not None:
+                windows[days] = add_aggregates(windows[days], daily_aggregates(date))
+        for date in pd.date_range(window_date - pd.DateOffset(days), today - pd.DateOffset(days + 1)):
+            if daily_aggregates(date) is not None:
+                windows[days] = add_aggregates(windows[days], daily_aggregates(date), -1)
+    return windows
+
+    
+def write_summary_metric(today_date, metrics_df):
+    """
+    Summarize the metric of every policy and store over the last week, month 
+    and quarter. The sums and counts of each window are kept between runs and 
+    moved forward day by day, so the work does not grow with the history of 
+    the metric file.
+    """
+    today = pd.Timestamp(today_date).normalize()
+    windows = update_metric_aggregates(today, metrics_df)
+    if windows is None:
+        windows = rebuild_metric_aggregates(today)
+    
+    windows_file = pd.concat([windows[days].reset_index().assign(WindowDate=today, Days=days) for days, eval_period in summary_windows])
+    write_file(windows_file[['WindowDate','Days','PolicyID','StoreID'] + aggregate_columns], '{}/windows.csv'.format(metric_aggregates_folder))
     # Check if the metric file is empty
-    if metric_file.shape[0] == 0:
+    if windows_file.shape[0] == 0:
         return
-    metric_file['MetricDateTime'] = metric_file['MetricDateTime'].apply(pd.to_datetime, format='%Y-%m-%d %H:%M:%S')
+    
     column_names = ['MetricDateTime','EvalPeriod','PolicyID','StoreID','Metric','TotalRevenue','NumStockout','TurnoverRatio',
                     'MetricIncrease','TotalRevenueIncrease','NumStockoutDecrease','TurnoverRatioIncrease']
-    
-    # Get last week's metric
-    summary_metric_week = pd.DataFrame(columns=column_names) 
-    last_week_metric = metric_file.loc[(metric_file['MetricDateTime'] <= today_date) & (metric_file['MetricDateTime'] >= today_date - pd.DateOffset(days_per_week))]                                   
-    #avg_metric_last_week = metric_file.groupby(['PolicyID','StoreID'])['Metric'].mean().to_frame('Metric').reset_index() 
-    avg_metric_last_week1 = last_week_metric.groupby(['PolicyID','StoreID'])['Metric','TurnoverRatio'].mean().reset_index()
-    avg_metric_last_week2 = last_week_metric.groupby(['PolicyID','StoreID'])['TotalRevenue','NumStockout'].sum().reset_index()
-    avg_metric_last_week = avg_metric_last_week1.merge(avg_metric_last_week2, on=['PolicyID','StoreID'])
-    summary_metric_week['PolicyID'] = avg_metric_last_week['PolicyID']
-    summary_metric_week['StoreID'] = avg_metric_last_week['StoreID']
-    summary_metric_week['Metric'] = avg_metric_last_week['Metric']
-    summary_metric_week['TotalRevenue'] = avg_metric_last_week['TotalRevenue']
-    summary_metric_week['NumStockout'] = avg_metric_last_week['NumStockout']
-    summary_metric_week['TurnoverRatio'] = avg_metric_last_week['TurnoverRatio']
-    summary_metric_week['MetricDateTime'] = today_date
-    summary_metric_week['EvalPeriod'] = '(I) LastWeek'
-    metric_change = get_metric_change(summary_metric_week)
-    summary_metric_week['MetricIncrease'], summary_metric_week['TotalRevenueIncrease'], summary_metric_week['NumStockoutDecrease'], summary_metric_week['TurnoverRatioIncrease'] = metric_change['MetricIncrease'], metric_change['TotalRevenueIncrease'], metric_change['NumStockoutDecrease'], metric_change['TurnoverRatioIncrease']
-       
-    # Get last month's metric
-    summary_metric_month = pd.DataFrame(columns=column_names) 
-    last_month_metric = metric_file.loc[(metric_file['MetricDateTime'] <= today_date) & (metric_file['MetricDateTime'] >= today_date - pd.DateOffset(days_per_month))]                                    
-    avg_metric_last_month1 = last_month_metric.groupby(['PolicyID','StoreID'])['Metric','TurnoverRatio'].mean().reset_index()
-    avg_metric_last_month2 = last_month_metric.groupby(['PolicyID','StoreID'])['TotalRevenue','NumStockout'].sum().reset_index()
-    avg_metric_last_month = avg_metric_last_month1.merge(avg_metric_last_month2, on=['PolicyID','StoreID'])
-    summary_metric_month['PolicyID'] = avg_metric_last_month['PolicyID']
-    summary_metric_month['StoreID'] = avg_metric_last_month['StoreID']
-    summary_metric_month['Metric'] = avg_metric_last_month['Metric']
-    summary_metric_month['TotalRevenue'] = avg_metric_last_month['TotalRevenue']
-    summary_metric_month['NumStockout'] = avg_metric_last_month['NumStockout']
-    summary_metric_month['TurnoverRatio'] = avg_metric_last_month['TurnoverRatio']
-    summary_metric_month['MetricDateTime'] = today_date
-    summary_metric_month['EvalPeriod'] = '(II) LastMonth'   
-    metric_change = get_metric_change(summary_metric_month)
-    summary_metric_month['MetricIncrease'], summary_metric_month['TotalRevenueIncrease'], summary_metric_month['NumStockoutDecrease'], summary_metric_month['TurnoverRatioIncrease'] = metric_change['MetricIncrease'], metric_change['TotalRevenueIncrease'], metric_change['NumStockoutDecrease'], metric_change['TurnoverRatioIncrease']
-    
-    # Get last quarter's metric
-    summary_metric_quarter = pd.DataFrame(columns=column_names) 
-    last_quarter_metric = metric_file.loc[(metric_file['MetricDateTime'] <= today_date) & (metric_file['MetricDateTime'] >= today_date - pd.DateOffset(days_per_quarter))]                                    
-    avg_metric_last_quarter1 = last_quarter_metric.groupby(['PolicyID','StoreID'])['Metric','TurnoverRatio'].mean().reset_index()
-    avg_metric_last_quarter2 = last_quarter_metric.groupby(['PolicyID','StoreID'])['TotalRevenue','NumStockout'].sum().reset_index()
-    avg_metric_last_quarter = avg_metric_last_quarter1.merge(avg_metric_last_quarter2, on=['PolicyID','StoreID'])
-    summary_metric_quarter['PolicyID'] = avg_metric_last_quarter['PolicyID']
-    summary_metric_quarter['StoreID'] = avg_metric_last_quarter['StoreID']
-    summary_metric_quarter['Metric'] = avg_metric_last_quarter['Metric']
-    summary_metric_quarter['TotalRevenue'] = avg_metric_last_quarter['TotalRevenue']
-    summary_metric_quarter['NumStockout'] = avg_metric_last_quarter['NumStockout']
-    summary_metric_quarter['TurnoverRatio'] = avg_metric_last_quarter['TurnoverRatio']
-    summary_metric_quarter['MetricDateTime'] = today_date
-    summary_metric_quarter['EvalPeriod'] = '(III) LastQuarter'   
-    metric_change = get_metric_change(summary_metric_quarter)
-    summary_metric_quarter['MetricIncrease'], summary_metric_quarter['TotalRevenueIncrease'], summary_metric_quarter['NumStockoutDecrease'], summary_metric_quarter['TurnoverRatioIncrease'] = metric_change['MetricIncrease'], metric_change['TotalRevenueIncrease'], metric_change['NumStockoutDecrease'], metric_change['TurnoverRatioIncrease']
-                                
-    summary_metric_all = pd.concat([summary_metric_week, summary_metric_month, summary_metric_quarter])
+    summary_metric_all = []
+    for days, eval_period in summary_windows:
+        aggregates = windows[days].sort_index()
+        summary_metric = pd.DataFrame(columns=column_names) 
+        summary_metric['PolicyID'] = aggregates.index.get_level_values('PolicyID')
+        summary_metric['StoreID'] = aggregates.index.get_level_values('StoreID')
+        summary_metric['Metric'] = aggregate_mean(aggregates, 'Metric').values
+        summary_metric['TotalRevenue'] = aggregates['TotalRevenue'].values
+        summary_metric['NumStockout'] = aggregates['NumStockout'].values
+        summary_metric['TurnoverRatio'] = aggregate_mean(aggregates, 'TurnoverRatio').values
+        summary_metric['MetricDateTime'] = today_date
+        summary_metric['EvalPeriod'] = eval_period
+        metric_change = get_metric_change(summary_metric)
+        summary_metric['MetricIncrease'], summary_metric['TotalRevenueIncrease'], summary_metric['NumStockoutDecrease'], summary_metric['TurnoverRatioIncrease'] = metric_change['MetricIncrease'], metric_change['TotalRevenueIncrease'], metric_change['NumStockoutDecrease'], metric_change['TurnoverRatioIncrease']
+        summary_metric_all.append(summary_metric)
+    summary_metric_all = pd.concat(summary_metric_all)
     
     # Write summary_metric_all to summary metric file
     summary_metric_file_name = '{}/summary_metric.csv'.format(raw_data_folder_orders) 
@@ -464,13 +756,11 @@ def write_summary_metric(today_date):
         
 def renew_adl_token():
     print("--- Creating a thread to renew ADL token periodically ---")
-    global adl
     interval = 1800
     while True:
         time.sleep(interval)
         try:
-            token = lib.auth(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
-            adl = core.AzureDLFileSystem(token=token, store_name=adl_name)
+            adl.reconnect()
             print("--- ADL token has been renewed ---")
         except Exception as e:
             raise Exception('Error while attempting to connect to Azure Data Lake Store:\n{}'.format(e))             
@@ -480,11 +770,7 @@ def renew_adl_token():
 if __name__ == '__main__':   
     print("--- Evaluation started ---")
     start_time = time.time()
-    try:
-        token = lib.auth(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
-        adl = core.AzureDLFileSystem(token=token, store_name=adl_name)
-    except Exception as e:
-        raise Exception('Error while attempting to connect to Azure Data Lake Store:\n{}'.format(e))
+    adl = storage.connect()
 
     # Create an ADL token renew thread
     renew_thread = threading.Thread(target=renew_adl_token)
@@ -503,12 +789,14 @@ if __name__ == '__main__':
                 if len(adl.ls(policy)) == 0:
                     sys.exit(0) 
     
-    opts,args = getopt.getopt(sys.argv[1:],"d:",["datetime="])
+    opts,args = getopt.getopt(sys.argv[1:],"d:w:",["datetime=","workers="])
     for opt, arg in opts:
         if opt in ("-d","--datetime"):
             print(arg)
             # running in BATCH mode
             today_date = datetime.strptime(arg,"%m/%d/%Y %H:%M:%S")
+        elif opt in ("-w","--workers"):
+            n_workers = int(arg)
     
     if not ('today_date' in locals() or 'today_date' in globals()):
         # running in PROD mode
@@ -518,17 +806,17 @@ if __name__ == '__main__':
     metric_file_name = '{}/metric.csv'.format(raw_data_folder_orders)
     # Check if metric file already exists     
     if adl.exists(metric_file_name):  
-        metric_today(today_date)
+        metrics_df = metric_today(today_date)
     else:
         # Create empty metric file and write to adl
         metric_file = pd.DataFrame(columns = ['PolicyID','MetricDateTime','Metric','TotalRevenue','NumStockout','TurnoverRatio','StoreID']) 
         write_file(metric_file, metric_file_name)      
-        metric_today(today_date)
+        metrics_df = metric_today(today_date)
 
     summary_metric_file_name = '{}/summary_metric.csv'.format(raw_data_folder_orders)    
     # Check if summary metric file already exists     
     if adl.exists(summary_metric_file_name):
         adl.rm('{}/summary_metric.csv'.format(raw_data_folder_orders))   
-    write_summary_metric(today_date)
+    write_summary_metric(today_date, metrics_df)
  
     print("--- %s seconds ---" % (time.time() - start_time))
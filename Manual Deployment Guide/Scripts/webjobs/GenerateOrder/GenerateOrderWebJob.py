@@ -24,12 +24,13 @@ import json,cronex,uuid,subprocess
 
 #from pyomo.environ import *
 
-from azure.datalake.store import core, lib, multithread
+from azure.datalake.store import lib
 
 from azure.mgmt.datalake.analytics.job import DataLakeAnalyticsJobManagementClient
 from azure.mgmt.datalake.analytics.job.models import JobInformation, JobState, USqlJobProperties
 
 import invutils as utils
+import storage
 
 
 #ADL credentials
@@ -75,12 +76,11 @@ if __name__ == '__main__':
     configuration_file_name = 'Configurations.xlsx'
     configuration_adl_path = configuration_adl_folder + '/' + configuration_file_name
 
-    # Create the ADLS client
+    # Create the token used by the Data Lake Analytics jobs
     adl_token = lib.auth(tenant_id=_TENANT_ID, client_id=_CLIENT_ID, client_secret=_CLIENT_SECRET)
-    adls_file_system_client = core.AzureDLFileSystem(adl_token, store_name=_ADL_NAME)
 
-    #Download configuration file and scripts from Azure Data Lake Store to local
-    multithread.ADLDownloader(adls_file_system_client, lpath='.', rpath=configuration_adl_path, overwrite=True)
+    #Download configuration file and scripts from the store to local
+    storage.connect().download(configuration_adl_path, '.')
 
     #Read downloaded configuration file
     configuration_file_path = os.path.realpath(os.path.join('./', configuration_file_name))
@@ -25,7 +25,7 @@ import json,cronex,uuid,subprocess
 
 #from pyomo.environ import *
 
-from azure.datalake.store import core, lib, multithread
+from azure.datalake.store import lib
 import azure.batch.batch_service_client as batch
 import azure.batch.batch_auth as batchauth
 import azure.batch.models as batchmodels
@@ -36,6 +36,7 @@ from azure.mgmt.datalake.analytics.job.models import JobInformation, JobState, U
 from azure.common.credentials import ServicePrincipalCredentials
 
 import invutils as utils
+import storage
 
 now = datetime.datetime.now()
 current_date = now.date()
@@ -235,12 +236,12 @@ if __name__ == '__main__':
     optimization_config_path = 'config_optimization'
     scripts_local_path = os.path.realpath('./taskscripts')
 
-    # Create the ADLS client
+    # Create the storage client, and the token used by the Data Lake Analytics jobs
     adl_token = lib.auth(tenant_id=_TENANT_ID, client_id=_CLIENT_ID, client_secret=_CLIENT_SECRET)
-    adls_file_system_client = core.AzureDLFileSystem(adl_token, store_name=_ADL_NAME)
+    adls_file_system_client = storage.connect()
 
-    #Download configuration file from Azure Data Lake Store to local
-    multithread.ADLDownloader(adls_file_system_client, lpath='.', rpath=configuration_adl_path, overwrite=True)
+    #Download configuration file from the store to local
+    adls_file_system_client.download(configuration_adl_path, '.')
         
     #Read downloaded configuration file
     configuration_file_path = os.path.realpath(os.path.join('./', configuration_file_name))
@@ -358,7 +359,7 @@ if __name__ == '__main__':
             optimization_timeout_max = int(sum(optimization_timeout_all))
             #refresh ADLS token and client
             adl_token = lib.auth(tenant_id=_TENANT_ID, client_id=_CLIENT_ID, client_secret=_CLIENT_SECRET)
-            adls_file_system_client = core.AzureDLFileSystem(adl_token, store_name=_ADL_NAME)
+            adls_file_system_client.reconnect()
             #Create a list of configuration dictionaries for all inventory policies/jobs
             job_list = [{}] * num_active_policies
             job_id_list = []
@@ -21,7 +21,7 @@
 #
 
 import os, argparse
-from azure.datalake.store import core, lib, multithread
+import storage
 
 if __name__ == '__main__':
 
@@ -45,8 +45,7 @@ if __name__ == '__main__':
     adl_client_id = args.adl_client_id
     adl_client_secret = args.adl_client_secret
 
-    token = lib.auth(tenant_id=adl_tenant_id, client_id=adl_client_id, client_secret=adl_client_secret)
-    adls_file_system_client = core.AzureDLFileSystem(token, store_name=adl_name)
+    adl = storage.ADLStorage(adl_name, adl_tenant_id, adl_client_id, adl_client_secret)
     
     file_list = file_names.split(',')
     #upload configuration file, the configuration file was uploaded to root directory, but not visible in the portal
@@ -57,4 +56,4 @@ if __name__ == '__main__':
             remote_file = remote_path + file
         local_file = os.path.join(local_path,file)
         print('Uploading log file {} to ADL folder [{}]...'.format(local_file, remote_path))    
-        multithread.ADLUploader(adls_file_system_client, lpath=local_file , rpath= remote_file,overwrite=True)
+        adl.upload(local_file, remote_file)
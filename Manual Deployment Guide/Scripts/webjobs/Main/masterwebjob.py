@@ -23,13 +23,7 @@
 #
 
 import datetime, time, requests,json,os
-from azure.datalake.store import core, lib, multithread
-
-#ADL credentials
-_ADL_NAME = os.environ['DATALAKESTORE_NAME']
-_TENANT_ID = os.environ['TENANT_ID']
-_CLIENT_ID = os.environ['CLIENT_ID']
-_CLIENT_SECRET = os.environ['CLIENT_SECRET']
+import storage
 
 #Web App credentials
 _WEB_APP_NAME = os.environ['FUNCTIONS_APP_NAME']
@@ -37,10 +31,9 @@ _WEB_APP_USER = os.environ['FUNCTIONS_APP_USER']
 _WEB_APP_PASSWORD = os.environ['FUNCTIONS_APP_PASSWORD']
 
 #Pull the last simulation datetime from ADLS and decide the current simulation datetime
-token = lib.auth(tenant_id=_TENANT_ID, client_id=_CLIENT_ID, client_secret=_CLIENT_SECRET)
-adl = core.AzureDLFileSystem(token=token, store_name=_ADL_NAME)
+adl = storage.connect()
 
-multithread.ADLDownloader(adl, lpath='LastSimulationDatetime.txt', rpath='/webjob_log/LastSimulationDatetime.txt', overwrite=True)
+adl.download('/webjob_log/LastSimulationDatetime.txt', 'LastSimulationDatetime.txt')
 f = open('LastSimulationDatetime.txt','r')
 simulation_datetime_last_str = f.readlines()[0]
 f.close()
@@ -57,7 +50,7 @@ f = open('LastSimulationDatetime.txt','w')
 f.writelines(simulation_datetime_cur_str)
 f.close()
 
-multithread.ADLUploader(adl, lpath='LastSimulationDatetime.txt', rpath='/webjob_log/LastSimulationDatetime.txt',overwrite=True)
+adl.upload('LastSimulationDatetime.txt', '/webjob_log/LastSimulationDatetime.txt')
 
 webjob_simulator = 'Simulator'
 webjob_optimization = 'InventoryOptimization'
@@ -141,8 +134,7 @@ if __name__ == '__main__':
 
     computation_time_str = simulation_datetime_cur_str + ',' + str(round(computation_time)) + '\n'
 
-    token = lib.auth(tenant_id=_TENANT_ID, client_id=_CLIENT_ID, client_secret=_CLIENT_SECRET)
-    adl = core.AzureDLFileSystem(token=token, store_name=_ADL_NAME)
+    adl.reconnect()
     with adl.open('/webjob_log/ComputationTime.csv','ab') as f:
         f.write(computation_time_str.encode('utf-8'))
 
@@ -27,23 +27,29 @@
 import sys
 
 import datetime as dt
-import os, json, codecs, random
+import os, io, csv, json, codecs, zlib
 import pandas as pd
-from io import StringIO
+from io import StringIO, BytesIO
 from copy import deepcopy
-from azure.datalake.store import core, lib, multithread
+import storage
 import numpy as np
-from numpy.random import uniform, random_integers, choice
 from collections import Counter
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import getopt
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None  # only needed for Parquet output
+
 if sys.version_info[0] < 3: 
     from StringIO import StringIO
 else:
     from io import StringIO
 
-random.seed(1)
+random_seed = 1  # root seed of a new hierarchy; later runs use the seed recorded in the hierarchy
 
 ##############################################
 # configuration parameters
@@ -55,37 +61,111 @@ private_parameters_folder = 'privateparameters'
 orders_folder = 'orders'
 configuration_folder = 'configuration'
 hierarchy_file = 'hierarchy_invopt.json'
+hierarchy_index_file = 'hierarchy_index.npz'  # flat tables of the hierarchy, rebuilt when the hierarchy changes
+horizon_file = 'price_demand_horizon.csv'  # prices and demand generated by previous runs
+forecast_index_folder = 'index'  # under demand_forecasts: one file per forecast date listing the (store, product) forecasts written,
+                                 # with the first date and demand of each forecast (read by the evaluation)
+columnar_folder = 'columnar'  # under the raw data folder: Parquet datasets, partitioned by date
+state_folder = 'state'  # under the private parameters folder: binary snapshot of every store at the end of the last run
+policy_records_folder = 'policies'  # under the raw data folder: sales and inventory of every active policy, as CSV
+
+# Formats of the raw data written (sales, inventory, spoilage, prices, demand forecasts):
+#   'json'    - one JSON document per store and date
+#   'csv'     - one CSV file per store and date (read by the U-SQL jobs)
+#   'parquet' - one Parquet file per dataset and date, holding all stores (requires pyarrow)
+# Demand forecasts are always written as CSV, since the simulator reads them back.
+output_formats = ['json', 'csv']
+parquet_compression = 'snappy'
 
 # Dynamic starting date: 14 days ago
 n_weeks_to_simulate = 1
 n_weeks_to_forecast = 6
 
-opts,args = getopt.getopt(sys.argv[1:],"d:",["datetime="])
+# Generation of sale/loss events:
+#   'batch' - draw all events of a store-day at once
+#   'loop'  - draw events one at a time (original implementation)
+#   'check' - compare both generators statistically before simulating each day in batch mode
+event_mode = 'batch'
+n_equivalence_trials = 50
+
+# number of worker processes simulating stores in parallel (1 = simulate stores one after another)
+n_workers = 1
+
+# generate prices and demand only for the dates not generated by previous runs (False = regenerate the whole horizon)
+incremental_horizon = True
+
+# number of demand forecast files fetched and parsed concurrently
+n_forecast_readers = 16
+
+# Raw data files are streamed to the store: characters buffered before each write, and the JSON layout
+# (indented like json.dumps(indent=4), the original layout, or compact without whitespace)
+write_buffer_size = 2 ** 20
+json_indent = True
+
+# number of threads writing files to the store in the background, while the simulation goes on (0 = write each file
+# before moving on); every run waits for all of its files at the end
+n_uploaders = 8
+
+# Size of the simulated retailer, used when the hierarchy is generated (first run); later runs keep the stored hierarchy.
+# Per-store attributes are kept for every store and product, so memory grows with Stores x Brands x ProductsPerBrand.
+scale_profiles = {
+    'small':  {'Stores': 6,    'Brands': 20,   'ProductsPerBrand': 1,  'Departments': 4,  'Suppliers': 5,   'StorageSpaces': 4},
+    'medium': {'Stores': 50,   'Brands': 200,  'ProductsPerBrand': 5,  'Departments': 10, 'Suppliers': 20,  'StorageSpaces': 10},
+    'large':  {'Stores': 500,  'Brands': 1000, 'ProductsPerBrand': 10, 'Departments': 20, 'Suppliers': 50,  'StorageSpaces': 20},
+    'xl':     {'Stores': 5000, 'Brands': 5000, 'ProductsPerBrand': 10, 'Departments': 50, 'Suppliers': 200, 'StorageSpaces': 50}
+}
+scale = 'small'
+
+# backfill: simulate every day from the simulated date up to this date (same format) in one process
+backfill_date = None
+
+opts,args = getopt.getopt(sys.argv[1:],"d:e:w:fo:s:b:r:cu:",["datetime=","events=","workers=","full-horizon","output-formats=","scale=",
+                                                             "backfill-until=","seed=","compact-json","uploaders="])
 for opt, arg in opts:
     if opt in ("-d","--datetime"):
         print(arg)
         # running in BATCH mode
         today_date = datetime.strptime(arg,"%m/%d/%Y %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+    elif opt in ("-b","--backfill-until"):
+        backfill_date = datetime.strptime(arg,"%m/%d/%Y %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+    elif opt in ("-r","--seed"):
+        random_seed = int(arg)
+    elif opt in ("-e","--events"):
+        if arg not in ('batch', 'loop', 'check'):
+            raise Exception('Unknown event generation mode {}'.format(arg))
+        event_mode = arg
+    elif opt in ("-w","--workers"):
+        n_workers = int(arg)
+    elif opt in ("-u","--uploaders"):
+        n_uploaders = int(arg)
+    elif opt in ("-f","--full-horizon"):
+        incremental_horizon = False
+    elif opt in ("-c","--compact-json"):
+        json_indent = False
+    elif opt in ("-o","--output-formats"):
+        output_formats = arg.split(',')
+    elif opt in ("-s","--scale"):
+        if arg not in scale_profiles:
+            raise Exception('Unknown scale profile {}'.format(arg))
+        scale = arg
+
+if 'parquet' in output_formats and pa is None:
+    raise ImportError('Parquet output requires pyarrow')
 
 if not ('today_date' in locals() or 'today_date' in globals()):
     # running in PROD mode
     today_date = datetime(datetime.today().year, datetime.today().month, datetime.today().day).strftime("%Y-%m-%d %H:%M:%S")
 
 
-adl_name = os.environ['DATALAKESTORE_NAME']
-tenant_id = os.environ['TENANT_ID']
-client_id = os.environ['CLIENT_ID']
-client_secret = os.environ['CLIENT_SECRET']
- 
 ##############################################
 #    simulation parameters
 ##############################################
 
-n_stores = 6
-n_brands = 20
-n_departments = 4
-n_suppliers = 5
-products_per_brand = 1
+n_stores = scale_profiles[scale]['Stores']
+n_brands = scale_profiles[scale]['Brands']
+n_departments = scale_profiles[scale]['Departments']
+n_suppliers = scale_profiles[scale]['Suppliers']
+products_per_brand = scale_profiles[scale]['ProductsPerBrand']
 loss_rate = 0
 
 # store department parameters
@@ -93,7 +173,7 @@ min_price_elasticity = -1.3  # price elasticity is defined per department
 max_price_elasticity = -0.7  # price elasticity is the same for all brands in the same department
 
 # storage parameters
-n_storage_spaces = 4  # number of storage spaces in each store
+n_storage_spaces = scale_profiles[scale]['StorageSpaces']  # number of storage spaces in each store
 min_storage_volume = 100
 max_storage_volume = 200
 min_storage_budget = 1000
@@ -155,16 +235,146 @@ max_service_level = 0.9999
 min_disposal_multiplier = 0.1
 max_disposal_multiplier = 0.2
 
-# auxiliary function for writing data to csv files
-def write_data(list_of_dict, fields, adl, file_name):
+# auxiliary function for flattening nested dictionaries: each row is a tuple of dictionaries, the first fields
+# are taken from the corresponding dictionary and the remaining fields from the last one
+def data_frame(list_of_dict, fields):
     rows = []
     for row in list_of_dict:
         new_row = [row[i][fields[i]] for i in range(len(row))]
         new_row.extend([row[-1][x] for x in fields[len(row):]])
         rows.append(new_row)
-    rows_df = pd.DataFrame(rows, columns=fields)
-    with adl.open(file_name, 'wb') as f:
-        f.write(rows_df.to_csv(index=False).encode('utf-8'))
+    return pd.DataFrame(rows, columns=fields)
+
+
+class StorageWriter(io.TextIOBase):
+    ''' Text stream over a binary file of the store: the text is encoded and written whenever
+        buffer_size characters are pending, so that no file is ever held in memory as one string '''
+
+    def __init__(self, f, buffer_size=None):
+        io.TextIOBase.__init__(self)
+        self.f = f
+        self.buffer_size = write_buffer_size if buffer_size is None else buffer_size
+        self.chunks = []
+        self.pending = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.pending += len(text)
+        if self.pending >= self.buffer_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.chunks:
+            self.f.write(''.join(self.chunks).encode('utf-8'))
+            self.chunks = []
+            self.pending = 0
+
+    def close(self):
+        # the file of the store is closed by its owner
+        self.flush()
+        io.TextIOBase.close(self)
+
+
+# auxiliary function for writing data to csv files: the rows are written as they are flattened
+def write_data(list_of_dict, fields, adl, file_name):
+    rows = ([row[i][fields[i]] for i in range(len(row))] + [row[-1][x] for x in fields[len(row):]] for row in list_of_dict)
+    write_rows(rows, fields, adl, file_name)
+
+
+def write_rows(rows, fields, adl, file_name, mode='wb'):
+    ''' Write an iterable of rows (sequences of values) to a CSV file, with the layout of DataFrame.to_csv '''
+    with adl.open(file_name, mode) as f, StorageWriter(f) as out:
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(fields)
+        writer.writerows(rows)
+
+
+def write_frame(rows_df, adl, file_name, mode='wb', **to_csv_args):
+    ''' Write a data frame to a CSV file (without its index); pandas formats it in chunks '''
+    with adl.open(file_name, mode) as f, StorageWriter(f) as out:
+        rows_df.to_csv(out, index=False, **to_csv_args)
+
+
+def dump_json(value, level=0):
+    ''' JSON text of a value with sorted keys, as nested level deep in an indented document (json_indent) '''
+    if not json_indent:
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return json.dumps(value, sort_keys=True, indent=4, separators=(',', ': ')).replace('\n', '\n' + '    ' * level)
+
+
+def write_json(document, adl, file_name, stream_key=None, items=()):
+    ''' Write a JSON document, with the same text as dump_json(document). The list under stream_key is
+        taken from items, any iterable, and encoded one item at a time '''
+    fields = dict(document)
+    if stream_key is not None:
+        fields[stream_key] = None
+    newline, indent = ('\n', '    ') if json_indent else ('', '')
+    separator = ': ' if json_indent else ':'
+    with adl.open(file_name, 'wb') as f, StorageWriter(f) as out:
+        out.write('{')
+        for n, key in enumerate(sorted(fields)):
+            out.write('{}{}{}{}{}'.format(',' if n > 0 else '', newline, indent, json.dumps(key), separator))
+            if key != stream_key:
+                out.write(dump_json(fields[key], 1))
+                continue
+            out.write('[')
+            empty = True
+            for item in items:
+                out.write('{}{}{}{}'.format(',' if not empty else '', newline, indent * 2, dump_json(item, 2)))
+                empty = False
+            out.write(']' if empty else newline + indent + ']')
+        out.write(newline + '}' if fields else '}')
+
+
+# column types of the Parquet datasets; StoreID and ProductID are dictionary-encoded strings
+columnar_schemas = {
+    'sales': [('StoreID', 'id'), ('ProductID', 'id'), ('TransactionDateTime', 'timestamp'), ('Units', 'int32'), ('Price', 'float64')],
+    'inventory': [('StoreID', 'id'), ('ProductID', 'id'), ('InventoryDateTime', 'timestamp'), ('Units', 'int32'),
+                  ('ExpiryDateTime', 'timestamp')],
+    'spoilage': [('StoreID', 'id'), ('ProductID', 'id'), ('SpoilageDateTime', 'timestamp'), ('Units', 'int32'),
+                 ('ExpiryDateTime', 'timestamp')],
+    'prices': [('StoreID', 'id'), ('ProductID', 'id'), ('DateTime', 'timestamp'), ('Price', 'float64')],
+    'demand_forecasts': [('StoreID', 'id'), ('ProductID', 'id'), ('DateTime', 'timestamp'), ('Demand', 'float64')]
+}
+
+
+def columnar_file_name(folder, dataset, partition_date):
+    ''' Parquet file of a dataset for one date (Hive-style partition, so that readers can filter on the date) '''
+    return '{}/{}/{}/Date={}/part-0.parquet'.format(folder, columnar_folder, dataset,
+                                                    pd.to_datetime(partition_date).strftime('%Y-%m-%d'))
+
+
+def write_columnar(adl, folder, dataset, partition_date, frames):
+    ''' Write the records of all stores for one date as a single Parquet file '''
+    df = pd.concat(frames, ignore_index=True)
+    columns = []
+    for column, column_type in columnar_schemas[dataset]:
+        if column_type == 'id':
+            values = pa.array(df[column].astype(str).values).dictionary_encode()
+        elif column_type == 'timestamp':
+            values = pa.array(pd.to_datetime(df[column]).values.astype('datetime64[s]'), type=pa.timestamp('s'))
+        else:
+            values = pa.array(df[column].values.astype(column_type))
+        columns.append(values)
+    table = pa.Table.from_arrays(columns, names=[column for column, _ in columnar_schemas[dataset]])
+    buffer = BytesIO()
+    pq.write_table(table, buffer, compression=parquet_compression)
+    with adl.open(columnar_file_name(folder, dataset, partition_date), 'wb') as f:
+        f.write(buffer.getvalue())
+
+
+def read_columnar(adl, folder, dataset, partition_date):
+    ''' Read a date partition of a Parquet dataset, None if it was not written '''
+    file_name = columnar_file_name(folder, dataset, partition_date)
+    if pa is None or not adl.exists(file_name):
+        return None
+    with adl.open(file_name, blocksize=2 ** 20) as f:
+        table = pq.read_table(BytesIO(f.read()))
+    return table.to_pandas()
 
 
 # define policy_name of inventory management policy that manager product in a store
@@ -172,86 +382,442 @@ def get_policy_name(store, product, supplier):
     return "Sim"
 
 
+# Sale and loss events of a workday form a Poisson process whose rate is the sum of all product rates.
+# Both generators below return the elapsed time of each event (as a fraction of a day, in increasing order)
+# and the index of the rate that generated it.
+# rng is either the numpy.random module or a numpy.random.RandomState.
+def generate_events(rates, workday_length, rng=np.random):
+    ''' Draw all events of a workday at once: Poisson number of events, uniform arrival times, categorical event ids '''
+    rates = np.asarray(rates, dtype=float)
+    total_rate = rates.sum()
+    if total_rate <= 0:
+        return np.zeros(0), np.zeros(0, dtype=int)
+    n_events = rng.poisson(total_rate)
+    elapsed = np.sort(rng.uniform(0, workday_length, n_events))
+    event_ids = rng.choice(a=len(rates), size=n_events, p=rates / total_rate)
+    return elapsed, event_ids
+
+
+def generate_events_loop(rates, workday_length, rng=np.random):
+    ''' Draw events one at a time from exponential inter-arrival times (original implementation) '''
+    ''' Beta is the expectation of inverse time until another event occurs '''
+    beta = workday_length / sum(rates)
+    rate_ids = list(range(len(rates)))
+    probabilities = [i / sum(rates) for i in rates]
+
+    elapsed = []
+    event_ids = []
+    workday_elapsed = 0.
+    while True:
+        ''' Choose a time elapsed until the next event '''
+        workday_elapsed += rng.exponential(scale=beta)
+        if workday_elapsed > workday_length:
+            break
+
+        ''' Choose which event occurred at that time '''
+        elapsed.append(workday_elapsed)
+        event_ids.append(rng.choice(a=rate_ids, p=probabilities))
+    return np.array(elapsed, dtype=float), np.array(event_ids, dtype=int)
+
+
+def check_event_equivalence(rates, workday_length, n_trials=n_equivalence_trials, rng=np.random):
+    ''' Compare the batch and loop event generators on the same rates.
+        Checks the number of events per day (z-test on the means), the distribution of event ids
+        (chi-square test of homogeneity) and the arrival times (two-sample Kolmogorov-Smirnov test). '''
+    samples = {}
+    for name, generator in (('batch', generate_events), ('loop', generate_events_loop)):
+        draws = [generator(rates, workday_length, rng) for trial in range(n_trials)]
+        samples[name] = (np.array([len(elapsed) for elapsed, event_ids in draws]),
+                         np.concatenate([elapsed for elapsed, event_ids in draws]),
+                         np.concatenate([event_ids for elapsed, event_ids in draws]))
+    counts_batch, elapsed_batch, ids_batch = samples['batch']
+    counts_loop, elapsed_loop, ids_loop = samples['loop']
+
+    # number of events per day
+    count_se = np.sqrt((counts_batch.var() + counts_loop.var()) / n_trials)
+    count_z = 0. if count_se == 0 else (counts_batch.mean() - counts_loop.mean()) / count_se
+
+    # event ids, restricted to the ids that occurred at least once
+    observed = np.vstack([np.bincount(ids_batch, minlength=len(rates)),
+                          np.bincount(ids_loop, minlength=len(rates))]).astype(float)
+    observed = observed[:, observed.sum(axis=0) > 0]
+    expected = observed.sum(axis=1, keepdims=True) * observed.sum(axis=0, keepdims=True) / max(observed.sum(), 1)
+    chi_square = ((observed - expected) ** 2 / np.where(expected > 0, expected, 1)).sum()
+    dof = max(observed.shape[1] - 1, 1)
+    chi_square_limit = dof + 4 * np.sqrt(2 * dof)  # roughly the 0.1% upper tail for moderate dof
+
+    # arrival times
+    n, m = len(elapsed_batch), len(elapsed_loop)
+    if n > 0 and m > 0:
+        pooled = np.concatenate([elapsed_batch, elapsed_loop])
+        cdf_batch = np.searchsorted(np.sort(elapsed_batch), pooled, side='right') / float(n)
+        cdf_loop = np.searchsorted(np.sort(elapsed_loop), pooled, side='right') / float(m)
+        ks = np.abs(cdf_batch - cdf_loop).max()
+        ks_limit = 1.95 * np.sqrt((n + m) / float(n * m))  # 0.1% significance level
+    else:
+        ks, ks_limit = 0., 1.
+
+    result = {'CountZ': float(count_z), 'ChiSquare': float(chi_square), 'ChiSquareLimit': float(chi_square_limit),
+              'KS': float(ks), 'KSLimit': float(ks_limit)}
+    result['Equivalent'] = bool(abs(count_z) < 4 and chi_square < chi_square_limit and ks < ks_limit)
+    return result
+
+
+def rank_within_groups(groups):
+    ''' Position of each element among the elements of its group, in array order '''
+    order = np.argsort(groups, kind='mergesort')
+    sorted_groups = groups[order]
+    ranks = np.empty(len(groups), dtype=int)
+    ranks[order] = np.arange(len(groups)) - np.searchsorted(sorted_groups, sorted_groups, side='left')
+    return ranks
+
+
+def zero_truncated_poisson(k, size, rng=np.random):
+    ''' Draw x>=1 from a Poisson distribution, redrawing the zeros '''
+    result = rng.poisson(k, size)
+    zeros = np.flatnonzero(result == 0)
+    while len(zeros) > 0:
+        result[zeros] = rng.poisson(k, len(zeros))
+        zeros = zeros[result[zeros] == 0]
+    return result
+
+
+def receipt_starts(n_items, k, rng=np.random):
+    ''' Index of the first item of each receipt, when n_items sold items are grouped into
+        receipts of zero-truncated Poisson sizes '''
+    sizes = zero_truncated_poisson(k, n_items, rng)  # there cannot be more receipts than items
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    return starts[starts < n_items]
+
+
+def write_sales_json(out, store_id, log_date, product_json, products, times, prices, starts):
+    ''' Write a sales log to a text stream with the layout of dump_json, one receipt at a time.
+        product_json holds the JSON string of every product id; products, times (strings) and prices describe
+        the sold items and starts the first item of each receipt '''
+    ends = np.append(starts[1:], len(products)).astype(np.int64)
+    amounts = np.add.reduceat(prices, starts) if len(starts) > 0 else np.zeros(0)
+    subtotals = np.round(amounts, 2)
+    taxes = np.round(amounts * 0.07, 2)
+    totals = np.round(amounts + taxes, 2)
+
+    if json_indent:
+        head = '{{\n    "SalesLogDateTime": {},\n    "StoreID": {},\n    "Transactions": ['
+        item, item_separator = '                {{\n                    "Price": {!r},\n                    "ProductID": {}\n                }}', ',\n'
+        receipt_layout = ('{}\n        {{\n            "Products": [\n{}\n            ],\n            "Subtotal": {!r},\n'
+                          '            "Tax": {!r},\n            "Total": {!r},\n            "TransactionDateTime": {}\n        }}')
+        tail, empty_tail = '\n    ]\n}', ']\n}'
+    else:
+        head = '{{"SalesLogDateTime":{},"StoreID":{},"Transactions":['
+        item, item_separator = '{{"Price":{!r},"ProductID":{}}}', ','
+        receipt_layout = '{}{{"Products":[{}],"Subtotal":{!r},"Tax":{!r},"Total":{!r},"TransactionDateTime":{}}}'
+        tail, empty_tail = ']}', ']}'
+
+    out.write(head.format(json.dumps(log_date), store_id))
+    if len(starts) == 0:
+        out.write(empty_tail)
+        return
+
+    products = products.tolist()
+    prices = prices.tolist()
+    for receipt, (start, end, subtotal, tax, total) in enumerate(zip(starts.tolist(), ends.tolist(), subtotals.tolist(),
+                                                                     taxes.tolist(), totals.tolist())):
+        items = item_separator.join(item.format(prices[i], product_json[products[i]]) for i in range(start, end))
+        out.write(receipt_layout.format(',' if receipt > 0 else '', items, subtotal, tax, total, json.dumps(times[end - 1])))
+    out.write(tail)
+
+
+# Random numbers that are a function of a key (e.g. store, product and date) rather than of the
+# number of draws made before, so that a value can be regenerated in isolation.
+# All of them derive from the root seed recorded in the hierarchy (RandomSeed).
+def mix_hash(values):
+    ''' splitmix64 finalizer: maps an array of integers to well mixed 64 bit integers.
+        The arithmetic wraps around modulo 2 ** 64 on purpose, so numpy's overflow warnings are silenced '''
+    with np.errstate(over='ignore'):
+        z = np.asarray(values).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def key_hash(seed, *keys):
+    ''' Combine arrays of integer keys and the root seed into one array of 64 bit hashes '''
+    h = mix_hash(np.full(np.broadcast(*keys).shape, seed, dtype=np.uint64))
+    for key in keys:
+        h = mix_hash(h ^ np.asarray(key).astype(np.uint64))
+    return h
+
+
+def string_codes(values):
+    ''' Map strings (e.g. product ids) to integers that are the same from one run to the next '''
+    uniques, inverse = np.unique(np.asarray(values).astype(str), return_inverse=True)
+    codes = np.array([zlib.crc32(value.encode('utf-8')) & 0xffffffff for value in uniques], dtype=np.uint64)
+    return codes[inverse]
+
+
+def random_stream(seed, *keys):
+    ''' Random stream of a purpose, e.g. ('events', store, date): independent of the other streams and of the
+        order they are drawn in, so that a store-day can be simulated again in isolation or in another process '''
+    h = int(key_hash(seed, *[zlib.crc32(str(key).encode('utf-8')) & 0xffffffff for key in keys]))
+    return np.random.RandomState([h & 0xffffffff, h >> 32])
+
+
+def keyed_normal(keys, counter):
+    ''' Standard normal draw for every key; counter selects an independent draw for the same keys '''
+    bits = mix_hash(keys ^ np.uint64(2 * counter + 1)), mix_hash(keys ^ np.uint64(2 * counter + 2))
+    u1, u2 = [(b >> np.uint64(11)).astype(np.float64) / 2. ** 53 for b in bits]
+    return np.sqrt(-2 * np.log(1 - u1)) * np.cos(2 * np.pi * u2)  # Box-Muller
+
+
+def sample_prices(cost, msrp, keys):
+    ''' Pick random prices between products' cost and MSRP (normal distribution truncated by rejection).
+        Only the rejected rows are drawn again, and draws are a function of the keys, so that
+        the price of a product in a store on a date is the same from one run to the next '''
+    mu = cost + 0.8 * (msrp - cost)
+    sd = (0.5 * (msrp - cost)) ** 2
+    prices = np.full(len(keys), np.nan)
+    pending = np.arange(len(keys))
+    attempt = 0
+    while len(pending) > 0:
+        result = mu[pending] + sd[pending] * keyed_normal(keys[pending], attempt)
+        accepted = (result <= msrp[pending]) & (result >= cost[pending])
+        prices[pending[accepted]] = np.round(result[accepted], 2)
+        pending = pending[~accepted]
+        attempt += 1
+    return prices
+
+
+def demand_kernel(prices, departments, new, msrp, traffic, desirability, elasticity):
+    ''' Demand of the rows selected by the boolean mask new (currently based on a modified formula suggested by Yiyu).
+        prices and departments (integer codes) are given for all rows, since a price is taken relative to the mean
+        price of its department over all rows; msrp, traffic, desirability and elasticity for the selected rows only '''
+    mean_prices = np.bincount(departments, weights=prices) / np.bincount(departments)
+    price = prices[new]
+    relative_price = price / mean_prices[departments[new]]
+    frac_discount_over_msrp = (msrp - price) / msrp
+    demand = traffic * desirability / (1 - frac_discount_over_msrp)
+    demand += (relative_price - 1) * price * elasticity
+    demand /= relative_price ** 2
+    return np.maximum(demand, 5)
+
+
+def to_epoch(dates):
+    ''' Seconds since the epoch of a timestamp or a list of timestamps '''
+    if isinstance(dates, (str, datetime)):
+        return pd.Timestamp(dates).value // 10 ** 9
+    return np.asarray(pd.to_datetime(dates).values, dtype='datetime64[s]').astype(np.int64)
+
+
+def epoch_to_string(epochs):
+    ''' Format seconds since the epoch as "%Y-%m-%d %H:%M:%S" strings '''
+    strings = np.datetime_as_string(np.asarray(epochs, dtype=np.int64).astype('datetime64[s]'))
+    return np.char.replace(strings, 'T', ' ') if strings.size > 0 else strings
+
+
+def connect_adl():
+    ''' Connect to the store configured by the environment (Azure Data Lake Store by default). Files are written
+        in the background by n_uploaders threads: call flush before the run ends '''
+    adl = storage.connect()
+    if n_uploaders > 0:
+        adl = storage.PipelinedStorage(adl, n_uploaders)
+    return adl
+
+
 # definitions of static data (suppliers, products, brands, stores, storage)
+def hierarchy_version(hierarchy):
+    ''' Checksum of the static part of the hierarchy (the dates change on every run) '''
+    static = {key: hierarchy[key] for key in ['Brands', 'Suppliers', 'Stores']}
+    return '{:08x}'.format(zlib.crc32(json.dumps(static, sort_keys=True).encode('utf-8')) & 0xffffffff)
+
+
+class HierarchyIndex:
+    ''' Flat view of the hierarchy: one data frame per relationship, holding the fields of the CSV attribute files.
+        Stores and products are integer-coded (StoreIndex, ProductIndex: row in the stores and brands_products tables),
+        so that the tables are joined and sliced without walking the nested dictionaries again. '''
+
+    def __init__(self, tables, version):
+        self.tables = tables
+        self.version = version
+
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+
+    @staticmethod
+    def from_hierarchy(hierarchy):
+        ''' Walk the hierarchy once '''
+        stores = hierarchy['Stores']
+        tables = {}
+        tables['stores'] = data_frame(((store,) for store in stores),
+                                      ['StoreID', 'StoreName', 'AvgHouseholdIncome', 'AvgTraffic', 'LossRate'])
+        tables['brands'] = data_frame(((brand,) for brand in hierarchy['Brands']), ['BrandID', 'BrandName', 'Desirability'])
+        tables['suppliers'] = data_frame(((supplier,) for supplier in hierarchy['Suppliers']),
+                                         ['SupplierID', 'SupplierName', 'ShippingCost', 'MinShippingVolume', 'MaxShippingVolume',
+                                          'FixedOrderSize', 'PurchaseCostBudget'])
+        tables['brands_products'] = data_frame(((brand, product) for brand in hierarchy['Brands'] for product in brand['Products']),
+                                               ['BrandID', 'ProductID', 'ProductName', 'MSRP', 'ProductVolume', 'ShelfLife'])
+        tables['store_departments'] = data_frame(((store, department) for store in stores for department in store['Departments']),
+                                                 ['StoreID', 'DepartmentID', 'DepartmentName', 'PriceElasticity'])
+        tables['store_storage'] = data_frame(((store, storage) for store in stores for storage in store['Storage']),
+                                             ['StoreID', 'StorageID', 'StorageName', 'StorageVolume', 'StorageCostBudget'])
+        tables['store_product_storage'] = data_frame(((store, storage, product) for store in stores
+                                                      for storage in store['ProductStorage'] for product in storage['Products']),
+                                                     ['StoreID', 'StorageID', 'ProductID', 'StorageCost', 'MissedSaleCost',
+                                                      'MinInventorySize', 'MaxInventorySize'])
+        tables['store_product_supplier'] = data_frame(((store, supplier, product) for store in stores
+                                                       for supplier in store['ProductSupplier'] for product in supplier['Products']),
+                                                      ['StoreID', 'SupplierID', 'ProductID', 'LeadTime', 'LeadTimeConfidenceInterval',
+                                                       'MinOrderQuantity', 'MaxOrderQuantity', 'QuantityMultiplier', 'Cost',
+                                                       'BackorderCost', 'ShippingCost', 'PurchaseCostBudget', 'ShipmentFreq',
+                                                       'ServiceLevel'])
+        tables['store_department_brand_products'] = data_frame(((store, department, brand, product) for store in stores
+                                                                for department in store['Departments']
+                                                                for brand in department['Brands'] for product in brand['Products']),
+                                                               ['StoreID', 'DepartmentID', 'BrandID', 'ProductID', 'MSRP', 'DisposalCost'])
+
+        store_ids = pd.Index(tables['stores']['StoreID'])
+        product_ids = pd.Index(tables['brands_products']['ProductID'])
+        for table in tables.values():
+            if 'StoreID' in table.columns:
+                table['StoreIndex'] = store_ids.get_indexer(table['StoreID'])
+            if 'ProductID' in table.columns:
+                table['ProductIndex'] = product_ids.get_indexer(table['ProductID'])
+        return HierarchyIndex(tables, hierarchy_version(hierarchy))
+
+
+    @staticmethod
+    def loads(content):
+        ''' Read an index written by dumps '''
+        arrays = np.load(BytesIO(content), allow_pickle=False)
+        tables = {}
+        for name in arrays['tables'].tolist():
+            columns = arrays[name].tolist()
+            tables[name] = pd.DataFrame({column: arrays['{}.{}'.format(name, column)] for column in columns}, columns=columns)
+            for column in columns:
+                if tables[name][column].dtype.kind == 'U':
+                    tables[name][column] = tables[name][column].astype(object)
+        return HierarchyIndex(tables, str(arrays['version']))
+
+
+    def dumps(self):
+        ''' Serialize the index as a NumPy archive: one array per column, strings as fixed-width unicode '''
+        arrays = {'version': np.array(self.version), 'tables': np.array(sorted(self.tables))}
+        for name, table in self.tables.items():
+            arrays[name] = np.array(list(table.columns))
+            for column in table.columns:
+                values = np.asarray(table[column])
+                arrays['{}.{}'.format(name, column)] = values if values.dtype.kind in 'biuf' else values.astype(str)
+        buffer = BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+
+    def for_store(self, store_id):
+        ''' Copy of the index restricted to one store '''
+        stores = self.tables['stores']
+        code = int(stores.loc[stores['StoreID'] == str(store_id), 'StoreIndex'].iloc[0])
+        tables = {name: table.loc[table['StoreIndex'] == code].reset_index(drop=True) if 'StoreIndex' in table.columns else table
+                  for name, table in self.tables.items()}
+        return HierarchyIndex(tables, self.version)
+
+
+def group_bounds(n_items, n_groups):
+    ''' Split n_items into n_groups contiguous groups: group g holds items bounds[g] to bounds[g + 1] - 1 '''
+    return [int(g * n_items / n_groups) for g in range(n_groups + 1)]
+
+
 class AttributeDescription:
 
     # definitions of brands and products
-    def __define_brands_products(self):
+    def __define_brands_products(self, rng):
         
+        n_products = n_brands * products_per_brand
+        desirability = rng.uniform(min_brand_desirability, max_brand_desirability, n_brands).tolist()
+        volume = rng.uniform(min_product_volume, max_product_volume, n_products).tolist()
+        shelf_life = rng.randint(min_shelf_life, max_shelf_life + 1, n_products).tolist()
+        # first half of the brands have perishable products, some brands in the second half also have perishable products
+        perishable = ((np.arange(1, n_brands + 1) <= n_brands / 2) | (rng.choice([-1, 1], n_brands) == 1)).tolist()
+
         # definition of brands and products
         self.hierarchy['Brands'] = []
-        for BrandID in range(1, n_brands + 1):
+        for brand in range(n_brands):
             brand_dict = {}
-            brand_dict['BrandID'] = str(BrandID)
+            brand_dict['BrandID'] = str(brand + 1)
             brand_dict['BrandName'] = 'Brand ' + brand_dict['BrandID']
-            brand_dict['Desirability'] = uniform(min_brand_desirability, max_brand_desirability)
+            brand_dict['Desirability'] = desirability[brand]
 
             # definition of products of the given brand in the given store department
             brand_dict['Products'] = []
-
-            # For the time being, only one product per brand. This will change in the future 
-            product_dict = {}
-            product_dict['ProductID'] =  brand_dict['BrandID'] + '_1'
-            product_dict['ProductName'] =  brand_dict['BrandName'] + ' Product ' + product_dict['ProductID']
-            product_dict['ProductVolume'] = uniform(min_product_volume, max_product_volume)
-            product_dict['MSRP'] = 0 # will be updated later on, based on the purchase cost
-            if BrandID <= n_brands/2 or choice([-1,1]) == 1: # first half of the brands have perishable products
-                                                             # some brands in the second half also have perishable products
-                product_dict['ShelfLife'] = str(random_integers(min_shelf_life, max_shelf_life)) + ' days'
-            else:
-                product_dict['ShelfLife'] = '10000 days'
-
-            brand_dict['Products'].append(product_dict)
+            for product in range(brand * products_per_brand, (brand + 1) * products_per_brand):
+                product_dict = {}
+                product_dict['ProductID'] = '{}_{}'.format(brand_dict['BrandID'], product - brand * products_per_brand + 1)
+                product_dict['ProductName'] = brand_dict['BrandName'] + ' Product ' + product_dict['ProductID']
+                product_dict['ProductVolume'] = volume[product]
+                product_dict['MSRP'] = 0 # will be updated later on, based on the purchase cost
+                product_dict['ShelfLife'] = '{} days'.format(shelf_life[product]) if perishable[brand] else '10000 days'
+                brand_dict['Products'].append(product_dict)
 
             self.hierarchy['Brands'].append(brand_dict)
 
 
     # definitions of suppliers
-    def __define_suppliers(self):
+    def __define_suppliers(self, rng):
+
+        shipping_cost = rng.uniform(min_shipping_cost, max_shipping_cost, n_suppliers).tolist()
+        min_shipping_volume = rng.uniform(min_min_shipping_volume, max_min_shipping_volume, n_suppliers)
+        max_shipping_volume = min_shipping_volume + rng.uniform(min_shipping_volume_interval, max_shipping_volume_interval, n_suppliers)
+        fixed_order_size = rng.randint(min_fixed_order_size, max_fixed_order_size + 1, n_suppliers).tolist()
+        purchase_cost_budget = rng.uniform(min_purchase_cost_budget, max_purchase_cost_budget, n_suppliers).tolist()
 
         self.hierarchy['Suppliers'] = []
-        for SupplierID in range(1, n_suppliers + 1):
+        for supplier, (min_volume, max_volume) in enumerate(zip(min_shipping_volume.tolist(), max_shipping_volume.tolist())):
             supplier_dict = {}
-            supplier_dict['SupplierID'] = str(SupplierID)
+            supplier_dict['SupplierID'] = str(supplier + 1)
             supplier_dict['SupplierName'] = 'Supplier ' + supplier_dict['SupplierID']
-            supplier_dict['ShippingCost'] = uniform(min_shipping_cost, max_shipping_cost)
-            supplier_dict['MinShippingVolume'] = uniform(min_min_shipping_volume, max_min_shipping_volume)
-            supplier_dict['MaxShippingVolume'] = supplier_dict['MinShippingVolume'] + uniform(min_shipping_volume_interval, max_shipping_volume_interval)
-            supplier_dict['FixedOrderSize'] = int(random_integers(min_fixed_order_size, max_fixed_order_size))
-            supplier_dict['PurchaseCostBudget'] = uniform(min_purchase_cost_budget, max_purchase_cost_budget)
+            supplier_dict['ShippingCost'] = shipping_cost[supplier]
+            supplier_dict['MinShippingVolume'] = min_volume
+            supplier_dict['MaxShippingVolume'] = max_volume
+            supplier_dict['FixedOrderSize'] = fixed_order_size[supplier]
+            supplier_dict['PurchaseCostBudget'] = purchase_cost_budget[supplier]
 
             self.hierarchy['Suppliers'].append(supplier_dict)
 
 
     # definitions of storage
-    def __store_storage(self):
-        storage = []
-        for StorageID in range(1, n_storage_spaces + 1):
-            storage_dict = {}
-            storage_dict['StorageID'] = str(StorageID)
-            storage_dict['StorageName'] = 'Storage ' + storage_dict['StorageID']
-            storage_dict['StorageVolume'] = uniform(min_storage_volume, max_storage_volume)
-            storage_dict['StorageCostBudget'] = uniform(min_storage_budget, max_storage_budget)
-            storage.append(storage_dict)
+    def __store_storage(self, rng):
+        volume = rng.uniform(min_storage_volume, max_storage_volume, n_storage_spaces).tolist()
+        budget = rng.uniform(min_storage_budget, max_storage_budget, n_storage_spaces).tolist()
+        return [{'StorageID': str(storage + 1), 'StorageName': 'Storage {}'.format(storage + 1),
+                 'StorageVolume': volume[storage], 'StorageCostBudget': budget[storage]} for storage in range(n_storage_spaces)]
 
-        return storage
 
+    # definitions of departments, with the store's MSRP and disposal cost of every product
+    def __store_departments(self, cost, rng):
 
-    # definitions of departments
-    def __store_departments(self):
+        products = [product for brand in self.hierarchy['Brands'] for product in brand['Products']]
+        msrp = (rng.uniform(min_msrp_multiplier, max_msrp_multiplier, len(products)) * cost).tolist()
+        disposal_cost = (rng.uniform(min_disposal_multiplier, max_disposal_multiplier, len(products)) * cost).tolist()
+        disposal_cost = [0 if product['ShelfLife'] == '10000 days' else disposal_cost[i] for i, product in enumerate(products)]
+        elasticity = rng.uniform(min_price_elasticity, max_price_elasticity, n_departments).tolist()
+
+        # position of the first product of every brand in the product arrays
+        first_product = np.cumsum([0] + [len(brand['Products']) for brand in self.hierarchy['Brands']]).tolist()
 
         departments = []
-        for DepartmentID in range(1, n_departments + 1):
+        brand_bounds = group_bounds(n_brands, n_departments)
+        for department in range(n_departments):
             department_dict = {}
-            department_dict['DepartmentID'] = str(DepartmentID)
+            department_dict['DepartmentID'] = str(department + 1)
             department_dict['DepartmentName'] = 'Department ' + department_dict['DepartmentID']
-            department_dict['PriceElasticity'] = uniform(min_price_elasticity, max_price_elasticity)
- 
+            department_dict['PriceElasticity'] = elasticity[department]
+
             # add products to departments. Each product can only be in one department
-            start_brand = int((DepartmentID - 1) * n_brands / n_departments)
-            end_brand = int(DepartmentID * n_brands / n_departments)
-            department_dict['Brands'] = deepcopy(self.hierarchy['Brands'][start_brand : end_brand]) # we use deepcopy to create a copy of a product inside department
-                                                                                                    # this will allow us to have different MSRP for the same product in different stores
+            # products are copied, which allows us to have different MSRP for the same product in different stores
+            department_dict['Brands'] = [dict(brand, Products=[dict(product, MSRP=msrp[first_product[b] + i],
+                                                                    DisposalCost=disposal_cost[first_product[b] + i])
+                                                               for i, product in enumerate(brand['Products'])])
+                                         for b, brand in enumerate(self.hierarchy['Brands'])
+                                         if brand_bounds[department] <= b < brand_bounds[department + 1]]
 
             departments.append(department_dict)
 
@@ -259,70 +825,73 @@ class AttributeDescription:
 
 
     # definitions of product storage
-    def __store_product_storage(self):
-
-        product_storage = []
-        for StorageID in range(1, n_storage_spaces + 1):
-            start_brand = int((StorageID - 1) * n_brands / n_storage_spaces)
-            end_brand = int(StorageID * n_brands / n_storage_spaces)
-            storage_dict = {}
-            storage_dict['StorageID'] = StorageID
-            storage_dict['Products'] = []
-  
-            # place products in a given storage space
-            for BrandID in range(start_brand, end_brand):
-                for product in self.hierarchy['Brands'][BrandID]['Products']:
-                    product_storage_dict = {}
-                    product_storage_dict['ProductID'] = product['ProductID']
-                    product_storage_dict['StorageCost'] = uniform(min_storage_cost, max_storage_cost)
-                    product_storage_dict['MissedSaleCost'] = uniform(min_missed_sale_cost, max_missed_sale_cost)
-                    product_storage_dict['MinInventorySize'] = int(random_integers(min_min_inventory_size, max_min_inventory_size))
-                    product_storage_dict['MaxInventorySize'] = product_storage_dict['MinInventorySize'] + int(random_integers(min_inventory_size_interval, max_inventory_size_interval))
-
-                    storage_dict['Products'].append(product_storage_dict)
-
-            product_storage.append(storage_dict)
-
-        return product_storage
+    def __store_product_storage(self, rng):
+
+        product_ids = [product['ProductID'] for brand in self.hierarchy['Brands'] for product in brand['Products']]
+        n_products = len(product_ids)
+        storage_cost = rng.uniform(min_storage_cost, max_storage_cost, n_products).tolist()
+        missed_sale_cost = rng.uniform(min_missed_sale_cost, max_missed_sale_cost, n_products).tolist()
+        min_inventory_size = rng.randint(min_min_inventory_size, max_min_inventory_size + 1, n_products)
+        max_inventory_size = (min_inventory_size + rng.randint(min_inventory_size_interval, max_inventory_size_interval + 1,
+                                                                   n_products)).tolist()
+        min_inventory_size = min_inventory_size.tolist()
+
+        # place products in storage spaces, by brand
+        bounds = self.__product_bounds(n_storage_spaces)
+        return [{'StorageID': storage + 1,
+                 'Products': [{'ProductID': product_ids[i], 'StorageCost': storage_cost[i], 'MissedSaleCost': missed_sale_cost[i],
+                               'MinInventorySize': min_inventory_size[i], 'MaxInventorySize': max_inventory_size[i]}
+                              for i in range(bounds[storage], bounds[storage + 1])]}
+                for storage in range(n_storage_spaces)]
 
 
     # definitions of suppliers of products
-    def __store_product_supplier(self):
-
-        product_supplier = []
-        for SupplierID in range(1, n_suppliers + 1): 
-            start_brand = int((SupplierID - 1) * n_brands / n_suppliers)
-            end_brand = int(SupplierID * n_brands / n_suppliers)
-            supplier_dict = {}
-            supplier_dict['SupplierID'] = SupplierID
-            supplier_dict['Products'] = []
-
-            # place products in a given storage space
-            for BrandID in range(start_brand, end_brand):
-                for product in self.hierarchy['Brands'][BrandID]['Products']:
-                    product_supplier_dict = {}
-                    product_supplier_dict['ProductID'] = product['ProductID']
-                    product_supplier_dict['LeadTime'] = int(random_integers(min_lead_time, max_lead_time))
-                    product_supplier_dict['LeadTimeConfidenceInterval'] = int(random_integers(min_lead_time_conf_interval, max_lead_time_conf_interval))
-                    product_supplier_dict['MinOrderQuantity'] = int(random_integers(min_min_order_quantity, max_min_order_quantity))
-                    product_supplier_dict['MaxOrderQuantity'] = product_supplier_dict['MinOrderQuantity'] + int(random_integers(min_order_quantity_interval, max_order_quantity_interval))
-                    product_supplier_dict['QuantityMultiplier'] = int(random_integers(min_quantity_multiplier, max_quantity_multiplier))
-                    product_supplier_dict['Cost'] = uniform(min_purchase_cost, max_purchase_cost)
-                    product_supplier_dict['BackorderCost'] = product_supplier_dict['Cost'] * uniform(min_backorder_multiplier, max_backorder_multiplier)
-                    product_supplier_dict['PurchaseCostBudget'] = product_supplier_dict['Cost'] * uniform(min_purchase_cost_budget_multiplier, max_purchase_cost_budget_multiplier)
-                    product_supplier_dict['ShippingCost'] = product_supplier_dict['Cost'] * uniform(min_shipping_multiplier, max_shipping_multiplier)
-                    product_supplier_dict['ShipmentFreq'] = str(random_integers(min_ordering_frequency, max_ordering_frequency)) + " days"
-                    product_supplier_dict['ServiceLevel'] = uniform(min_service_level, max_service_level)
-
-                    supplier_dict['Products'].append(product_supplier_dict)
-
-            product_supplier.append(supplier_dict)
-
-        return product_supplier
+    def __store_product_supplier(self, rng):
+
+        product_ids = [product['ProductID'] for brand in self.hierarchy['Brands'] for product in brand['Products']]
+        n_products = len(product_ids)
+        lead_time = rng.randint(min_lead_time, max_lead_time + 1, n_products).tolist()
+        lead_time_interval = rng.randint(min_lead_time_conf_interval, max_lead_time_conf_interval + 1, n_products).tolist()
+        min_order_quantity = rng.randint(min_min_order_quantity, max_min_order_quantity + 1, n_products)
+        max_order_quantity = (min_order_quantity + rng.randint(min_order_quantity_interval, max_order_quantity_interval + 1,
+                                                                   n_products)).tolist()
+        min_order_quantity = min_order_quantity.tolist()
+        quantity_multiplier = rng.randint(min_quantity_multiplier, max_quantity_multiplier + 1, n_products).tolist()
+        cost = rng.uniform(min_purchase_cost, max_purchase_cost, n_products)
+        backorder_cost = (cost * rng.uniform(min_backorder_multiplier, max_backorder_multiplier, n_products)).tolist()
+        purchase_cost_budget = (cost * rng.uniform(min_purchase_cost_budget_multiplier, max_purchase_cost_budget_multiplier,
+                                               n_products)).tolist()
+        shipping_cost = (cost * rng.uniform(min_shipping_multiplier, max_shipping_multiplier, n_products)).tolist()
+        shipment_freq = rng.randint(min_ordering_frequency, max_ordering_frequency + 1, n_products).tolist()
+        service_level = rng.uniform(min_service_level, max_service_level, n_products).tolist()
+
+        # every supplier supplies the products of a range of brands
+        bounds = self.__product_bounds(n_suppliers)
+        product_cost = cost.tolist()
+        product_supplier = [{'SupplierID': supplier + 1,
+                             'Products': [{'ProductID': product_ids[i], 'LeadTime': lead_time[i],
+                                           'LeadTimeConfidenceInterval': lead_time_interval[i],
+                                           'MinOrderQuantity': min_order_quantity[i], 'MaxOrderQuantity': max_order_quantity[i],
+                                           'QuantityMultiplier': quantity_multiplier[i], 'Cost': product_cost[i],
+                                           'BackorderCost': backorder_cost[i], 'PurchaseCostBudget': purchase_cost_budget[i],
+                                           'ShippingCost': shipping_cost[i], 'ShipmentFreq': '{} days'.format(shipment_freq[i]),
+                                           'ServiceLevel': service_level[i]}
+                                          for i in range(bounds[supplier], bounds[supplier + 1])]}
+                            for supplier in range(n_suppliers)]
+
+        return product_supplier, cost
+
+
+    def __product_bounds(self, n_groups):
+        ''' Split the products into n_groups contiguous groups of brands (see group_bounds) '''
+        first_product = np.cumsum([0] + [len(brand['Products']) for brand in self.hierarchy['Brands']]).tolist()
+        return [first_product[brand] for brand in group_bounds(len(self.hierarchy['Brands']), n_groups)]
 
 
     # Create static data: definitions of stores, storage spaces, products and suppliers 
-    def __init__(self):
+    def __init__(self, today_date=today_date, configurations=None):
+        ''' configurations is the InventoryPolicyConfig sheet; it is downloaded from the store when not given '''
+        self.today_date = today_date
         self.hierarchy = {}
         self.hierarchy['InitialWeeksToSimulate'] = n_weeks_to_simulate
         self.hierarchy['WeeksToForecast'] = n_weeks_to_forecast
@@ -337,85 +906,102 @@ class AttributeDescription:
             self.load_hierarchy()
             #self.hierarchy['InitialDate'] = (datetime.strptime(self.hierarchy['LastDate'], "%Y-%m-%d %H:%M:%S") + dt.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
             self.hierarchy['InitialDate'] = self.hierarchy['LastDate']
-            self.hierarchy['LastDate'] = today_date
+            self.hierarchy['LastDate'] = self.today_date
             self.store_hierarchy()  # writes the JSON file to blob storage for later access
+            self.load_index()
             self.write_csv_attributes()  # writes the same information in the original CSV form
             print('Loaded existing hierarchy.')
 
-        multithread.ADLDownloader(self.adl, lpath='.\Configurations.xlsx', 
-                                  rpath=configuration_folder + '/Configurations.xlsx', overwrite=True)
-        self.configurations = pd.read_excel('.\Configurations.xlsx', sheetname='InventoryPolicyConfig')
+        if configurations is None:
+            self.adl.download(configuration_folder + '/Configurations.xlsx', '.\Configurations.xlsx')
+            configurations = pd.read_excel('.\Configurations.xlsx', sheetname='InventoryPolicyConfig')
+        self.configurations = configurations
 
         if load_hierarchy_from_adl:
             return
 
         # this is the first run of simulator, initialize static data
-        self.hierarchy['InitialDate'] = (datetime.strptime(today_date, "%Y-%m-%d %H:%M:%S") - dt.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
-        self.hierarchy['LastDate'] = today_date
-
-        self.__define_brands_products()
-        self.__define_suppliers()
+        self.hierarchy['InitialDate'] = (datetime.strptime(self.today_date, "%Y-%m-%d %H:%M:%S") - dt.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        self.hierarchy['LastDate'] = self.today_date
+
+        # every store is generated from its own random stream, so that its attributes do not depend on the number of stores
+        self.hierarchy['RandomSeed'] = random_seed
+        rng = random_stream(random_seed, 'hierarchy')
+        self.__define_brands_products(rng)
+        self.__define_suppliers(rng)
  
         # definition of stores
         self.hierarchy['Stores'] = []
-        for StoreID in range(1, n_stores + 1):
+        households = rng.multivariate_normal(mean=[5E4, 100], cov=[[1E8, -1E4], [-1E4, 100]], size=n_stores).tolist()
+        for StoreID, (AvgHouseholdIncome, AvgTraffic) in enumerate(households, 1):
 
             # definition of store
-            AvgHouseholdIncome, AvgTraffic = np.random.multivariate_normal(mean=[5E4, 100],
-                                                                           cov=[[1E8, -1E4],
-                                                                                [-1E4, 100]]).tolist()
             store_dict = {}
             store_dict['StoreID'] = str(StoreID)
             store_dict['StoreName'] = 'Store ' + store_dict['StoreID']
             store_dict['AvgHouseholdIncome'] = AvgHouseholdIncome
             store_dict['AvgTraffic'] = AvgTraffic
             store_dict['LossRate'] = loss_rate
+            store_rng = random_stream(random_seed, 'hierarchy', store_dict['StoreID'])
 
             # definition of storage in the store
-            store_dict['Storage'] = self.__store_storage()
+            store_dict['Storage'] = self.__store_storage(store_rng)
 
-            # definition of departments in the store
-            store_dict['Departments'] = self.__store_departments()
-           
-            # definition of placements of products in storage space
-            store_dict['ProductStorage'] = self.__store_product_storage()
-           
             # definitions of suppliers of products
-            store_dict['ProductSupplier'] = self.__store_product_supplier()
+            store_dict['ProductSupplier'], cost = self.__store_product_supplier(store_rng)
 
-            for department in store_dict['Departments']:
-                for brand in department['Brands']:
-                    brands_per_supplier = n_brands / n_suppliers     # we assume that each supplier supplies the same number of brands
-                    supplier_index = int((int(brand['BrandID']) - 1) / brands_per_supplier)
-                    brand_index = int((int(brand['BrandID']) - 1) % brands_per_supplier)
-                    start_index = brand_index * products_per_brand
-                    end_index = (brand_index + 1) * products_per_brand
-                    if len(brand['Products']) == 1:
-                        products = [store_dict['ProductSupplier'][supplier_index]['Products'][start_index]]
-                    else:
-                        products = store_dict['ProductSupplier'][supplier_index]['Products'][start_index:end_index]
-                    for product, product_supplier in zip(brand['Products'], products): 
-                        product['MSRP'] = uniform(min_msrp_multiplier, max_msrp_multiplier) * product_supplier['Cost'] 
-                        if product['ShelfLife'] == '10000 days':              
-                            product['DisposalCost'] = 0
-                        else:
-                            product['DisposalCost'] = uniform(min_disposal_multiplier, max_disposal_multiplier) * product_supplier['Cost']
+            # definition of departments in the store (MSRP depends on the purchase cost)
+            store_dict['Departments'] = self.__store_departments(cost, store_rng)
+           
+            # definition of placements of products in storage space
+            store_dict['ProductStorage'] = self.__store_product_storage(store_rng)
 
             self.hierarchy['Stores'].append(store_dict)
 
+        self.hierarchy['HierarchyVersion'] = hierarchy_version(self.hierarchy)
         self.store_hierarchy()  # writes the JSON file to blob storage for later access
+        self.load_index()
         self.write_csv_attributes()  # writes the same information in the original CSV form
         print('Generated new hierarchy (did not load from file).')
 
 
+    def __getstate__(self):
+        ''' The ADL client is not sent to worker processes; each worker connects on its own '''
+        state = self.__dict__.copy()
+        state['adl'] = None
+        return state
+
+
+    def for_store(self, store_id):
+        ''' Copy of the description restricted to the data needed to simulate one store '''
+        description = AttributeDescription.__new__(AttributeDescription)
+        description.__dict__.update(self.__dict__)
+        description.hierarchy = dict(self.hierarchy)
+        description.hierarchy['Stores'] = [store for store in self.hierarchy['Stores'] if store['StoreID'] == str(store_id)]
+        description.hierarchy_index = self.hierarchy_index.for_store(store_id)
+        description.demand_df = self.demand_df.loc[self.demand_df.StoreID == store_id]
+        return description
+
+
+    def copy(self):
+        ''' Shallow copy, which keeps the data of the current date when the description is advanced '''
+        description = AttributeDescription.__new__(AttributeDescription)
+        description.__dict__.update(self.__dict__)
+        description.hierarchy = dict(self.hierarchy)
+        return description
+
+
+    def advance(self, today_date):
+        ''' Move on to the next date of a backfill, without reloading the hierarchy and configurations '''
+        self.today_date = today_date
+        self.hierarchy['InitialDate'] = self.hierarchy['LastDate']
+        self.hierarchy['LastDate'] = today_date
+        self.store_hierarchy()
+
+
     def connect_to_adl(self):
         ''' Connects to ADL, creates main folders, and checks whether hierarchy file already exists '''
-        try:
-            token = lib.auth(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
-            # token = os.environ['AuthorizationToken']
-            self.adl = core.AzureDLFileSystem(token=token, store_name=adl_name)
-        except Exception as e:
-            raise Exception('Error while attempting to connect to Azure Data Lake Store:\n{}'.format(e))
+        self.adl = connect_adl()
 
         directories = ['RawDataFolder', 'PublicParametersFolder', 'PrivateParametersFolder']
         for directory in directories:
@@ -433,6 +1019,23 @@ class AttributeDescription:
         with self.adl.open('{}/{}'.format(self.hierarchy['PrivateParametersFolder'], hierarchy_file),
                            blocksize=2 ** 20) as f:
             self.hierarchy = json.loads(f.read().decode('utf-8'))
+        if 'HierarchyVersion' not in self.hierarchy:  # written before the hierarchy index was introduced
+            self.hierarchy['HierarchyVersion'] = hierarchy_version(self.hierarchy)
+        if 'RandomSeed' not in self.hierarchy:  # written before the root seed was recorded
+            self.hierarchy['RandomSeed'] = random_seed
+
+
+    def load_index(self):
+        ''' Load the flat hierarchy index cached next to the hierarchy, or build it if the hierarchy changed '''
+        file_name = '{}/{}'.format(self.hierarchy['PrivateParametersFolder'], hierarchy_index_file)
+        if self.adl.exists(file_name):
+            with self.adl.open(file_name, blocksize=2 ** 20) as f:
+                self.hierarchy_index = HierarchyIndex.loads(f.read())
+            if self.hierarchy_index.version == self.hierarchy['HierarchyVersion']:
+                return
+        self.hierarchy_index = HierarchyIndex.from_hierarchy(self.hierarchy)
+        with self.adl.open(file_name, 'wb') as f:
+            f.write(self.hierarchy_index.dumps())
 
 
     def store_hierarchy(self):
@@ -442,6 +1045,7 @@ class AttributeDescription:
             f.write(hierarchy_string.encode('utf-8'))
 
         reduced_hierarchy = deepcopy(self.hierarchy)
+        del reduced_hierarchy['RandomSeed']  # would allow to regenerate the demand
         for store in reduced_hierarchy['Stores']:
             del store['LossRate']
             for department in store['Departments']:
@@ -461,121 +1065,152 @@ class AttributeDescription:
     def write_csv_attributes(self):
         
         file_name = self.hierarchy['PublicParametersFolder'] + '/'
-        write_data(((row,) for row in self.hierarchy['Stores']), ['StoreID', 'StoreName', 'AvgHouseholdIncome', 'AvgTraffic'], 
-                   self.adl, file_name + 'stores.csv')
-        write_data(((brand,) for brand in self.hierarchy['Brands']), ['BrandID', 'BrandName'], self.adl, file_name + 'brands.csv')
-        write_data(((supplier,) for supplier in self.hierarchy['Suppliers']), 
-                   ['SupplierID', 'SupplierName', 'ShippingCost', 'MinShippingVolume', 'MaxShippingVolume', 'FixedOrderSize', 'PurchaseCostBudget'], 
-                   self.adl, file_name + 'suppliers.csv')
-        write_data(((brand, product) for brand in self.hierarchy['Brands'] for product in brand['Products']),
-                   ['BrandID', 'ProductID', 'ProductName', 'MSRP', 'ProductVolume', 'ShelfLife'], self.adl, file_name + 'brands_products.csv') 
-        write_data(((store, department) for store in self.hierarchy['Stores'] for department in store['Departments']),
-                   ['StoreID','DepartmentID','DepartmentName'], self.adl, file_name + 'store_departments.csv') 
-        write_data(((store, storage) for store in self.hierarchy['Stores'] for storage in store['Storage']),
-                   ['StoreID', 'StorageID', 'StorageName', 'StorageVolume', 'StorageCostBudget'], self.adl, file_name + 'store_storage.csv') 
-        write_data(((store, storage, product) for store in self.hierarchy['Stores'] for storage in store['ProductStorage'] for product in storage['Products']),
-                   ['StoreID', 'StorageID', 'ProductID', 'StorageCost', 'MissedSaleCost', 'MinInventorySize', 'MaxInventorySize'], 
-                   self.adl, file_name + 'store_product_storage.csv') 
-        write_data(((store, supplier, product) for store in self.hierarchy['Stores'] for supplier in store['ProductSupplier'] for product in supplier['Products']),
-                   ['StoreID', 'SupplierID', 'ProductID', 'LeadTime', 'LeadTimeConfidenceInterval', 'MinOrderQuantity', 'MaxOrderQuantity',
-                    'QuantityMultiplier', 'Cost', 'BackorderCost', 'ShippingCost', 'PurchaseCostBudget', 'ShipmentFreq', 'ServiceLevel'], 
-                   self.adl, file_name + 'store_product_supplier.csv')
-        write_data(((store, department, brand, product) for store in self.hierarchy['Stores'] for department in store['Departments']
-                                                        for brand in department['Brands'] for product in brand['Products']),
-                   ['StoreID', 'DepartmentID', 'BrandID', 'ProductID', 'MSRP', 'DisposalCost'], 
-                   self.adl, file_name + 'store_department_brand_products.csv')
+        index = self.hierarchy_index
+        write_frame(index['stores'][['StoreID', 'StoreName', 'AvgHouseholdIncome', 'AvgTraffic']], self.adl, file_name + 'stores.csv')
+        write_frame(index['brands'][['BrandID', 'BrandName']], self.adl, file_name + 'brands.csv')
+        write_frame(index['suppliers'][['SupplierID', 'SupplierName', 'ShippingCost', 'MinShippingVolume', 'MaxShippingVolume',
+                                        'FixedOrderSize', 'PurchaseCostBudget']],
+                    self.adl, file_name + 'suppliers.csv')
+        write_frame(index['brands_products'][['BrandID', 'ProductID', 'ProductName', 'MSRP', 'ProductVolume', 'ShelfLife']],
+                    self.adl, file_name + 'brands_products.csv')
+        write_frame(index['store_departments'][['StoreID', 'DepartmentID', 'DepartmentName']], self.adl, file_name + 'store_departments.csv')
+        write_frame(index['store_storage'][['StoreID', 'StorageID', 'StorageName', 'StorageVolume', 'StorageCostBudget']],
+                    self.adl, file_name + 'store_storage.csv')
+        write_frame(index['store_product_storage'][['StoreID', 'StorageID', 'ProductID', 'StorageCost', 'MissedSaleCost',
+                                                    'MinInventorySize', 'MaxInventorySize']],
+                    self.adl, file_name + 'store_product_storage.csv')
+        write_frame(index['store_product_supplier'][['StoreID', 'SupplierID', 'ProductID', 'LeadTime', 'LeadTimeConfidenceInterval',
+                                                     'MinOrderQuantity', 'MaxOrderQuantity', 'QuantityMultiplier', 'Cost',
+                                                     'BackorderCost', 'ShippingCost', 'PurchaseCostBudget', 'ShipmentFreq',
+                                                     'ServiceLevel']],
+                    self.adl, file_name + 'store_product_supplier.csv')
+        write_frame(index['store_department_brand_products'][['StoreID', 'DepartmentID', 'BrandID', 'ProductID', 'MSRP', 'DisposalCost']],
+                    self.adl, file_name + 'store_department_brand_products.csv')
        
 
     # Load all features for all products as a data frame 
     # We assume that a product is supplied by a single supplier
     def get_product_features(self):
         
-        features = []
-        for store in self.hierarchy['Stores']:
-            for department in store['Departments']:
-                for brand in department['Brands']:
-                    for product in brand['Products']:
-                        features.append([store['StoreID'], store['AvgHouseholdIncome'], store['AvgTraffic'], department['DepartmentID'], 
-                                         department['PriceElasticity'], brand['BrandID'], brand['Desirability'], product['ProductID'], 
-                                         product['MSRP'], store['LossRate'], product['ShelfLife']])
-        feature_df = pd.DataFrame(features, columns=['StoreID', 'AvgHouseholdIncome', 'AvgTraffic',
-                                                     'DepartmentID', 'PriceElasticity', 'BrandID', 'Desirability',
-                                                     'ProductID', 'MSRP', 'LossRate', 'ShelfLife'])
-
-        features_suppliers = []
-        for store in self.hierarchy['Stores']:
-            for supplier in store['ProductSupplier']:
-                for product in supplier['Products']:
-                    features_suppliers.append([store['StoreID'], product['ProductID'], supplier['SupplierID'], product['Cost'], product['ShipmentFreq'], 
-                                               product['MinOrderQuantity'], product['MaxOrderQuantity'], product['QuantityMultiplier'],
-                                               product['LeadTime'], product['LeadTimeConfidenceInterval']])
-        feature_supplier_df = pd.DataFrame(features_suppliers, columns = ['StoreID', 'ProductID', 'SupplierID', 'Cost', 'ShipmentFreq', 'MinOrderQuantity',
-                                                                          'MaxOrderQuantity', 'QuantityMultiplier', 'LeadTime', 'LeadTimeConfidenceInterval'])
-
-        self.feature_df = pd.merge(feature_df, feature_supplier_df, how = 'inner', on = ['StoreID', 'ProductID'])
+        index = self.hierarchy_index
+        feature_df = index['store_department_brand_products'][['StoreIndex', 'ProductIndex', 'StoreID', 'DepartmentID', 'BrandID',
+                                                               'ProductID', 'MSRP']]
+        feature_df = feature_df.merge(index['stores'][['StoreIndex', 'AvgHouseholdIncome', 'AvgTraffic', 'LossRate']],
+                                      how='left', on='StoreIndex')
+        feature_df = feature_df.merge(index['store_departments'][['StoreIndex', 'DepartmentID', 'PriceElasticity']],
+                                      how='left', on=['StoreIndex', 'DepartmentID'])
+        feature_df = feature_df.merge(index['brands'][['BrandID', 'Desirability']], how='left', on='BrandID')
+        feature_df['ShelfLife'] = index['brands_products']['ShelfLife'].values[feature_df['ProductIndex'].values]
+
+        feature_supplier_df = index['store_product_supplier'][['StoreIndex', 'ProductIndex', 'SupplierID', 'Cost', 'ShipmentFreq',
+                                                               'MinOrderQuantity', 'MaxOrderQuantity', 'QuantityMultiplier',
+                                                               'LeadTime', 'LeadTimeConfidenceInterval']]
+        feature_df = pd.merge(feature_df, feature_supplier_df, how = 'inner', on = ['StoreIndex', 'ProductIndex'])
+        self.feature_df = feature_df[['StoreID', 'AvgHouseholdIncome', 'AvgTraffic', 'DepartmentID', 'PriceElasticity', 'BrandID',
+                                      'Desirability', 'ProductID', 'MSRP', 'LossRate', 'ShelfLife', 'SupplierID', 'Cost', 'ShipmentFreq',
+                                      'MinOrderQuantity', 'MaxOrderQuantity', 'QuantityMultiplier', 'LeadTime',
+                                      'LeadTimeConfidenceInterval']]
+        self.department_codes = pd.factorize(self.feature_df['DepartmentID'])[0]
 
         
+    def load_horizon(self, dates):
+        ''' Load prices and demand generated by previous runs for the given dates, if they cover all products '''
+        file_name = '{}/{}'.format(self.hierarchy['PrivateParametersFolder'], horizon_file)
+        if hasattr(self, 'demand_df'):
+            # backfill: the horizon of the previous date is still in memory
+            horizon_df = self.demand_df[['StoreID', 'ProductID', 'DateTime', 'Price', 'Demand']]
+        elif not self.adl.exists(file_name):
+            return None
+        else:
+            with self.adl.open(file_name, blocksize=2 ** 20) as f:
+                horizon_df = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", dtype={'StoreID': str, 'ProductID': str},
+                                         parse_dates=['DateTime'], float_precision='round_trip')
+        keys = set(zip(self.feature_df['StoreID'], self.feature_df['ProductID']))
+        if set(zip(horizon_df['StoreID'], horizon_df['ProductID'])) != keys:
+            print('Products changed since the horizon was stored, regenerating all prices and demand.')
+            return None
+        return horizon_df.loc[horizon_df['DateTime'].isin(dates)]
+
+
+    def store_horizon(self):
+        ''' Store prices and demand of the current horizon for the next run '''
+        file_name = '{}/{}'.format(self.hierarchy['PrivateParametersFolder'], horizon_file)
+        write_frame(self.demand_df[['StoreID', 'ProductID', 'DateTime', 'Price', 'Demand']], self.adl, file_name,
+                    date_format='%Y-%m-%d %H:%M:%S')
+
+
     def get_prices(self):
         ''' Load/generate prices for each product-store-date combination needed '''
         self.get_product_features()
-        
-        # We need to do a full outer join between price change dates and product features.
-        # Create a dummy column called "ones" for this purpose, and remove it afterward.
-
-        # TBD - change this code to compute prices and demand only for one day. Read prices and demand from previous days
 
         dates = [pd.to_datetime(self.hierarchy['InitialDate']) + pd.to_timedelta('{} days'.format(i)) for i in
                     range((pd.to_datetime(self.hierarchy['LastDate']) - pd.to_datetime(self.hierarchy['InitialDate'])).days
                         + 7*self.hierarchy['WeeksToForecast'])]
-        price_change_df = pd.DataFrame(dates, columns=['DateTime'])
+
+        # Prices (and demand) of dates generated by previous runs are reused, only the new dates are generated
+        self.horizon_df = self.load_horizon(dates) if incremental_horizon else None
+        if self.horizon_df is not None:
+            known_dates = set(self.horizon_df['DateTime'])
+            dates = [date for date in dates if date not in known_dates]
+        print('Generating prices for {} dates.'.format(len(dates)))
+
+        # We need to do a full outer join between price change dates and product features.
+        # Create a dummy column called "ones" for this purpose, and remove it afterward.
+        # Every row keeps the position of its product features (FeatureOrder) for computing demand.
+        price_change_df = pd.DataFrame({'DateTime': pd.to_datetime(dates)})
         price_change_df['ones'] = 1
         feature_df = self.feature_df.copy(deep=True)
+        feature_df['FeatureOrder'] = np.arange(feature_df.shape[0])
         feature_df['ones'] = 1
         price_change_df = feature_df.merge(price_change_df, on='ones', how='outer')
         price_change_df.drop('ones', axis=1, inplace=True)
-        price_change_df['Price'] = np.NaN  # all prices must be randomly generated since none were loaded
+        price_change_df['Price'] = np.nan  # all prices must be randomly generated since none were loaded
         print('Did not load any suggested prices.')
 
-        price_change_df.Price = price_change_df.apply(self.choose_new_price, axis=1)
+        new_prices = price_change_df.loc[price_change_df['Price'].isnull()]
+        keys = key_hash(self.hierarchy['RandomSeed'], string_codes(new_prices['StoreID']), string_codes(new_prices['ProductID']),
+                        new_prices['DateTime'].values.astype('datetime64[D]').astype(np.int64))
+        price_change_df.loc[new_prices.index, 'Price'] = sample_prices(new_prices['Cost'].values.astype(float),
+                                                                      new_prices['MSRP'].values.astype(float), keys)
+        price_change_df = price_change_df[['ProductID', 'StoreID', 'DateTime', 'Price', 'FeatureOrder']]
+        price_change_df['Demand'] = np.nan  # computed by get_demand
+
+        if self.horizon_df is not None:
+            # keep the rows ordered by product (in the order of product features), then by date.
+            # Demand of the stored horizon was computed (or forecast) by previous runs and is never recomputed
+            feature_order = feature_df[['StoreID', 'ProductID', 'FeatureOrder']]
+            horizon_df = self.horizon_df[['ProductID', 'StoreID', 'DateTime', 'Price', 'Demand']].merge(feature_order,
+                                                                                                      on=['StoreID', 'ProductID'])
+            price_change_df = pd.concat([horizon_df, price_change_df], ignore_index=True)
+            price_change_df = price_change_df.sort_values(['FeatureOrder', 'DateTime']).reset_index(drop=True)
+
+        self.price_features = price_change_df['FeatureOrder'].values
+        self.known_demand = price_change_df['Demand'].values.astype(float)
         self.price_change_df = price_change_df[['ProductID', 'StoreID', 'DateTime', 'Price']]
         self.store_prices(pd.to_datetime(self.hierarchy['LastDate']))
        
 
-    def choose_new_price(self, row):
-        ''' Pick a random price between a product's cost and MSRP '''
-        if not np.isnan(row.Price):
-            return (row.Price)
-        mu = row.Cost + 0.8 * (row.MSRP - row.Cost)
-        sd = (0.5 * (row.MSRP - row.Cost)) ** 2
-        result = np.random.normal(loc=mu, scale=sd)
-        while (result > row.MSRP) or (result < row.Cost):
-            result = np.random.normal(loc=mu, scale=sd)
-        return (round(result, 2))
-
-
     def store_prices(self, last_timestamp):
         ''' Write one price change JSON file per store/date combination '''
         historic_prices = self.price_change_df[self.price_change_df['DateTime'] < last_timestamp]
+        if 'parquet' in output_formats:
+            for date, prices in historic_prices.groupby('DateTime'):
+                write_columnar(self.adl, self.hierarchy['RawDataFolder'], 'prices', date, [prices])
+        if 'json' not in output_formats:
+            return
+
         for record in historic_prices.groupby(['StoreID', 'DateTime']):
             file_name = '{}/pc_store{}_{}.json'.format(self.hierarchy['RawDataFolder'],
                                                        record[0][0],
                                                        record[0][1].strftime('%Y_%m_%d_%H'))
 
-            ''' Create a dictionary of info to be encoded in JSON format '''
+            ''' Create a dictionary of info to be encoded in JSON format; the price updates are streamed '''
             price_change_dict = {}
             price_change_dict['StoreID'] = int(record[0][0])
             price_change_dict['PriceDate'] = str(record[0][1])
-            entries = []
-            for row in record[1].itertuples():
-                entry_dict = {}
-                entry_dict['ProductID'] = str(row.ProductID)
-                entry_dict['Price'] = float(row.Price)
-                entries.append(entry_dict)
-            price_change_dict['PriceUpdates'] = entries
-
-            with self.adl.open(file_name, 'wb') as f:
-                price_change_string = json.dumps(price_change_dict, sort_keys=True, indent=4, separators=(',', ': '))
-                f.write(price_change_string.encode('utf-8'))
+            entries = ({'ProductID': str(product_id), 'Price': float(price)}
+                       for product_id, price in zip(record[1]['ProductID'], record[1]['Price']))
+            write_json(price_change_dict, self.adl, file_name, 'PriceUpdates', entries)
 
 
     def get_demand(self):
@@ -584,59 +1219,114 @@ class AttributeDescription:
                           'LeadTimeConfidenceInterval', 'ShipmentFreq',
                           'MinOrderQuantity', 'MaxOrderQuantity', 'QuantityMultiplier', 'Demand']
 
-        ''' Calculates demand values (currently based on a modified formula suggested by Yiyu) '''
-        demand_df = self.price_change_df.merge(self.feature_df, on=['ProductID', 'StoreID'], how='left')
-        demand_df['RelativePrice'] = demand_df['Price'] / demand_df.groupby('DepartmentID')['Price'].transform('mean')
-        demand_df['FracDiscountOverMSRP'] = (demand_df.MSRP - demand_df.Price) / demand_df.MSRP
-        demand_df['Demand'] = demand_df.AvgTraffic * demand_df.Desirability / (1 - demand_df.FracDiscountOverMSRP)
-        demand_df.Demand += (demand_df.RelativePrice - 1) * demand_df.Price * demand_df.PriceElasticity
-        demand_df.Demand /= demand_df.RelativePrice ** 2
-        demand_df.Demand = demand_df.Demand.apply(lambda x: max(x, 5))
-        demand_df = demand_df[demand_columns]
-
-        # read previously computed demand
-        yesterday = datetime.strftime(pd.to_datetime(today_date) -  dt.timedelta(days = 1),"%Y-%m-%d_%H_%M_%S")
-        previous_demand_columns = ['StoreID','ProductID','DateTime','Demand','PredictedDemandDistribution','PredictedDemandVariance','PredictedDemandProbability']
-        previous_demand_df = pd.DataFrame(columns = previous_demand_columns)
-        for partition, group in demand_df.groupby(['StoreID', 'ProductID']):
-            file_name = '{}/demand_forecasts/{}/{}/{}.csv'.format(self.hierarchy['RawDataFolder'], partition[0], partition[1], 
-                        yesterday)     
-            if self.adl.exists(file_name):    
-                with self.adl.open(file_name, blocksize=2 ** 20) as f:
-                    previous_demand = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", dtype={'StoreID': str}, parse_dates = ['DateTime'], header = 0,
-                                                  names = previous_demand_columns)
-                    previous_demand_df = pd.concat([previous_demand_df, previous_demand], ignore_index = True)
-
-        # merge previous and new demand. when we have both new and old value of demand, take the ond one
-        merged = pd.merge(demand_df, previous_demand_df, how='left', on=['StoreID', 'ProductID', 'DateTime'], suffixes = ['','_prev'])
-        merged['Demand'] = merged.apply(lambda x: x['Demand'] if np.isnan(x['Demand_prev']) else x['Demand_prev'], axis = 1)
-        
-        self.demand_df = merged[demand_columns]
+        ''' Calculates demand values of the dates not in the stored horizon; features are gathered by position '''
+        rows = self.price_features
+        demand = self.known_demand.copy()
+        new = np.isnan(demand)
+        new_rows = rows[new]
+        demand[new] = demand_kernel(self.price_change_df['Price'].values.astype(float), self.department_codes[rows], new,
+                                    self.feature_df['MSRP'].values.astype(float)[new_rows],
+                                    self.feature_df['AvgTraffic'].values.astype(float)[new_rows],
+                                    self.feature_df['Desirability'].values.astype(float)[new_rows],
+                                    self.feature_df['PriceElasticity'].values.astype(float)[new_rows])
+
+        demand_df = self.price_change_df.copy()
+        for column in demand_columns[4:-1]:
+            demand_df[column] = self.feature_df[column].values[rows]
+        demand_df['Demand'] = demand
+
+        yesterday = datetime.strftime(pd.to_datetime(self.today_date) -  dt.timedelta(days = 1),"%Y-%m-%d_%H_%M_%S")
+        if self.horizon_df is None:
+            # read previously computed demand
+            previous_demand_df = self.read_demand_forecasts(demand_df, yesterday)
+
+            # merge previous and new demand. when we have both new and old value of demand, take the ond one
+            merged = pd.merge(demand_df, previous_demand_df, how='left', on=['StoreID', 'ProductID', 'DateTime'], suffixes = ['','_prev'])
+            merged['Demand'] = merged['Demand_prev'].astype(float).fillna(merged['Demand'])
+            demand_df = merged[demand_columns]
+
+        self.demand_df = demand_df
+        self.store_horizon()
 
         # store future demand values in CSV file
-        demand_csv = self.demand_df[['StoreID', 'ProductID','DateTime','Demand']][demand_df['DateTime'] >= pd.to_datetime(today_date)]
+        demand_csv = self.demand_df[['StoreID', 'ProductID','DateTime','Demand']][self.demand_df['DateTime'] >= pd.to_datetime(self.today_date)]
         demand_csv.rename({'Demand': 'PredictedDemand'}, inplace=True)
         demand_csv['PredictedDemandDistribution'] = ''
         demand_csv['PredictedDemandVariance'] = -1    
         demand_csv['PredictedDemandProbability'] = 1       
 
         # write predicted demand to CSV files, one file per store, product 
+        forecast_date = self.today_date.replace(' ','_').replace(':','_')
+        partitions = []
         for partition, group in  demand_csv.groupby(['StoreID', 'ProductID']):
             file_name = '{}/demand_forecasts/{}/{}/{}.csv'.format(self.hierarchy['RawDataFolder'], partition[0], partition[1], 
-                        today_date.replace(' ','_').replace(':','_'))
-            with self.adl.open(file_name, 'wb') as f:
-                f.write(group.to_csv(index=False).encode('utf-8'))
+                        forecast_date)
+            write_frame(group, self.adl, file_name)
+            partitions.append(partition + (group['DateTime'].iloc[0], group['Demand'].iloc[0]))
+
+        # list the written forecasts, so that the next run does not need to probe for them, along with the first row
+        # of each forecast: the evaluation looks up the demand of all stores and products in this one table
+        file_name = '{}/demand_forecasts/{}/{}.csv'.format(self.hierarchy['RawDataFolder'], forecast_index_folder, forecast_date)
+        write_rows(partitions, ['StoreID', 'ProductID', 'DateTime', 'Demand'], self.adl, file_name)
+
+        if 'parquet' in output_formats:
+            write_columnar(self.adl, self.hierarchy['RawDataFolder'], 'demand_forecasts', self.today_date, [demand_csv])
+
+
+    def list_demand_forecasts(self, forecast_date):
+        ''' List the (StoreID, ProductID) pairs having a demand forecast written on the given date '''
+        forecast_folder = '{}/demand_forecasts'.format(self.hierarchy['RawDataFolder'])
+        index_file = '{}/{}/{}.csv'.format(forecast_folder, forecast_index_folder, forecast_date)
+        if self.adl.exists(index_file):
+            with self.adl.open(index_file, blocksize=2 ** 20) as f:
+                index_df = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", dtype=str)
+            return list(zip(index_df['StoreID'], index_df['ProductID']))
+
+        # forecasts written before the index was introduced: list the whole tree once
+        if not self.adl.exists(forecast_folder):
+            return []
+        partitions = []
+        for path in self.adl.walk(forecast_folder):
+            parts = path.rstrip('/').split('/')
+            if len(parts) >= 3 and parts[-1] == '{}.csv'.format(forecast_date) and parts[-3] != forecast_index_folder:
+                partitions.append((parts[-3], parts[-2]))
+        return partitions
+
+
+    def read_demand_forecast(self, file_name):
+        ''' Fetch and parse a single demand forecast file '''
+        previous_demand_columns = ['StoreID','ProductID','DateTime','Demand','PredictedDemandDistribution','PredictedDemandVariance','PredictedDemandProbability']
+        with self.adl.open(file_name, blocksize=2 ** 20) as f:
+            return pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", dtype={'StoreID': str}, parse_dates = ['DateTime'], header = 0,
+                               names = previous_demand_columns)
+
+
+    def read_demand_forecasts(self, demand_df, forecast_date):
+        ''' Read the demand forecasts written on the given date for the products in demand_df '''
+        previous_demand_columns = ['StoreID','ProductID','DateTime','Demand','PredictedDemandDistribution','PredictedDemandVariance','PredictedDemandProbability']
+        needed = set(zip(demand_df['StoreID'], demand_df['ProductID']))
+        file_names = ['{}/demand_forecasts/{}/{}/{}.csv'.format(self.hierarchy['RawDataFolder'], partition[0], partition[1], forecast_date)
+                      for partition in self.list_demand_forecasts(forecast_date) if partition in needed]
+        if len(file_names) == 0:
+            return pd.DataFrame(columns = previous_demand_columns)
+
+        # files are small: fetch and parse them concurrently, then concatenate once
+        with ThreadPoolExecutor(max_workers=n_forecast_readers) as executor:
+            forecasts = list(executor.map(self.read_demand_forecast, file_names))
+        return pd.concat(forecasts, ignore_index = True)
 
 
 class Store:
     ''' Simulates sales of all products in a given store '''
 
     def __init__(self, description, store_id):
-        ''' Create a new store given the full simulation AttributeDescription and StoreID '''
+        ''' Create a new store given the AttributeDescription restricted to the store (for_store) and StoreID '''
         self.description = description
         self.adl = description.adl
         self.folder = description.hierarchy['RawDataFolder']
         self.store_id = store_id
+        self.today_date = description.today_date
+        self.seed = description.hierarchy['RandomSeed']
 
         '''
         Workday length and operating time is not currently a tunable parameter.
@@ -645,36 +1335,67 @@ class Store:
         self.workday_length = 14. / 24
         self.opening_time = pd.to_timedelta('7 hours')
         self.closing_time = pd.to_timedelta('21 hours')
-        self.todays_sales = []
-
-        # Load orders
-        self.orders = pd.DataFrame(columns=('PolicyName', 'StoreID', 'ProductID', 'SupplierID', 'Quantity', 
-                                            'OrderTimestamp', 'ETA', 'ConfidenceInterval', 'Fulfilled'))
+        self.columnar = {}  # (dataset, date) -> records of the store to be written as Parquet
+        self.order_files = {}  # orders files written by the store -> policy name
 
+        self.demand_df = description.demand_df.loc[description.demand_df.StoreID == store_id]
+        first_date = self.demand_df['DateTime'].min()
+        state = self.load_state(first_date)
+        if state is not None:
+            snapshot_files = dict(zip(state['OrderFile'].tolist(), zip(state['OrderFilePolicy'].tolist(),
+                                                                        state['OrderFileLength'].tolist(),
+                                                                        state['OrderFileTime'].tolist())))
+            snapshot_orders = pd.DataFrame({column: state['Orders.' + column] for column in OrderBook.columns}, columns=OrderBook.columns)
+            for column in ['OrderTimestamp', 'ETA']:
+                snapshot_orders[column] = pd.to_datetime(snapshot_orders[column], unit='s')
+
+        # Load orders: from the snapshot, unless their file was written since (e.g. by an inventory optimization job)
+        policy_orders_list = []
         if self.adl.exists(description.hierarchy['OrdersFolder']):
             policies = self.adl.ls(description.hierarchy['OrdersFolder'])
             for policy in policies:
                 file_name = '{}/orders_{}.csv'.format(policy, self.store_id)
                 if description.adl.exists(file_name):
+                    if state is not None and file_name in snapshot_files:
+                        policy_name, length, modification_time = snapshot_files[file_name]
+                        info = self.adl.info(file_name)
+                        if (info['length'], info['modificationTime']) == (length, modification_time):
+                            policy_orders_list.append(snapshot_orders.loc[snapshot_orders['PolicyName'] == policy_name])
+                            continue
                     with description.adl.open(file_name, blocksize=2 ** 20) as f:
                         policy_orders = pd.read_csv(StringIO(f.read().decode('utf-8')), header = 0, sep=",", parse_dates=['OrderTimestamp', 'ETA'],
                                                     names=['PolicyName', 'StoreID', 'ProductID', 'SupplierID', 'Quantity', 
                                                            'OrderTimestamp', 'ETA', 'ConfidenceInterval', 'Fulfilled'],
                                                     dtype={'PolicyName':str, 'StoreID':str, 'ProductID':str, 
                                                            'SupplierID':str, 'Quantity':int, 'ConfidenceInterval':int, 'Fulfilled':bool})
-                        self.orders = pd.concat([self.orders, policy_orders])
-                    self.orders = self.orders.reset_index().iloc[:,1:]
+                        policy_orders_list.append(policy_orders)
  
-        ''' Create an inventory for each product. Created inventory = predicted demand '''
-        self.demand_df = description.demand_df.loc[description.demand_df.StoreID == store_id]
-        self.product_ids = self.demand_df['ProductID'].unique()
-        first_date = self.demand_df['DateTime'].min()
-        self.inventories = {}
-        for product_id in self.product_ids:
-            row = self.demand_df.loc[(self.demand_df['ProductID'] == product_id) &
-                                     (self.demand_df['DateTime'] == first_date)]
-            self.inventories[product_id] = Inventory(description, row.iloc[0], self.orders)
-        self.backorders = {}
+        # Every active policy (in the order of the configuration) has its own inventory, facing the same customers.
+        # The records of the first one are published as the records of the store; without any active policy,
+        # a single inventory receives no deliveries
+        configuration = description.configurations
+        self.policies = configuration.loc[configuration['ActiveFlag'] == 1, 'InventoryPolicyName'].astype(str).tolist()
+        self.clear_sales_log()
+
+        ''' Create an inventory for each product and policy. Created inventory = predicted demand '''
+        first_rows = self.demand_df.loc[self.demand_df['DateTime'] == first_date].drop_duplicates('ProductID')
+        self.inventory = StoreInventory(description, first_rows, self.policies if len(self.policies) > 0 else [''],
+                                        random_stream(self.seed, 'arrivals', store_id, first_date.date()), state)
+        self.product_ids = self.inventory.product_ids
+        self.product_json = [json.dumps(str(product_id)) for product_id in self.product_ids]
+        self.shelf_life_days = first_rows['ShelfLife'].astype(str).str.split(' ').str[0].astype(np.int64).values
+
+        # supplier terms of each product (in the order of the inventory), used to order backordered items
+        suppliers = description.hierarchy_index['store_product_supplier'].set_index('ProductID')
+        suppliers = suppliers.loc[self.product_ids]
+        suppliers['ShipmentFreq'] = suppliers['ShipmentFreq'].astype(str).str.split(' ').str[0].astype(np.int64)
+        self.supplier_terms = suppliers[['SupplierID', 'MinOrderQuantity', 'MaxOrderQuantity', 'QuantityMultiplier', 'ShipmentFreq',
+                                         'LeadTime', 'LeadTimeConfidenceInterval']].to_dict('list')
+        self.backorders = {} if state is None else dict(zip(state['BackorderProductID'].tolist(), state['Backorders'].tolist()))
+
+        self.orders = OrderBook(self.inventory.index, self.policies)
+        for policy_orders in policy_orders_list:
+            self.orders.extend(policy_orders)
        
 
     def run(self):
@@ -682,180 +1403,250 @@ class Store:
         conversion_factor = self.workday_length # was 7 * workday_length
         for StartDate, date_df in self.demand_df.groupby('DateTime', sort=True):
             ''' Find the sales and loss rates for each product in that week '''
-            if StartDate >= pd.to_datetime(today_date):
+            if StartDate >= pd.to_datetime(self.today_date):
                 break
             
             print(StartDate)
-            rates = []
-            events = []
-            for row in date_df.itertuples():
-                self.inventories[row.ProductID].update_price(row.Price)
-                rates.extend([row.Demand, row.LossRate])
-                events.extend([[row.ProductID, True], [row.ProductID, False]])
-
-            ''' Beta is the expectation of inverse time until another event occurs '''
-            beta = conversion_factor / sum(rates)
-            rate_ids = list(range(len(rates)))
-            probabilities = [i / sum(rates) for i in rates]
+            rng = random_stream(self.seed, 'events', self.store_id, StartDate.date())
+            products = np.array([self.inventory.index[product_id] for product_id in date_df['ProductID']], dtype=np.int64)
+            self.inventory.price[products] = date_df['Price'].values
+
+            # each product has a sale event (rate = demand) followed by a loss event
+            rates = np.column_stack([date_df['Demand'].values, date_df['LossRate'].values]).ravel().astype(float)
+            event_products = np.repeat(products, 2)
+            event_is_sale = np.tile([True, False], len(products))
 
             # iterate over 1 day (TBD - simplify this code)
             for i in range(1):
                 my_start_date = StartDate + i * pd.to_timedelta('1 days') + self.opening_time
-                if my_start_date > pd.to_datetime(today_date):
+                if my_start_date > pd.to_datetime(self.today_date):
                     break
-                workday_elapsed = 0.
                 self.todays_backorders = []
                 self.get_deliveries(my_start_date) # get deliveries of orders
-                
-                while True:
-                    ''' Choose a time elapsed until the next event '''
-                    workday_elapsed += np.random.exponential(scale=beta)
-                    if workday_elapsed > self.workday_length:
-                        break
-
-                    ''' Choose which event occurred at that time and attempt it '''
-                    event_id = np.random.choice(a=rate_ids, p=probabilities)
-                    product_id, is_sale = events[event_id]
-                    result = self.inventories[product_id].remove_unit(is_sale=is_sale,
-                                                                      time=my_start_date + pd.to_timedelta(workday_elapsed, unit='d'))
-
-                    ''' If a sale was successfully attempted (the item was in stock), record the sale '''
-                    if is_sale:
-                        if result is not None:
-                            self.todays_sales.append(result)
-                        #else:
-                        # backorder item, it was not in the inventory. 
-                        # TBD in the future
-                        #   - maintain inventory per policy
-                        #   - fulfill orders from all policies
-                        #   - generate multiple sales, one from each policy
-                        #   - export only sales of active policies 
-                        #   - export only inventory of active policies
-                        self.todays_backorders.append(product_id)
+
+                if event_mode == 'check':
+                    # the check draws from a stream of its own, so that the simulated events are those of batch mode
+                    check = check_event_equivalence(rates, conversion_factor,
+                                                    rng=random_stream(self.seed, 'check', self.store_id, StartDate.date()))
+                    print('Event generators equivalent: {Equivalent} (count z={CountZ:.2f}, chi-square={ChiSquare:.1f}/{ChiSquareLimit:.1f}, '
+                          'KS={KS:.4f}/{KSLimit:.4f})'.format(**check))
+
+                if event_mode == 'loop':
+                    elapsed, event_ids = generate_events_loop(rates, conversion_factor, rng)
+                else:
+                    elapsed, event_ids = generate_events(rates, conversion_factor, rng)
+                self.apply_events(my_start_date, elapsed, event_products[event_ids], event_is_sale[event_ids])
 
                 self.end_of_day(my_start_date)
-       
 
-    # fulfill orders from active policies
+
+    def advance(self, today_date, demand_df):
+        ''' Move on to the next date of a backfill, keeping the state of the store in memory '''
+        self.today_date = today_date
+        self.demand_df = demand_df
+
+
+    def state_file_name(self):
+        return '{}/{}/store{}.npz'.format(self.description.hierarchy['PrivateParametersFolder'], state_folder, self.store_id)
+
+
+    def load_state(self, state_date):
+        ''' Snapshot written at the end of the previous run, if that run ended on the given date '''
+        file_name = self.state_file_name()
+        if not self.adl.exists(file_name):
+            return None
+        with self.adl.open(file_name, blocksize=2 ** 20) as f:
+            state = np.load(BytesIO(f.read()), allow_pickle=False)
+            state = {name: state[name] for name in state.files}
+        if str(state['Date']) != state_date.strftime('%Y-%m-%d %H:%M:%S'):
+            print('Snapshot of store {} is not up to date, restoring from the published records.'.format(self.store_id))
+            return None
+        return state
+
+
+    def save_state(self):
+        ''' Write a snapshot of the store (inventory batches, backorders, orders) for the next run.
+            The JSON/CSV records are only outputs; the next run restores the store from this file alone, except for
+            the orders files written since by other jobs '''
+        state = {'Date': np.array(self.inventory.last_write_date.strftime('%Y-%m-%d %H:%M:%S'))}
+
+        rows, expiry, units = self.inventory.batches()
+        state['ProductID'] = np.asarray(self.product_ids, dtype=str)
+        state['PolicyName'] = np.asarray(self.inventory.policies, dtype=str)
+        state['BatchPolicy'], state['BatchProduct'] = np.divmod(rows, len(self.product_ids))
+        state['BatchExpiry'], state['BatchUnits'] = expiry, units
+
+        state['BackorderProductID'] = np.array(list(self.backorders), dtype=str)
+        state['Backorders'] = np.array(list(self.backorders.values()), dtype=np.int64)
+
+        orders = self.orders.to_frame()
+        for column in OrderBook.columns:
+            values = orders[column]
+            if column in ['OrderTimestamp', 'ETA']:
+                values = to_epoch(values)
+            state['Orders.' + column] = np.asarray(values).astype(str if OrderBook.dtypes[column] == object else OrderBook.dtypes[column])
+
+        # orders files are also written by the inventory optimization jobs: remember what they looked like
+        order_files = sorted(self.order_files.items())
+        info = [self.adl.info(file_name) for file_name, _ in order_files]
+        state['OrderFile'] = np.array([file_name for file_name, _ in order_files], dtype=str)
+        state['OrderFilePolicy'] = np.array([policy_name for _, policy_name in order_files], dtype=str)
+        state['OrderFileLength'] = np.array([file_info['length'] for file_info in info], dtype=np.int64)
+        state['OrderFileTime'] = np.array([file_info['modificationTime'] for file_info in info], dtype=np.int64)
+
+        buffer = BytesIO()
+        np.savez_compressed(buffer, **state)
+        with self.adl.open(self.state_file_name(), 'wb') as f:
+            f.write(buffer.getvalue())
+
+
+    def apply_events(self, start_date, elapsed, products, is_sale):
+        ''' Attempt a day of sale/loss events (product index and type of each event) against the inventories
+            of all policies in one pass over the event arrays: every policy faces the same events '''
+
+        # inventories only shrink during the day, so an event succeeds in the inventory of a policy iff
+        # fewer events of the same product happened before it than there were units in that inventory
+        rows = self.inventory.rows(np.arange(len(self.inventory.policies))[:, None], products[None, :])
+        served = rank_within_groups(products) < self.inventory.stock()[rows]
+
+        sales = np.bincount(rows[served & is_sale], minlength=self.inventory.n_rows)
+        losses = np.bincount(rows[served & ~is_sale], minlength=self.inventory.n_rows)
+        self.inventory.sales += sales
+        self.inventory.losses += losses
+        self.inventory.remove(sales + losses)
+
+        ''' Record the sales that were successfully attempted (the item was in stock), policy after policy '''
+        sold_policies, sold = np.nonzero(served & is_sale)
+        times = to_epoch(start_date) + np.round(elapsed[sold] * 24 * 3600).astype(np.int64)
+        self.sale_policies = np.concatenate([self.sale_policies, sold_policies])
+        self.sale_products = np.concatenate([self.sale_products, products[sold]])
+        self.sale_times = np.concatenate([self.sale_times, times])
+        self.sale_prices = np.concatenate([self.sale_prices, np.round(self.inventory.price, 2)[products[sold]]])
+
+        # every sale attempt is backordered, whether or not the item was in the inventory
+        self.todays_backorders.extend(self.product_ids[products[is_sale]].tolist())
+
+
+    # fulfill orders from active policies, each into the inventory of its policy
     def get_deliveries(self, current_date):
-        configuration = self.description.configurations
-        
-        for i, order in self.orders.iterrows():
-            # check if this order can be delivered today
-            active = configuration.loc[configuration['InventoryPolicyName'] == str(order['PolicyName']),'ActiveFlag'].iat[0]
-            if active == 1 and order['ETA'].date() == current_date.date() and order['Fulfilled'] == False:
-                self.orders.at[i,'Fulfilled'] = True
-                # add inventory record
-                brand_id = int(order['ProductID'].split('_')[0]) - 1
-                shelf_life = int(self.description.hierarchy['Brands'][brand_id]['Products'][0]['ShelfLife'].split(' ')[0])
-                self.inventories[order['ProductID']].add_inventory(current_date + shelf_life * pd.to_timedelta('1 days'), 
-                                                                   order['Quantity'])
+        policies, products, quantities = self.orders.deliver(current_date)
+        self.inventory.add(self.inventory.rows(policies, products), to_epoch(current_date) + self.shelf_life_days[products] * 24 * 3600,
+                           quantities)
         
 
-    def poor_mans_zero_truncated_poisson(self, k):
-        ''' Draw x>=1 from a Poisson distribution (to determine # of items in a transaction) '''
-        result = np.random.poisson(k)
-        while (result == 0):
-            result = np.random.poisson(k)
-        return (result)
-
-
-    def group_sales_into_transaction(self, sale_list):
-        ''' Group individual item sales records into a single receipt '''
-        products = []
-        subtotal = 0.
-        for sale in sale_list:
-            entry_dict = {}
-            entry_dict['ProductID'] = sale['ProductID']
-            entry_dict['Price'] = sale['Price']
-            products.append(entry_dict)
-            subtotal += sale['Units'] * sale['Price']
-        transaction = {}
-        transaction['TransactionDateTime'] = sale_list[-1]['TransactionDateTime']
-        transaction['Subtotal'] = round(subtotal, 2)
-        transaction['Tax'] = round(subtotal * 0.07, 2)
-        transaction['Total'] = round(subtotal + transaction['Tax'], 2)
-        transaction['Products'] = products
-        return (transaction)
+    def clear_sales_log(self):
+        ''' Sales log of the day: policy index, product index, time (epoch seconds) and price of each unit sold '''
+        self.sale_policies = np.zeros(0, dtype=np.int64)
+        self.sale_products = np.zeros(0, dtype=np.int64)
+        self.sale_times = np.zeros(0, dtype=np.int64)
+        self.sale_prices = np.zeros(0, dtype=float)
+
+
+    def collect_columnar(self, dataset, partition_date, rows):
+        ''' Keep records (tuples or a data frame) of the store until the Parquet files holding all stores are written '''
+        columns = [column for column, _ in columnar_schemas[dataset]]
+        self.columnar.setdefault((dataset, partition_date), []).append(pd.DataFrame(rows, columns=columns))
+
+
+    def write_policy_records(self, summaries, write_date, write_date_file_format):
+        ''' Write the inventory and the sales log (items sold, then spoilages at price 0) of every active policy,
+            so that policies are evaluated on what they sold rather than by matching sales to their orders '''
+        folder = '{}/{}'.format(self.folder, policy_records_folder)
+        write_rows(((policy, self.store_id, product['ProductID'], write_date, batch['Units'], batch['ExpiryDateTime'])
+                    for policy, (inventory_summaries, _) in zip(self.policies, summaries)
+                    for product in inventory_summaries for batch in product['CurrentInventory']),
+                   ['PolicyID', 'StoreID', 'ProductID', 'InventoryDateTime', 'Units', 'ExpiryDateTime'],
+                   self.adl, '{}/inv_store{}_{}.csv'.format(folder, self.store_id, write_date_file_format))
+
+        sale_times = epoch_to_string(self.sale_times).tolist()
+        sale_products = self.product_ids[self.sale_products].tolist()
+        sale_prices = self.sale_prices.tolist()
+        bounds = np.searchsorted(self.sale_policies, np.arange(len(self.policies) + 1))
+
+        def policy_sales(i, policy, spoilage_summaries):
+            for sale in range(bounds[i], bounds[i + 1]):
+                yield policy, self.store_id, sale_products[sale], sale_times[sale], 1, sale_prices[sale]
+            for product in spoilage_summaries:
+                for batch in product['CurrentSpoilages']:
+                    yield policy, self.store_id, product['ProductID'], write_date, batch['Units'], 0.0
+
+        write_rows((row for i, (policy, (_, spoilage_summaries)) in enumerate(zip(self.policies, summaries))
+                    for row in policy_sales(i, policy, spoilage_summaries)),
+                   ['PolicyID', 'StoreID', 'ProductID', 'TransactionDateTime', 'Units', 'Price'],
+                   self.adl, '{}/sales_store{}_{}.csv'.format(folder, self.store_id, write_date_file_format))
 
 
     def end_of_day(self, current_date):
         ''' Write out sales transactions and inventory for the day '''
-        ''' Begin by writing the inventory summary '''
-        inventory_summaries = []
-        spoilage_summaries = []
-        for product_id in self.product_ids:
-            inventory_summary, spoilage_summary = self.inventories[product_id].end_of_day()
-            inventory_summaries.append(inventory_summary)
-            if len(spoilage_summary['CurrentSpoilages']) > 0:
-                spoilage_summaries.append(spoilage_summary)
-        write_date = self.inventories[self.product_ids[0]].last_write_date.strftime('%Y-%m-%d %H:%M:%S')
-        write_date_file_format = self.inventories[self.product_ids[0]].last_write_date.strftime('%Y_%m_%d_%H_%M_%S')
+        ''' Begin by writing the inventory summary (of the first policy) '''
+        summaries = self.inventory.end_of_day()
+        inventory_summaries, spoilage_summaries = summaries[0]
+        write_date = self.inventory.last_write_date.strftime('%Y-%m-%d %H:%M:%S')
+        write_date_file_format = self.inventory.last_write_date.strftime('%Y_%m_%d_%H_%M_%S')
+        if len(self.policies) > 0:
+            self.write_policy_records(summaries, write_date, write_date_file_format)
      
         inventory_dict = {}
         inventory_dict['StoreID'] = int(self.store_id)
         inventory_dict['InventoryDateTime'] = write_date
         inventory_dict['Products'] = inventory_summaries
-      
-        spoilages_dict = {}
-        spoilages_dict['StoreID'] = int(self.store_id)
-        spoilages_dict['SpoilageDateTime'] = write_date
-        spoilages_dict['Products'] = spoilage_summaries
 
         # save inventory in JSON format
-        inventory_file_name = '{}/inv_store{}_{}.json'.format(self.folder, self.store_id, write_date_file_format)
-        with self.adl.open(inventory_file_name, 'wb') as f:
-            inventory_string = json.dumps(inventory_dict, sort_keys=True, indent=4, separators=(',', ': '))
-            f.write(inventory_string.encode('utf-8'))
+        if 'json' in output_formats:
+            inventory_file_name = '{}/inv_store{}_{}.json'.format(self.folder, self.store_id, write_date_file_format)
+            write_json(inventory_dict, self.adl, inventory_file_name, 'Products', inventory_summaries)
 
         # save inventory in CSV format
-        inventory_file_name = '{}/inv_store{}_{}.csv'.format(self.folder, self.store_id, write_date_file_format)
-        write_data(((store, product, timestamp, inventory_record) for store in [{'StoreID': self.store_id}]
-                                                                  for product in inventory_dict['Products']
-                                                                  for timestamp in [{'InventoryDateTime': write_date}]
-                                                                  for inventory_record in product['CurrentInventory']),
-                   ['StoreID', 'ProductID', 'InventoryDateTime', 'Units', 'ExpiryDateTime'], self.adl, inventory_file_name)
-
-        ''' Now create the sales summary '''
-        sales_dict = {}
-        sales_dict['StoreID'] = int(self.store_id)
-        sales_dict['SalesLogDateTime'] = write_date
-        transactions = []
-        idx = 0
-        while (idx < len(self.todays_sales)):
-            n = self.poor_mans_zero_truncated_poisson(2)  # max num of items in next transaction
-            transactions.append(self.group_sales_into_transaction(self.todays_sales[idx:min(idx + n,
-                                                                                            len(self.todays_sales))]))
-            idx += n
-
-        sales_dict['Transactions'] = transactions
-
-        # append spoilages to sales
-        if len(spoilage_summaries) > 0:
-            rows = []
-            for product in spoilages_dict['Products']:
-                for spoilage_record in product['CurrentSpoilages']:
-                    spoilage_dict = {}
-                    spoilage_dict['ProductID'] = product['ProductID']
-                    spoilage_dict['TransactionDateTime'] = write_date 
-                    spoilage_dict['Units'] = spoilage_record['Units']
-                    spoilage_dict['Price'] = 0
-                    rows.append(spoilage_dict)
-
-            self.todays_sales.extend(rows)
+        if 'csv' in output_formats:
+            inventory_file_name = '{}/inv_store{}_{}.csv'.format(self.folder, self.store_id, write_date_file_format)
+            write_data(((store, product, timestamp, inventory_record) for store in [{'StoreID': self.store_id}]
+                                                                      for product in inventory_dict['Products']
+                                                                      for timestamp in [{'InventoryDateTime': write_date}]
+                                                                      for inventory_record in product['CurrentInventory']),
+                       ['StoreID', 'ProductID', 'InventoryDateTime', 'Units', 'ExpiryDateTime'], self.adl, inventory_file_name)
+
+        if 'parquet' in output_formats:
+            self.collect_columnar('inventory', write_date,
+                                  [(self.store_id, product['ProductID'], write_date, batch['Units'], batch['ExpiryDateTime'])
+                                   for product in inventory_summaries for batch in product['CurrentInventory']])
+            self.collect_columnar('spoilage', write_date,
+                                  [(self.store_id, product['ProductID'], write_date, batch['Units'], batch['ExpiryDateTime'])
+                                   for product in spoilage_summaries for batch in product['CurrentSpoilages']])
+
+        ''' Now create the sales summary: group the items sold into receipts of random size '''
+        published = self.sale_policies == 0
+        sale_products, sale_prices = self.sale_products[published], self.sale_prices[published]
+        starts = receipt_starts(len(sale_products), 2, random_stream(self.seed, 'receipts', self.store_id, current_date.date()))
+        sale_times = epoch_to_string(self.sale_times[published])
 
         # save sales in JSON format
-        sales_file_name = '{}/sales_store{}_{}.json'.format(self.folder, self.store_id, write_date_file_format)
-        with self.adl.open(sales_file_name, 'wb') as f:
-            sales_string = json.dumps(sales_dict, sort_keys=True, indent=4, separators=(',', ': '))
-            f.write(sales_string.encode('utf-8'))
+        if 'json' in output_formats:
+            sales_file_name = '{}/sales_store{}_{}.json'.format(self.folder, self.store_id, write_date_file_format)
+            with self.adl.open(sales_file_name, 'wb') as f, StorageWriter(f) as out:
+                write_sales_json(out, int(self.store_id), write_date, self.product_json,
+                                 sale_products, sale_times, sale_prices, starts)
+
+        # the sales log lists every item sold, followed by the spoilages at price 0
+        spoiled_products = np.array([self.inventory.index[product['ProductID']]
+                                     for product in spoilage_summaries for batch in product['CurrentSpoilages']], dtype=np.int64)
+        spoiled_units = np.array([batch['Units'] for product in spoilage_summaries for batch in product['CurrentSpoilages']],
+                                 dtype=np.int64)
+        sales_df = pd.DataFrame({'StoreID': self.store_id,
+                                 'ProductID': self.product_ids[np.concatenate([sale_products, spoiled_products])],
+                                 'TransactionDateTime': np.concatenate([sale_times, np.repeat(write_date, len(spoiled_products))]),
+                                 'Units': np.concatenate([np.ones(len(sale_products), dtype=np.int64), spoiled_units]),
+                                 'Price': np.concatenate([sale_prices, np.zeros(len(spoiled_products))])},
+                                columns=['StoreID', 'ProductID', 'TransactionDateTime', 'Units', 'Price'])
 
         # save sales in CSV format
-        sales_file_name = '{}/sales_store{}_{}.csv'.format(self.folder, self.store_id, write_date_file_format)
-        write_data(((store, sale_record) for store in [{'StoreID': self.store_id}] for sale_record in self.todays_sales), 
-                   ['StoreID', 'ProductID', 'TransactionDateTime', 'Units', 'Price'], self.adl, sales_file_name)
+        if 'csv' in output_formats:
+            sales_file_name = '{}/sales_store{}_{}.csv'.format(self.folder, self.store_id, write_date_file_format)
+            write_frame(sales_df, self.adl, sales_file_name)
 
-        self.todays_sales = []
+        if 'parquet' in output_formats:
+            self.collect_columnar('sales', write_date, sales_df)
+
+        self.clear_sales_log()
 
         # add today's backorders to the global dataset of backorders
         counts = Counter(self.todays_backorders) 
@@ -867,27 +1658,20 @@ class Store:
                 self.backorders[product] += n_backorders
 
         # try to place orders on backordered items
-        store_id_int = int(self.store_id) - 1
-        store_data = self.description.hierarchy['Stores'][store_id_int]
-        n_orig_orders = self.orders.shape[0]
+        n_orig_orders = len(self.orders)
         # Python 2 - for product, n_backorders in self.backorders.iteritems():
         for product, n_backorders in self.backorders.items():
 
             # find supplier data for a product
-            product_index = int(product.split('_')[0]) - 1
-            products_per_supplier = n_brands / n_suppliers
-            supplier_index = int(product_index / products_per_supplier)
-            product_index = int(product_index % products_per_supplier)
-            supplier_product = store_data['ProductSupplier'][supplier_index]['Products'][product_index]
-            supplier_id = store_data['ProductSupplier'][supplier_index]['SupplierID']
+            supplier_product = {name: terms[self.inventory.index[product]] for name, terms in self.supplier_terms.items()}
+            supplier_id = supplier_product['SupplierID']
 
             # all supplier constraints are satisfied, we can place an order
             can_order = True
             if supplier_product['MinOrderQuantity'] > n_backorders or supplier_product['QuantityMultiplier'] > n_backorders:
                 can_order = False    # wait till we have enough items to order
             else:
-                shipment_freq = int(supplier_product['ShipmentFreq'].split(' ')[0])
-                if current_date.toordinal() % shipment_freq != 0:
+                if current_date.toordinal() % supplier_product['ShipmentFreq'] != 0:
                     can_order = False    # wait until supplier will start to accept the orders
                 
             if can_order:
@@ -899,187 +1683,446 @@ class Store:
                 self.backorders[product] = n_backorders - order_size
                     
                 policy_name = get_policy_name(self.store_id, product, supplier_id)
-                self.orders.loc[self.orders.shape[0] + 1] = [policy_name, self.store_id, product, supplier_id, 
-                                                             order_size, current_date, 
-                                                             current_date + supplier_product['LeadTime'] * pd.to_timedelta('1 days'), 
-                                                             supplier_product['LeadTimeConfidenceInterval'], False]
+                self.orders.append(policy_name, self.store_id, product, supplier_id, order_size, current_date,
+                                   current_date + supplier_product['LeadTime'] * pd.to_timedelta('1 days'),
+                                   supplier_product['LeadTimeConfidenceInterval'])
 
         # clean up the dictionary of backorders
         self.backorders = {product: v for product, v in self.backorders.items() if v > 0}        
 
         # save orders
-        self.orders['Quantity'] = self.orders['Quantity'].astype(int)
-        self.orders['ConfidenceInterval'] = self.orders['ConfidenceInterval'].astype(int)
-        grouped = self.orders.groupby('PolicyName')
+        orders = self.orders.to_frame()
+        new_orders_all = self.orders.to_frame(n_orig_orders)
+        grouped = orders.groupby('PolicyName')
         conf = self.description.configurations
 
         for name, group in grouped:
 
             directory_name = conf.loc[conf['InventoryPolicyName'] == str(name),'DirectoryName'].iat[0]
             orders_file_name = self.description.hierarchy['OrdersFolder'] + '/' + str(directory_name) + '/orders_' + str(self.store_id) + '.csv'
-            with self.adl.open(orders_file_name, 'wb') as f:
-                f.write(group.to_csv(index=False).encode('utf-8'))
+            write_frame(group, self.adl, orders_file_name)
+            self.order_files[orders_file_name] = str(name)
 
             partial_orders_file_name = self.description.hierarchy['OrdersFolder'] + '/' + str(directory_name) + '/partial_orders_' + str(self.store_id) + '.csv'
             if self.adl.exists(partial_orders_file_name):
-                if n_orig_orders < self.orders.shape[0]:
-                    new_orders_all = self.orders.iloc[n_orig_orders:self.orders.shape[0]]
+                if n_orig_orders < len(self.orders):
                     new_orders = new_orders_all[new_orders_all['PolicyName'] == name]
-                    with self.adl.open(partial_orders_file_name, 'ab') as f:
-                        f.write(new_orders.to_csv(index=False, header=False).encode('utf-8'))
+                    write_frame(new_orders, self.adl, partial_orders_file_name, 'ab', header=False)
+            else:
+                write_frame(group, self.adl, partial_orders_file_name)
+
+
+class OrderBook:
+    ''' Orders of a store, kept column-wise in arrays that double in size when full, and indexed by ETA date.
+        Every order is delivered to the inventory of its policy; orders of inactive policies are never delivered '''
+
+    columns = ['PolicyName', 'StoreID', 'ProductID', 'SupplierID', 'Quantity',
+               'OrderTimestamp', 'ETA', 'ConfidenceInterval', 'Fulfilled']
+    dtypes = {'PolicyName': object, 'StoreID': object, 'ProductID': object, 'SupplierID': object, 'Quantity': np.int64,
+              'OrderTimestamp': np.int64, 'ETA': np.int64, 'ConfidenceInterval': np.int64, 'Fulfilled': bool,
+              'ProductIndex': np.int64, 'PolicyIndex': np.int64}
+
+    def __init__(self, product_index, policies, capacity=64):
+        ''' product_index maps product ids to inventory indices, policies lists the names of the active policies '''
+        self.product_index = product_index
+        self.policy_index = {policy: i for i, policy in enumerate(policies)}
+        self.size = 0
+        self.data = {column: np.zeros(capacity, dtype=dtype) for column, dtype in self.dtypes.items()}
+        self.by_eta = {}  # ETA (days since the epoch) -> orders arriving that day
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __reserve(self, n):
+        ''' Make room for n more orders '''
+        if self.size + n > len(self.data['Quantity']):
+            capacity = max(2 * len(self.data['Quantity']), self.size + n)
+            for column, values in self.data.items():
+                self.data[column] = np.concatenate([values, np.zeros(capacity - len(values), dtype=values.dtype)])
+
+
+    def extend(self, orders_df):
+        ''' Append the orders of a data frame with the order file columns '''
+        n = orders_df.shape[0]
+        self.__reserve(n)
+        rows = slice(self.size, self.size + n)
+        for column in ['PolicyName', 'StoreID', 'ProductID', 'SupplierID']:
+            self.data[column][rows] = orders_df[column].astype(str).values
+        for column in ['Quantity', 'ConfidenceInterval']:
+            self.data[column][rows] = orders_df[column].values.astype(np.int64)
+        for column in ['OrderTimestamp', 'ETA']:
+            self.data[column][rows] = to_epoch(orders_df[column])
+        self.data['Fulfilled'][rows] = orders_df['Fulfilled'].values.astype(bool)
+        self.data['ProductIndex'][rows] = [self.product_index.get(product_id, -1) for product_id in self.data['ProductID'][rows]]
+        self.data['PolicyIndex'][rows] = [self.policy_index.get(policy, -1) for policy in self.data['PolicyName'][rows]]
+
+        for i, eta in zip(range(self.size, self.size + n), self.data['ETA'][rows] // (24 * 3600)):
+            self.by_eta.setdefault(eta, []).append(i)
+        self.size += n
+
+
+    def append(self, policy_name, store_id, product_id, supplier_id, quantity, order_timestamp, eta, confidence_interval):
+        ''' Place a new order '''
+        self.__reserve(1)
+        values = {'PolicyName': str(policy_name), 'StoreID': str(store_id), 'ProductID': str(product_id),
+                  'SupplierID': str(supplier_id), 'Quantity': quantity, 'OrderTimestamp': to_epoch(order_timestamp),
+                  'ETA': to_epoch(eta), 'ConfidenceInterval': confidence_interval, 'Fulfilled': False,
+                  'ProductIndex': self.product_index.get(str(product_id), -1), 'PolicyIndex': self.policy_index.get(str(policy_name), -1)}
+        for column, value in values.items():
+            self.data[column][self.size] = value
+        self.by_eta.setdefault(values['ETA'] // (24 * 3600), []).append(self.size)
+        self.size += 1
+
+
+    def deliver(self, date):
+        ''' Mark the orders of active policies arriving on the given date as fulfilled, and return their
+            policy indices, product indices and quantities '''
+        due = np.array(self.by_eta.get(to_epoch(date) // (24 * 3600), []), dtype=np.int64)
+        due = due[(self.data['PolicyIndex'][due] >= 0) & ~self.data['Fulfilled'][due] & (self.data['ProductIndex'][due] >= 0)]
+        self.data['Fulfilled'][due] = True
+        return self.data['PolicyIndex'][due], self.data['ProductIndex'][due], self.data['Quantity'][due]
+
+
+    def to_frame(self, start=0):
+        ''' Orders from the given position on, with the order file columns '''
+        orders = pd.DataFrame({column: self.data[column][start:self.size] for column in self.columns}, columns=self.columns)
+        for column in ['OrderTimestamp', 'ETA']:
+            orders[column] = pd.to_datetime(orders[column], unit='s')
+        return orders
+
+
+class StoreInventory:
+    ''' Maintains inventory of all products of a store (not limiting in demand forecasting/price optimization solution),
+        once for every policy simulated: row r holds product r % n_products under policy r // n_products.
+        Batches of each row are kept first-in first-out in a ring buffer: row r of the expiry (epoch seconds)
+        and units arrays holds the batches of row r, starting at column head[r] and wrapping around. '''
+
+    initial_capacity = 4  # batches per product before the buffers grow
+
+    def __compute_arrivals(self):
+        min_order = np.maximum(1, self.min_order_quantity)
+        max_order = np.where(self.max_order_quantity < 0, 10000, np.minimum(10000, self.max_order_quantity))
+        order_arrival = self.rng.randint(min_order, max_order + 1)
+        multiplier = np.maximum(self.quantity_multiplier, 1)
+        return np.where(self.quantity_multiplier > 0,
+                        np.maximum(min_order, order_arrival - order_arrival % multiplier),
+                        order_arrival)
+
+
+    def __init__(self, description, rows, policies, rng=np.random, state=None):
+        ''' Restore the inventory from the store snapshot, or else load the last inventory record if possible;
+            otherwise, create a new inventory. rows holds one record of the demand data frame per product.
+            A policy restarts from its own inventory record if it is listed there; batches not attributed to a policy
+            (inventory record of the store, older snapshot) start the inventory of every other policy '''
+        self.rng = rng
+        self.store_id = rows['StoreID'].iloc[0]
+        self.product_ids = rows['ProductID'].values
+        self.index = {product_id: i for i, product_id in enumerate(self.product_ids)}
+        self.policies = list(policies)
+        self.n_rows = len(self.policies) * len(self.product_ids)
+        self.price = rows['Price'].values.astype(float)
+        self.min_order_quantity = rows['MinOrderQuantity'].values.astype(np.int64)
+        self.max_order_quantity = rows['MaxOrderQuantity'].values.astype(np.int64)
+        self.quantity_multiplier = rows['QuantityMultiplier'].values.astype(np.int64)
+        self.last_write_date = rows['DateTime'].iloc[0]
+
+        self.expiry = np.zeros((self.n_rows, self.initial_capacity), dtype=np.int64)
+        self.units = np.zeros((self.n_rows, self.initial_capacity), dtype=np.int32)
+        self.head = np.zeros(self.n_rows, dtype=np.int64)
+        self.count = np.zeros(self.n_rows, dtype=np.int64)
+
+        self.arrivals = np.zeros(self.n_rows, dtype=np.int64)
+        self.sales = np.zeros(self.n_rows, dtype=np.int64)
+        self.losses = np.zeros(self.n_rows, dtype=np.int64)
+        self.spoilages = np.zeros(self.n_rows, dtype=np.int64)
+
+        if state is not None:
+            # batches of products that are no longer sold, or of policies no longer simulated, are dropped
+            products = np.array([self.index.get(product_id, -1) for product_id in state['ProductID'].tolist()],
+                                dtype=np.int64)[state['BatchProduct']]
+            if 'BatchPolicy' in state:
+                policies = np.array([self.policies.index(policy) if policy in self.policies else -1
+                                     for policy in state['PolicyName'].tolist()], dtype=np.int64)[state['BatchPolicy']]
+                kept = (products >= 0) & (policies >= 0)
+                self.add(self.rows(policies[kept], products[kept]), state['BatchExpiry'][kept], state['BatchUnits'][kept])
             else:
-                with self.adl.open(partial_orders_file_name, 'wb') as f:
-                    f.write(group.to_csv(index=False).encode('utf-8'))
-
-
-class Inventory:
-    ''' Maintains product inventory (not limiting in demand forecasting/price optimization solution) '''
-
-    def  __compute_arrivals(self):
-         min_order = max(1,self.min_order_quantity)
-         if self.max_order_quantity < 0:
-             max_order = 10000
-         else:
-             max_order = min(10000, self.max_order_quantity)
-         order_arrival = int(random_integers(min_order, max_order))
-         if self.quantity_multiplier > 0:
-             return max(min_order, order_arrival - (order_arrival % self.quantity_multiplier))     
-         else:
-             return order_arrival
-
-
-    def __init__(self, description, row, orders):
-        ''' Load last inventory record if possible; otherwise, create a new inventory '''
-        self.store_id = row.StoreID
-        self.product_id = row.ProductID
-        self.price = row.Price
-        self.min_order_quantity = row.MinOrderQuantity
-        self.max_order_quantity = row.MaxOrderQuantity
-        self.quantity_multiplier = row.QuantityMultiplier
-        self.shipment_frequency = pd.to_timedelta(row.ShipmentFreq)
-        self.shelf_life = pd.to_timedelta(row.ShelfLife)
-        self.inventory = []
-        self.arrivals = 0
-        self.last_write_date = row.DateTime
-
-        file_name = '{}/inv_store{}_{}.json'.format(description.hierarchy['RawDataFolder'],
-                                                    self.store_id,
-                                                    row.DateTime.strftime('%Y_%m_%d_%H_%M_%S'))
+                kept = products >= 0
+                self.add_to_all(products[kept], state['BatchExpiry'][kept], state['BatchUnits'][kept])
+            return
+
+        batches = self.__load_batches(description)
+        if batches is None:
+            self.arrivals = np.tile(self.__compute_arrivals(), len(self.policies))
+        else:
+            recorded = self.__load_policy_batches(description)
+            batches = [(policy, self.index[product_id], expiry, units) for policy, policy_name in enumerate(self.policies)
+                       for product_id, expiry, units in recorded.get(policy_name, batches) if product_id in self.index]
+            if len(batches) > 0:
+                policies, products, expiry, units = zip(*batches)
+                self.add(self.rows(policies, np.array(products)), to_epoch(list(expiry)), np.array(units))
+
+
+    def __load_batches(self, description):
+        ''' Batches (product, expiry, units) of the last inventory record, from whichever format it was written in.
+            None if there is no record '''
+        folder = description.hierarchy['RawDataFolder']
+        file_date = self.last_write_date.strftime('%Y_%m_%d_%H_%M_%S')
+        file_name = '{}/inv_store{}_{}.json'.format(folder, self.store_id, file_date)
         if description.adl.exists(file_name):
             with description.adl.open(file_name, blocksize=2 ** 20) as f:
                 last_inventory = json.loads(f.read().decode('utf-8'))
-                for product in last_inventory['Products']:
-                    if product['ProductID'] == self.product_id:
-                        break
-                for batch in product['CurrentInventory']:
-                    self.inventory.append([pd.to_datetime(batch['ExpiryDateTime']), batch['Units']])
-        else:
-            self.start_date = row.DateTime
-            self.arrivals = self.__compute_arrivals()  
-
-        self.sales = 0
-        self.losses = 0
-        self.spoilages = 0
-        
-
-    def update_price(self, price):
-        ''' Used to update the price included in sales records '''
-        self.price = price
-        
+            return [(product['ProductID'], batch['ExpiryDateTime'], batch['Units'])
+                    for product in last_inventory['Products'] for batch in product['CurrentInventory']]
 
-    def remove_unit(self, time, is_sale=True):
-        ''' Checks whether a new sale/loss event is possible, and if so, updates inventory and sale records '''
-        time = time.round(freq='1s')
-        if len(self.inventory) > 0:
-            if is_sale:
-                self.sales += 1
-            else:
-                self.losses += 1
-            if self.inventory[0][1] == 1:
-                self.inventory.pop(0)  # last item from this expiry date; remove its entry
-            else:
-                self.inventory[0][1] -= 1
-             
-            event_dict = {}
-            if is_sale:
-                ''' Create a JSONable description of a sale (no need for loss events) '''
-                event_dict['TransactionDateTime'] = str(time)
-                event_dict['ProductID'] = self.product_id
-                event_dict['Units'] = 1
-                event_dict['Price'] = round(float(self.price), 2)
-            return event_dict
-        else:
-            return None  # this return value indicates this item is sold out
+        file_name = '{}/inv_store{}_{}.csv'.format(folder, self.store_id, file_date)
+        if description.adl.exists(file_name):
+            with description.adl.open(file_name, blocksize=2 ** 20) as f:
+                last_inventory = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",", dtype={'StoreID': str, 'ProductID': str})
+            return list(zip(last_inventory['ProductID'], last_inventory['ExpiryDateTime'], last_inventory['Units']))
+
+        last_inventory = read_columnar(description.adl, folder, 'inventory', self.last_write_date)
+        if last_inventory is not None:
+            last_inventory = last_inventory.loc[last_inventory['StoreID'].astype(str) == str(self.store_id)]
+            return list(zip(last_inventory['ProductID'].astype(str), last_inventory['ExpiryDateTime'], last_inventory['Units']))
+        return None
+
+
+    def __load_policy_batches(self, description):
+        ''' Batches (product, expiry, units) of the last inventory record of every policy, by policy name '''
+        file_name = '{}/{}/inv_store{}_{}.csv'.format(description.hierarchy['RawDataFolder'], policy_records_folder, self.store_id,
+                                                      self.last_write_date.strftime('%Y_%m_%d_%H_%M_%S'))
+        if not description.adl.exists(file_name):
+            return {}
+        with description.adl.open(file_name, blocksize=2 ** 20) as f:
+            last_inventory = pd.read_csv(StringIO(f.read().decode('utf-8')), sep=",",
+                                         dtype={'PolicyID': str, 'StoreID': str, 'ProductID': str})
+        return {policy: list(zip(group['ProductID'], group['ExpiryDateTime'], group['Units']))
+                for policy, group in last_inventory.groupby('PolicyID', sort=False)}
+
+
+    def rows(self, policies, products):
+        ''' Inventory rows of (policy index, product index) pairs '''
+        return np.asarray(policies, dtype=np.int64) * len(self.product_ids) + products
+
+
+    def __positions(self):
+        ''' Columns of the batches of every row in FIFO order, and which of them hold a batch '''
+        offsets = np.arange(self.expiry.shape[1])
+        columns = (self.head[:, None] + offsets) % self.expiry.shape[1]
+        valid = offsets < self.count[:, None]
+        return columns, valid
+
+
+    def __grow(self, capacity):
+        ''' Reallocate the buffers with the given number of batches per product, unwrapping the rings '''
+        columns, valid = self.__positions()
+        rows = np.arange(self.n_rows)[:, None]
+        expiry = np.zeros((self.n_rows, capacity), dtype=np.int64)
+        units = np.zeros((self.n_rows, capacity), dtype=np.int32)
+        expiry[:, :columns.shape[1]] = np.where(valid, self.expiry[rows, columns], 0)
+        units[:, :columns.shape[1]] = np.where(valid, self.units[rows, columns], 0)
+        self.expiry, self.units = expiry, units
+        self.head[:] = 0
+
+
+    def stock(self):
+        ''' Number of units of every row currently in stock '''
+        columns, valid = self.__positions()
+        rows = np.arange(self.n_rows)[:, None]
+        return np.where(valid, np.maximum(self.units[rows, columns], 0), 0).sum(axis=1)
+
+
+    def add(self, rows, expiry, units):
+        ''' Append batches (row, expiry in epoch seconds, units) at the end of the row queues '''
+        rows = np.atleast_1d(rows).astype(np.int64)
+        rank = rank_within_groups(rows)
+        needed = (self.count[rows] + rank + 1).max() if len(rows) > 0 else 0
+        if needed > self.expiry.shape[1]:
+            self.__grow(max(2 * self.expiry.shape[1], needed))
+        columns = (self.head[rows] + self.count[rows] + rank) % self.expiry.shape[1]
+        self.expiry[rows, columns] = expiry
+        self.units[rows, columns] = units
+        self.count += np.bincount(rows, minlength=self.n_rows)
+
+
+    def add_to_all(self, products, expiry, units):
+        ''' Append the same batches (product index, expiry, units) to the inventory of every policy '''
+        n_policies = len(self.policies)
+        rows = self.rows(np.arange(n_policies)[:, None], np.asarray(products, dtype=np.int64)[None, :]).ravel()
+        self.add(rows, np.tile(expiry, n_policies), np.tile(units, n_policies))
+
+
+    def remove(self, n):
+        ''' Remove n[r] units of every row r first-in first-out, dropping the batches that run out '''
+        columns, valid = self.__positions()
+        rows = np.arange(self.n_rows)
+        units = np.where(valid, self.units[rows[:, None], columns], 0)
+        removed = np.cumsum(np.maximum(units, 0), axis=1)
+
+        # batches used up entirely, then the first remaining batch of each product gives away the rest
+        emptied = valid & (removed <= n[:, None]) & (n[:, None] > 0)
+        n_emptied = emptied.sum(axis=1)
+        partial = np.flatnonzero((n_emptied < self.count) & (n > 0))
+        first = n_emptied[partial]
+        self.units[partial, columns[partial, first]] = removed[partial, first] - n[partial]
+
+        self.head = (self.head + n_emptied) % self.expiry.shape[1]
+        self.count -= n_emptied
+
+
+    def expire(self, date):
+        ''' Remove all batches expiring on or before the date (epoch seconds).
+            Returns rows, expiry and units of the removed batches '''
+        columns, valid = self.__positions()
+        rows = np.arange(self.n_rows)[:, None]
+        expiry = self.expiry[rows, columns]
+        units = self.units[rows, columns]
+        expired = valid & (expiry <= date)
+        spoiled = np.nonzero(expired)
+        spoiled_batches = (spoiled[0], expiry[spoiled], units[spoiled])
+
+        # keep the remaining batches in order, packed at the start of the rows that lost a batch
+        affected = np.flatnonzero(expired.any(axis=1))
+        if len(affected) > 0:
+            keep = valid[affected] & ~expired[affected]
+            order = np.argsort(~keep, axis=1, kind='mergesort')
+            affected_rows = np.arange(len(affected))[:, None]
+            self.expiry[affected] = expiry[affected][affected_rows, order]
+            self.units[affected] = units[affected][affected_rows, order]
+            self.head[affected] = 0
+            self.count[affected] = keep.sum(axis=1)
+        return spoiled_batches
+
+
+    def batches(self):
+        ''' Rows, expiry and units of all batches in stock, ordered by row and FIFO position '''
+        columns, valid = self.__positions()
+        rows = np.arange(self.n_rows)[:, None]
+        current = np.nonzero(valid)
+        return current[0], self.expiry[rows, columns][current], self.units[rows, columns][current]
 
 
     def end_of_day(self):
-        ''' Remove expired products, write inventory record, and reset daily event tallies '''
+        ''' Remove expired products, write inventory and spoilage records, and reset daily event tallies.
+            Returns the inventory and spoilage summaries of every policy '''
         time_elapsed = pd.to_timedelta('1 days')
-        current_write_date = self.last_write_date + time_elapsed
-        self.last_write_date = current_write_date
+        self.last_write_date = self.last_write_date + time_elapsed
 
         ''' Remove any products now expired '''
-        self.spoilages = sum([i[1] for i in self.inventory if i[0] <= self.last_write_date])
-        self.spoilages_details = [i for i in self.inventory if i[0] <= self.last_write_date] 
-        self.inventory = [i for i in self.inventory if i[0] > self.last_write_date]
-
-        if len(self.spoilages_details) > 0:
-            neg = [u[1] for u in self.spoilages_details if u[1] <= 0]
-
-        spoilages_summary = self.write_spoilage_summary()
+        spoiled_rows, spoiled_expiry, spoiled_units = self.expire(to_epoch(self.last_write_date))
+        self.spoilages = np.bincount(spoiled_rows, weights=spoiled_units, minlength=self.n_rows).astype(np.int64)
+        spoiled = self.__group_batches(spoiled_rows, spoiled_expiry, spoiled_units)
 
         ''' Write and reset sale/loss/arrival tallies '''
-        inventory_summary = self.write_inventory_summary()
-        self.arrivals = 0
-        self.sales = 0
-        self.losses = 0
-        self.spoilages = 0
-        return inventory_summary, spoilages_summary
-
+        current = self.__group_batches(*self.batches())
+        summaries = []
+        for first in range(0, self.n_rows, len(self.product_ids)):
+            rows = range(first, first + len(self.product_ids))
+            inventory_summaries = [{'ProductID': str(self.product_ids[row - first]),
+                                    'Arrivals': int(self.arrivals[row]),
+                                    'Sales': int(self.sales[row]),
+                                    'Losses': int(self.losses[row]),
+                                    'Spoilages': int(self.spoilages[row]),
+                                    'CurrentInventory': current[row]} for row in rows]
+            spoilage_summaries = [{'ProductID': str(self.product_ids[row - first]), 'CurrentSpoilages': spoiled[row]}
+                                  for row in rows if len(spoiled[row]) > 0]
+            summaries.append((inventory_summaries, spoilage_summaries))
+        self.arrivals[:] = 0
+        self.sales[:] = 0
+        self.losses[:] = 0
+        self.spoilages[:] = 0
+        return summaries
+
+
+    def __group_batches(self, rows, expiry, units):
+        ''' Create JSONable descriptions of batches, grouped by row '''
+        expiry = epoch_to_string(expiry).tolist()
+        units = units.tolist()
+        bounds = np.searchsorted(rows, np.arange(self.n_rows + 1))
+        return [[{'ExpiryDateTime': expiry[i], 'Units': units[i]} for i in range(bounds[row], bounds[row + 1])]
+                for row in range(self.n_rows)]
+
+
+def simulate_store(description, store_id, days=[]):
+    ''' Simulate one store on the date of the description, then on each of the backfill days (date, demand of the store).
+        Runs in a worker process when stores are simulated in parallel '''
+    worker = description.adl is None
+    if worker:
+        description.adl = connect_adl()
+    print(store_id)
+    my_store = Store(description, store_id)
+    my_store.run()
+    for date, demand_df in days:
+        my_store.advance(date, demand_df)
+        my_store.run()
+    my_store.save_state()
+    if worker:
+        description.adl.flush()
+    return my_store.columnar
+
+
+def write_columnar_output(description, outputs):
+    ''' Write the Parquet records collected from the stores, one file per dataset and date '''
+    merged = {}
+    for output in outputs:
+        for key, frames in output.items():
+            merged.setdefault(key, []).extend(frames)
+    for (dataset, partition_date), frames in sorted(merged.items()):
+        write_columnar(description.adl, description.hierarchy['RawDataFolder'], dataset, partition_date, frames)
+
+
+def run_stores(description, store_ids, workers, days=[]):
+    ''' Simulate the stores one after another, or fan them out to a pool of worker processes.
+        Every store-day draws from its own random streams, so the output does not depend on the number of workers.
+        days are the further (date, demand) of a backfill, simulated after the date of the description '''
+    def store_days(store_id):
+        return [(date, demand_df.loc[demand_df.StoreID == store_id]) for date, demand_df in days]
+
+    if workers <= 1:
+        outputs = [simulate_store(description.for_store(store_id), store_id, store_days(store_id)) for store_id in store_ids]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(simulate_store, description.for_store(store_id), store_id, store_days(store_id))
+                       for store_id in store_ids]
+            outputs = [future.result() for future in futures]
+    write_columnar_output(description, outputs)
+    description.adl.flush()
+
+
+def backfill(description, last_date, workers):
+    ''' Simulate every day from the date of the description up to last_date in one process, writing the same files as
+        one run per day. Prices and demand forecasts are generated day after day first (each day builds on the
+        horizon of the previous one), then every store runs through all the days keeping its state in memory '''
+    description.get_prices()
+    description.get_demand()
+    first_day = description.copy()
 
-    def add_inventory(self, expiration_date, units):
-        self.inventory.append([expiration_date, units])
-           
+    days = []
+    date = pd.to_datetime(description.today_date) + pd.to_timedelta('1 days')
+    while date <= pd.to_datetime(last_date):
+        print('Backfill: {}'.format(date))
+        description.advance(date.strftime('%Y-%m-%d %H:%M:%S'))
+        description.get_prices()
+        description.get_demand()
+        # the stores only need the demand of the dates simulated on that day
+        demand_df = description.demand_df
+        days.append((description.today_date, demand_df.loc[(demand_df['DateTime'] >= pd.to_datetime(description.hierarchy['InitialDate'])) &
+                                                           (demand_df['DateTime'] < pd.to_datetime(description.today_date))]))
+        date += pd.to_timedelta('1 days')
 
-    def write_spoilage_summary(self):
-        spoilage_dict = {}
-        spoilage_dict['ProductID'] = str(self.product_id)
-        current_spoilages = []
-        for i in self.spoilages_details:
-            entry_dict = {}
-            entry_dict['ExpiryDateTime'] = str(i[0])
-            entry_dict['Units'] = int(i[1])
-            current_spoilages.append(entry_dict)
-        spoilage_dict['CurrentSpoilages'] = current_spoilages
-        return spoilage_dict
-
-
-    def write_inventory_summary(self):
-        ''' Create a JSONable description of the inventory on this date '''
-        inventory_dict = {}
-        inventory_dict['ProductID'] = str(self.product_id)
-        inventory_dict['Arrivals'] = int(self.arrivals)
-        inventory_dict['Sales'] = int(self.sales)
-        inventory_dict['Losses'] = int(self.losses)
-        inventory_dict['Spoilages'] = int(self.spoilages)
-        current_inventory = []
-        for i in self.inventory:
-            entry_dict = {}
-            entry_dict['ExpiryDateTime'] = str(i[0])
-            entry_dict['Units'] = int(i[1])
-            current_inventory.append(entry_dict)
-        inventory_dict['CurrentInventory'] = current_inventory
-        return inventory_dict
+    run_stores(first_day, first_day.demand_df['StoreID'].unique(), workers, days)
 
 
 if __name__ == '__main__':
 
     # define static data
     description = AttributeDescription()
-    description.get_prices()
-    description.get_demand()
-    store_ids = description.demand_df['StoreID'].unique()
-    for store_id in store_ids:
-        print(store_id)
-        my_store = Store(description, store_id)
-        my_store.run()
+    if backfill_date is not None:
+        backfill(description, backfill_date, n_workers)
+    else:
+        description.get_prices()
+        description.get_demand()
+        store_ids = description.demand_df['StoreID'].unique()
+        run_stores(description, store_ids, n_workers)
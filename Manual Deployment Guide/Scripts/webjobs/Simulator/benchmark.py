@@ -0,0 +1,173 @@
+#Benchmark of the data simulator: builds synthetic hierarchies of several sizes against an in-memory store (no Azure
+#Data Lake Store credentials needed), simulates them, and reports the time (and optionally the memory) of every phase as JSON.
+#
+#   python benchmark.py [-s small,medium] [-c sim,shipped] [-n <stores simulated>] [-d <days simulated>] [-o <results file>] [-m]
+#
+#-c selects the policy configurations: 'sim' keeps a single inventory, 'shipped' one inventory for each policy active in the
+#shipped Configurations.xlsx.
+#-m also traces the peak memory of every phase (PeakBytes) with tracemalloc, which makes the run several times slower;
+#without it the phases report no PeakBytes.
+
+#
+# Copyright © Microsoft Corporation (“Microsoft”).
+#
+# Microsoft grants you the right to use this software in accordance with your subscription agreement, if any, to use software
+# provided for use with Microsoft Azure (“Subscription Agreement”).  All software is licensed, not sold.
+#
+# If you do not have a Subscription Agreement, or at your option if you so choose, Microsoft grants you a nonexclusive, perpetual,
+# royalty-free right to use and modify this software solely for your internal business purposes in connection with Microsoft Azure
+# and other Microsoft products, including but not limited to, Microsoft R Open, Microsoft R Server, and Microsoft SQL Server.
+#
+# Unless otherwise stated in your Subscription Agreement, the following applies.  THIS SOFTWARE IS PROVIDED “AS IS” WITHOUT
+# WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL MICROSOFT OR ITS LICENSORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THE SAMPLE CODE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys, os, json, time, getopt, platform, tracemalloc, contextlib
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+os.environ['STORAGE_BACKEND'] = 'memory'  # read by storage.connect when the simulator connects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))  # storage.py in the repository
+
+benchmark_date = '2017-01-15 00:00:00'
+
+# InventoryPolicyConfig sheets used instead of Configurations.xlsx: the orders placed by the simulator belong to the Sim policy
+benchmark_configurations = {
+    'sim': pd.DataFrame({'InventoryPolicyName': ['Sim'], 'DirectoryName': ['sim'], 'ActiveFlag': [1]}),
+    'shipped': pd.DataFrame({'InventoryPolicyName': ['s_Q', 's_Q_perishable', 'Sim'], 'DirectoryName': ['sQ', 'sQperishable', 'Sim'],
+                             'ActiveFlag': [1, 1, 0]})}
+
+
+class PhaseRecorder:
+    ''' Time and memory of the phases of a run, summed over the calls of each phase.
+        Memory is the peak size of the blocks allocated by Python (numpy buffers included) since the phase, or the last
+        phase nested in it, started. Tracing memory slows the run down: times are only comparable between runs that
+        both trace memory, or both do not '''
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.nested_peaks = []  # highest peak of the phases nested in each running phase
+
+    def __peak(self):
+        return tracemalloc.get_traced_memory()[1] if self.trace_memory else 0
+
+    def measure(self, name, function, *args):
+        ''' Call function, recording its time and memory under the phase name. Phases can be nested '''
+        if self.trace_memory:
+            if len(self.nested_peaks) > 0:
+                self.nested_peaks[-1] = max(self.nested_peaks[-1], self.__peak())
+            tracemalloc.clear_traces()  # also resets the peak
+        self.nested_peaks.append(0)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            peak = max(self.__peak(), self.nested_peaks.pop())
+            phase = self.phases.setdefault(name, {'Calls': 0, 'Seconds': 0.})
+            phase['Calls'] += 1
+            phase['Seconds'] += seconds
+            if self.trace_memory:
+                phase['PeakBytes'] = max(phase.get('PeakBytes', 0), peak)
+            if len(self.nested_peaks) > 0:
+                self.nested_peaks[-1] = max(self.nested_peaks[-1], peak)
+            if self.trace_memory:
+                tracemalloc.clear_traces()
+
+
+def run_scale(simulator, scale, configuration, n_stores, n_days, trace_memory):
+    ''' Generate a hierarchy of the given scale profile and simulate n_days days of its first n_stores stores
+        (all stores if None) under the named policy configuration '''
+    profile = simulator.scale_profiles[scale]
+    simulator.scale = scale
+    simulator.n_stores = profile['Stores']
+    simulator.n_brands = profile['Brands']
+    simulator.n_departments = profile['Departments']
+    simulator.n_suppliers = profile['Suppliers']
+    simulator.products_per_brand = profile['ProductsPerBrand']
+    simulator.n_storage_spaces = profile['StorageSpaces']
+
+    recorder = PhaseRecorder(trace_memory)
+    description = recorder.measure('AttributeDescription.__init__', simulator.AttributeDescription, benchmark_date,
+                                   benchmark_configurations[configuration])
+    # a new hierarchy starts the day before the simulated date: go further back to simulate more days
+    description.hierarchy['InitialDate'] = (datetime.strptime(benchmark_date, '%Y-%m-%d %H:%M:%S') -
+                                            timedelta(days=n_days)).strftime('%Y-%m-%d %H:%M:%S')
+    recorder.measure('get_prices', description.get_prices)
+    recorder.measure('get_demand', description.get_demand)
+
+    store_ids = description.demand_df['StoreID'].unique()[:n_stores]
+    for store_id in store_ids:
+        store = recorder.measure('Store.__init__', simulator.Store, description.for_store(store_id), store_id)
+        end_of_day = store.end_of_day
+        store.end_of_day = lambda current_date: recorder.measure('Store.end_of_day', end_of_day, current_date)
+        recorder.measure('Store.run', store.run)  # includes Store.end_of_day
+    recorder.measure('flush', description.adl.flush)  # files still being written in the background
+
+    return {'Scale': scale, 'Configuration': configuration, 'Stores': int(profile['Stores']), 'Products': int(description.hierarchy_index['brands_products'].shape[0]),
+            'StoresSimulated': int(len(store_ids)), 'DaysSimulated': n_days, 'Phases': recorder.phases}
+
+
+def main(argv):
+    scales = ['small', 'medium']
+    configurations = ['sim', 'shipped']
+    n_stores = None
+    n_days = 7
+    output_file = None
+    trace_memory = False
+
+    opts, args = getopt.getopt(argv, "s:c:n:d:o:m", ["scales=", "configurations=", "stores=", "days=", "output=", "memory"])
+    for opt, arg in opts:
+        if opt in ("-s", "--scales"):
+            scales = arg.split(',')
+        elif opt in ("-c", "--configurations"):
+            configurations = arg.split(',')
+        elif opt in ("-n", "--stores"):
+            n_stores = int(arg)
+        elif opt in ("-d", "--days"):
+            n_days = int(arg)
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt in ("-m", "--memory"):
+            trace_memory = True
+
+    # the simulator reads its own options from the command line when it is imported
+    sys.argv = sys.argv[:1]
+    import Simulator as simulator
+    for scale in scales:
+        if scale not in simulator.scale_profiles:
+            raise Exception('Unknown scale profile {}'.format(scale))
+    for configuration in configurations:
+        if configuration not in benchmark_configurations:
+            raise Exception('Unknown policy configuration {}'.format(configuration))
+
+    if trace_memory:
+        tracemalloc.start()
+    results = []
+    for scale in scales:
+        for configuration in configurations:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # the simulator reports its progress
+                results.append(run_scale(simulator, scale, configuration, n_stores, n_days, trace_memory))
+            print('{} ({}): {:.1f} s'.format(scale, configuration, sum(phase['Seconds'] for name, phase in results[-1]['Phases'].items()
+                                                                       if name != 'Store.end_of_day')), file=sys.stderr)
+
+    report = {'Date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'Python': platform.python_version(),
+              'NumPy': np.__version__, 'pandas': pd.__version__, 'TraceMemory': trace_memory, 'Results': results}
+    report_string = json.dumps(report, sort_keys=True, indent=4, separators=(',', ': '))
+    if output_file is None:
+        print(report_string)
+    else:
+        with open(output_file, 'w') as f:
+            f.write(report_string)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -32,9 +32,10 @@ if __name__ == '__main__':
     task_script= scripts_adl_dir +'/inventory_optimization_task.py'
     upload_script = scripts_adl_dir +'/upload_to_adls.py'
     mipcl_script = scripts_adl_dir +'/mipcl_wrapper.py'
+    storage_script = scripts_adl_dir +'/storage.py'
     policy_script = scripts_adl_dir + '/' + policy_adl_subdir + '/' + policy_script
 
-    file_list = [task_script,upload_script,mipcl_script,policy_script]
+    file_list = [task_script,upload_script,mipcl_script,storage_script,policy_script]
 
     scripts_local_path =  '/taskscripts/'
 
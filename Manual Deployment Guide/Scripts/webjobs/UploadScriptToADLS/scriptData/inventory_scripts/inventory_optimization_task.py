@@ -4,7 +4,7 @@ import argparse
 import collections
 import os
 import string
-from azure.datalake.store import core, lib, multithread
+import storage
 
 import sys, subprocess, time
 import numpy
@@ -24,7 +24,7 @@ def download_from_adls(adl, short_filename, filename):
     download_succeeded = False
     for i in arange(n_download_retries):
         try:
-            multithread.ADLDownloader(adl, lpath = short_filename, rpath = filename, overwrite=True)
+            adl.download(filename, short_filename)
         except BaseException as e:
             logger.error('Failed to download the file ' + short_filename + ': ' + str(e), exc_info=True)
             time.sleep(30)
@@ -192,9 +192,9 @@ if __name__ == '__main__':
  
     adl_client_start_time = time.time()
 
-    # create ADLS client    
-    adl_token = lib.auth(tenant_id=args.adl_tenant_id, client_id=args.adl_client_id, client_secret=args.adl_client_secret)
-    adls_file_system_client = core.AzureDLFileSystem(adl_token, store_name=args.adl_name)
+    # create storage client (Azure Data Lake Store unless STORAGE_BACKEND says otherwise)
+    adls_file_system_client = storage.connect(dict(os.environ, DATALAKESTORE_NAME=args.adl_name, TENANT_ID=args.adl_tenant_id,
+                                                   CLIENT_ID=args.adl_client_id, CLIENT_SECRET=args.adl_client_secret))
     print("Creating ADL client took" + " %s seconds." % (time.time() - adl_client_start_time))
 
     print("Started solving optimization problem")
@@ -212,8 +212,7 @@ if __name__ == '__main__':
 
     print('Uploading file {} to ADL folder [{}]...'.format(output_file, output_remote_dir_name))
 
-    multithread.ADLUploader(adls_file_system_client, lpath = output_file, 
-                            rpath = output_remote_dir_name + '/' + os.path.basename(output_file), overwrite=True)
+    adls_file_system_client.upload(output_file, output_remote_dir_name + '/' + os.path.basename(output_file))
     print("Uploading results took " + " %s seconds." % (time.time() - upload_result_start_time))
 
     print("Total time:" + " %s seconds." % (time.time() - start_time_all))
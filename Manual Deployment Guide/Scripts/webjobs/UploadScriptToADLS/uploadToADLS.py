@@ -25,17 +25,11 @@
 # https://docs.microsoft.com/en-us/azure/data-lake-store/data-lake-store-authenticate-using-active-directory#create-an-active-directory-application
 
 import sys, os, requests
-from azure.datalake.store import core, lib, multithread
+import storage
 import zipfile
 
 cwd = os.getcwd()
 
-#Azure DataLake Store Credentials
-_ADL_NAME = os.environ['DATALAKESTORE_NAME']
-_TENANT_ID = os.environ['TENANT_ID']
-_CLIENT_ID = os.environ['CLIENT_ID']
-_CLIENT_SECRET = os.environ['CLIENT_SECRET']
-
 #Web App credentials
 _WEB_APP_NAME = os.environ['FUNCTIONS_APP_NAME']
 _WEB_APP_USER = os.environ['FUNCTIONS_APP_USER']
@@ -52,11 +46,12 @@ print('Webjob ' + webjob_name + ' started.')
 
 #Uploading Script Data to Azure DataLake Store
 dir_list = next(os.walk('.'+'\\scriptData\\'))[1]
-token = lib.auth(tenant_id=_TENANT_ID, client_id=_CLIENT_ID, client_secret=_CLIENT_SECRET)
-adls_file_system_client = core.AzureDLFileSystem(token, store_name=_ADL_NAME)
+#Azure DataLake Store credentials are read from DATALAKESTORE_NAME, TENANT_ID, CLIENT_ID and CLIENT_SECRET
+adl = storage.connect()
 
 for dir in dir_list:
     local_path=cwd+'\\scriptData\\'+dir
     print('Uploading ' +local_path)
-    remote_path=dir+'\\'
-    multithread.ADLUploader(adls_file_system_client, lpath=local_path , rpath= remote_path,overwrite=True)
\ No newline at end of file
+    remote_path=dir+'/'
+    adl.upload(local_path, remote_path)
+adl.flush()
\ No newline at end of file
@@ -27,7 +27,7 @@
 
 import sys, os
 
-from azure.datalake.store import core, lib, multithread
+import storage
 import zipfile
 
 cwd = os.getcwd()
@@ -39,24 +39,20 @@ zip_ref.extractall()
 zip_ref.close()
 
 
-#Azure DataLake Store Credentials
-_ADL_NAME = os.environ['DATALAKESTORE_NAME']
-_TENANT_ID = os.environ['TENANT_ID']
-_CLIENT_ID = os.environ['CLIENT_ID']
-_CLIENT_SECRET = os.environ['CLIENT_SECRET']
+#Azure DataLake Store credentials are read from DATALAKESTORE_NAME, TENANT_ID, CLIENT_ID and CLIENT_SECRET
+adl = storage.connect()
 
 
 #localPath='D:\\home\\site\\wwwroot\\app_data\\jobs\\triggered\\uploadStaticData\\staticData\\'
 
 dir_list = next(os.walk('.'+'\\staticData\\'))[1]
-token = lib.auth(tenant_id=_TENANT_ID, client_id=_CLIENT_ID, client_secret=_CLIENT_SECRET)
-adls_file_system_client = core.AzureDLFileSystem(token, store_name=_ADL_NAME)
 
 for dir in dir_list:
     local_path=cwd+'\\staticData\\'+dir
     print(local_path)
-    remote_path=dir+'\\'
-    multithread.ADLUploader(adls_file_system_client, lpath=local_path , rpath= remote_path,overwrite=True)
+    remote_path=dir+'/'
+    adl.upload(local_path, remote_path)
+adl.flush()
 
 
 #Update the Schedule file to Main webjob, so that it starts after all the static data is uploaded
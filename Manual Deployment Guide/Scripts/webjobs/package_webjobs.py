@@ -0,0 +1,91 @@
+#Builds the deployment archive (<webjob>.zip) of webjobs from their folders, adding the modules of the shared folder
+#(storage.py) to every webjob that uses them, so that the repository keeps a single copy of each.
+#
+#   python package_webjobs.py [<webjob> ...]
+#
+#Without arguments, the archives checked in next to the webjob folders are rebuilt. The archive of UploadStaticDataToADLS
+#is not part of the repository, as the static data it uploads (staticData.zip) is not: put staticData.zip in its folder,
+#then run python package_webjobs.py UploadStaticDataToADLS.
+
+#
+# Copyright © Microsoft Corporation (“Microsoft”).
+#
+# Microsoft grants you the right to use this software in accordance with your subscription agreement, if any, to use software
+# provided for use with Microsoft Azure (“Subscription Agreement”).  All software is licensed, not sold.
+#
+# If you do not have a Subscription Agreement, or at your option if you so choose, Microsoft grants you a nonexclusive, perpetual,
+# royalty-free right to use and modify this software solely for your internal business purposes in connection with Microsoft Azure
+# and other Microsoft products, including but not limited to, Microsoft R Open, Microsoft R Server, and Microsoft SQL Server.
+#
+# Unless otherwise stated in your Subscription Agreement, the following applies.  THIS SOFTWARE IS PROVIDED “AS IS” WITHOUT
+# WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL MICROSOFT OR ITS LICENSORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THE SAMPLE CODE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys, os, zipfile
+
+webjobs_folder = os.path.dirname(os.path.abspath(__file__))
+shared_folder = os.path.join(webjobs_folder, 'shared')
+shared_modules = ['storage.py']
+
+# folders of each archive that receive the shared modules; inventory_scripts is uploaded for the optimization tasks
+shared_targets = {
+    'Evaluation': ['Evaluation'],
+    'GenerateOrder': ['GenerateOrder'],
+    'InstallPackages': [],
+    'InventoryOptimization': ['InventoryOptimization'],
+    'Main': ['Main'],
+    'Simulator': ['Simulator'],
+    'UploadScriptToADLS': ['UploadScriptToADLS', 'UploadScriptToADLS/scriptData/inventory_scripts'],
+    'UploadStaticDataToADLS': ['UploadStaticDataToADLS'],
+}
+
+excluded_folders = ['__pycache__']
+excluded_extensions = ['.pyc']
+crlf_extensions = ['.cmd']  # run by cmd.exe on the App Service
+archive_date = (1980, 1, 1, 0, 0, 0)  # the same content always gives the same archive
+
+
+def archive_files(webjob):
+    ''' Local file of every name of the archive of a webjob: the files of its folder, then the shared modules '''
+    files = {}
+    for folder, folders, names in os.walk(os.path.join(webjobs_folder, webjob)):
+        folders[:] = [name for name in folders if name not in excluded_folders]
+        for name in names:
+            if os.path.splitext(name)[1] not in excluded_extensions:
+                path = os.path.join(folder, name)
+                files[os.path.relpath(path, webjobs_folder).replace(os.sep, '/')] = path
+    for target in shared_targets[webjob]:
+        for module in shared_modules:
+            files['{}/{}'.format(target, module)] = os.path.join(shared_folder, module)
+    return files
+
+
+def package(webjob):
+    ''' Write <webjob>.zip next to the folder of the webjob '''
+    files = archive_files(webjob)
+    with zipfile.ZipFile(os.path.join(webjobs_folder, webjob + '.zip'), 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(files):
+            with open(files[name], 'rb') as f:
+                content = f.read()
+            if os.path.splitext(name)[1] in crlf_extensions:
+                content = content.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+            info = zipfile.ZipInfo(name, date_time=archive_date)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, content)
+    return len(files)
+
+
+if __name__ == '__main__':
+    webjobs = sys.argv[1:]
+    if len(webjobs) == 0:
+        webjobs = [webjob for webjob in sorted(shared_targets) if os.path.exists(os.path.join(webjobs_folder, webjob + '.zip'))]
+    for webjob in webjobs:
+        if webjob not in shared_targets:
+            raise Exception('Unknown webjob {}'.format(webjob))
+        print('{}.zip: {} files'.format(webjob, package(webjob)))
@@ -0,0 +1,478 @@
+#This module hides the file system used by the webjobs behind a small interface (the subset of AzureDLFileSystem
+#they use), so that the same code runs against Azure Data Lake Store, a local directory or memory.
+#The backend is chosen with the STORAGE_BACKEND environment variable: adl (default), local or memory.
+#PipelinedStorage wraps any of them to write files in the background.
+#This file is the only copy in the repository: package_webjobs.py adds it to the archive of every webjob that uses it
+#(and to the scripts uploaded for the optimization tasks). To run a webjob from its folder, put this folder on PYTHONPATH.
+
+#
+# Copyright © Microsoft Corporation (“Microsoft”).
+#
+# Microsoft grants you the right to use this software in accordance with your subscription agreement, if any, to use software
+# provided for use with Microsoft Azure (“Subscription Agreement”).  All software is licensed, not sold.
+#
+# If you do not have a Subscription Agreement, or at your option if you so choose, Microsoft grants you a nonexclusive, perpetual,
+# royalty-free right to use and modify this software solely for your internal business purposes in connection with Microsoft Azure
+# and other Microsoft products, including but not limited to, Microsoft R Open, Microsoft R Server, and Microsoft SQL Server.
+#
+# Unless otherwise stated in your Subscription Agreement, the following applies.  THIS SOFTWARE IS PROVIDED “AS IS” WITHOUT
+# WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL MICROSOFT OR ITS LICENSORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THE SAMPLE CODE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, io, time, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Storage:
+    ''' File system used by the webjobs. Paths are '/'-separated and relative to the root of the store '''
+
+    def open(self, path, mode='rb', blocksize=2 ** 25):
+        ''' Open a file in binary mode ('rb', 'wb' or 'ab'). Folders are created on write '''
+        raise NotImplementedError
+
+    def exists(self, path):
+        ''' Whether a file or folder exists '''
+        raise NotImplementedError
+
+    def info(self, path):
+        ''' Metadata of a file: dictionary with its 'length' (bytes) and 'modificationTime' (milliseconds since the epoch) '''
+        raise NotImplementedError
+
+    def ls(self, path):
+        ''' Paths of the files and folders directly under a folder '''
+        raise NotImplementedError
+
+    def walk(self, path):
+        ''' Paths of all the files under a folder '''
+        raise NotImplementedError
+
+    def mkdir(self, path):
+        ''' Create a folder and its parents '''
+        raise NotImplementedError
+
+    def rm(self, path, recursive=False):
+        ''' Remove a file, or a folder with recursive=True '''
+        raise NotImplementedError
+
+    def download(self, rpath, lpath):
+        ''' Copy a file of the store to a local file, or into a local folder '''
+        raise NotImplementedError
+
+    def upload(self, lpath, rpath):
+        ''' Copy a local file to the store, or a local folder and everything under it '''
+        raise NotImplementedError
+
+    def reconnect(self):
+        ''' Renew the credentials used to access the store, if any '''
+        pass
+
+    def flush(self):
+        ''' Wait until every file written is stored '''
+        pass
+
+
+def local_target(lpath, rpath):
+    ''' Local file name of a download: lpath itself, or the file name of rpath inside the folder lpath '''
+    if os.path.isdir(lpath):
+        return os.path.join(lpath, rpath.rstrip('/').split('/')[-1])
+    return lpath
+
+
+def local_files(lpath, rpath):
+    ''' (local file, remote path) of the files of an upload: lpath itself, or every file under the folder lpath '''
+    if not os.path.isdir(lpath):
+        return [(lpath, rpath)]
+    files = []
+    for folder, _, names in os.walk(lpath):
+        relative = os.path.relpath(folder, lpath).replace(os.sep, '/')
+        prefix = rpath.rstrip('/') if relative == '.' else rpath.rstrip('/') + '/' + relative
+        files += [(os.path.join(folder, name), prefix + '/' + name) for name in sorted(names)]
+    return files
+
+
+class ADLStorage(Storage):
+    ''' Azure Data Lake Store '''
+
+    def __init__(self, store_name, tenant_id, client_id, client_secret):
+        self.store_name = store_name
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.adl = None
+        self.reconnect()
+
+    def __getstate__(self):
+        # the client is not picklable; worker processes connect again
+        state = dict(self.__dict__)
+        state['adl'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reconnect()
+
+    def reconnect(self):
+        from azure.datalake.store import core, lib
+        try:
+            token = lib.auth(tenant_id=self.tenant_id, client_id=self.client_id, client_secret=self.client_secret)
+            self.adl = core.AzureDLFileSystem(token=token, store_name=self.store_name)
+        except Exception as e:
+            raise Exception('Error while attempting to connect to Azure Data Lake Store:\n{}'.format(e))
+
+    def open(self, path, mode='rb', blocksize=2 ** 25):
+        return self.adl.open(path, mode, blocksize=blocksize)
+
+    def exists(self, path):
+        return self.adl.exists(path)
+
+    def info(self, path):
+        return self.adl.info(path)
+
+    def ls(self, path):
+        return self.adl.ls(path)
+
+    def walk(self, path):
+        return self.adl.walk(path)
+
+    def mkdir(self, path):
+        self.adl.mkdir(path)
+
+    def rm(self, path, recursive=False):
+        self.adl.rm(path, recursive=recursive)
+
+    def download(self, rpath, lpath):
+        from azure.datalake.store import multithread
+        multithread.ADLDownloader(self.adl, lpath=lpath, rpath=rpath, overwrite=True)
+
+    def upload(self, lpath, rpath):
+        from azure.datalake.store import multithread
+        multithread.ADLUploader(self.adl, lpath=lpath, rpath=rpath, overwrite=True)
+
+
+class LocalStorage(Storage):
+    ''' Folder of the local (POSIX or Windows) file system '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def local_path(self, path):
+        return os.path.join(self.root, *[part for part in path.split('/') if part])
+
+    def open(self, path, mode='rb', blocksize=2 ** 25):
+        local_path = self.local_path(path)
+        if 'r' not in mode:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return open(local_path, mode)
+
+    def exists(self, path):
+        return os.path.exists(self.local_path(path))
+
+    def info(self, path):
+        status = os.stat(self.local_path(path))
+        return {'length': status.st_size, 'modificationTime': int(status.st_mtime * 1000)}
+
+    def ls(self, path):
+        return [path.rstrip('/') + '/' + name for name in sorted(os.listdir(self.local_path(path)))]
+
+    def walk(self, path):
+        files = []
+        for folder, _, names in os.walk(self.local_path(path)):
+            relative = os.path.relpath(folder, self.local_path(path)).replace(os.sep, '/')
+            prefix = path.rstrip('/') if relative == '.' else path.rstrip('/') + '/' + relative
+            files += [prefix + '/' + name for name in sorted(names)]
+        return files
+
+    def mkdir(self, path):
+        os.makedirs(self.local_path(path), exist_ok=True)
+
+    def rm(self, path, recursive=False):
+        local_path = self.local_path(path)
+        if os.path.isdir(local_path):
+            if recursive:
+                shutil.rmtree(local_path)
+            else:
+                os.rmdir(local_path)
+        else:
+            os.remove(local_path)
+
+    def download(self, rpath, lpath):
+        shutil.copyfile(self.local_path(rpath), local_target(lpath, rpath))
+
+    def upload(self, lpath, rpath):
+        for local_file, remote_path in local_files(lpath, rpath):
+            local_path = self.local_path(remote_path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            shutil.copyfile(local_file, local_path)
+
+
+class MemoryFile(io.BytesIO):
+    ''' File of a MemoryStorage: the content is stored when the file is closed '''
+
+    def __init__(self, storage, path, content):
+        io.BytesIO.__init__(self)
+        self.storage = storage
+        self.path = path
+        self.write(content)
+
+    def close(self):
+        if not self.closed:
+            with self.storage.lock:
+                self.storage.files[self.path] = self.getvalue()
+                self.storage.touch(self.path)
+        io.BytesIO.close(self)
+
+
+class MemoryStorage(Storage):
+    ''' Store kept in memory, for tests and benchmarks. Not shared between processes '''
+
+    def __init__(self):
+        self.files = {}
+        self.folders = set()
+        self.times = {}  # modification time of every file: a write counter, so that successive writes always differ
+        self.clock = 0
+        self.lock = threading.Lock()
+
+    def touch(self, key):
+        self.clock += 1
+        self.times[key] = self.clock
+
+    @staticmethod
+    def key(path):
+        return '/'.join(part for part in path.split('/') if part)
+
+    def open(self, path, mode='rb', blocksize=2 ** 25):
+        key = self.key(path)
+        if 'r' in mode:
+            if key not in self.files:
+                raise FileNotFoundError(path)
+            return io.BytesIO(self.files[key])
+        return MemoryFile(self, key, self.files.get(key, b'') if 'a' in mode else b'')
+
+    def names(self):
+        ''' Files and folders stored, as a snapshot that other threads may change afterwards '''
+        with self.lock:
+            return list(self.files), list(self.folders)
+
+    def exists(self, path):
+        key = self.key(path)
+        files, folders = self.names()
+        return key in files or key in folders or any(name.startswith(key + '/') for name in files)
+
+    def info(self, path):
+        key = self.key(path)
+        if key not in self.files:
+            raise FileNotFoundError(path)
+        return {'length': len(self.files[key]), 'modificationTime': self.times[key]}
+
+    def ls(self, path):
+        key = self.key(path)
+        children = set()
+        files, folders = self.names()
+        for name in files + folders:
+            if name.startswith(key + '/'):
+                children.add(name[len(key) + 1:].split('/')[0])
+        return [path.rstrip('/') + '/' + child for child in sorted(children)]
+
+    def walk(self, path):
+        key = self.key(path)
+        return [path.rstrip('/') + name[len(key):] for name in sorted(self.names()[0]) if name.startswith(key + '/')]
+
+    def mkdir(self, path):
+        with self.lock:
+            self.folders.add(self.key(path))
+
+    def rm(self, path, recursive=False):
+        key = self.key(path)
+        with self.lock:
+            if key in self.files:
+                del self.files[key]
+                del self.times[key]
+                return
+            for name in [name for name in self.files if name.startswith(key + '/')]:
+                if not recursive:
+                    raise OSError('Folder is not empty: {}'.format(path))
+                del self.files[name]
+                del self.times[name]
+            self.folders = set(name for name in self.folders if name != key and not name.startswith(key + '/'))
+
+    def download(self, rpath, lpath):
+        with open(local_target(lpath, rpath), 'wb') as f:
+            f.write(self.files[self.key(rpath)])
+
+    def upload(self, lpath, rpath):
+        for local_file, remote_path in local_files(lpath, rpath):
+            with open(local_file, 'rb') as f:
+                content = f.read()
+            with self.lock:
+                self.files[self.key(remote_path)] = content
+                self.touch(self.key(remote_path))
+
+
+class PendingFile(io.BytesIO):
+    ''' File written through a PipelinedStorage: the content is queued for upload when the file is closed '''
+
+    def __init__(self, storage, path, mode):
+        io.BytesIO.__init__(self)
+        self.storage = storage
+        self.path = path
+        self.mode = mode
+
+    def close(self):
+        if not self.closed:
+            self.storage.enqueue(self.path, self.mode, self.getvalue())
+        io.BytesIO.close(self)
+
+
+class PipelinedStorage(Storage):
+    ''' Storage whose files are written in the background by a pool of uploader threads, so that the caller does not
+        wait on a round trip per file. Writes to the same path are applied in order, and every operation on a path
+        first waits for the pending writes of the path and of the files under it. A write is retried with growing
+        pauses before it fails; an append is only retried if the file still has the length it had before the append.
+        Failures are raised by flush, the barrier to call before the files are used elsewhere. At most max_pending
+        files are queued, so that writers block instead of filling the memory '''
+
+    def __init__(self, storage, n_uploaders=8, max_pending=64, retries=3, retry_delay=1.0):
+        self.storage = storage
+        self.n_uploaders = n_uploaders
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.start()
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.n_uploaders)
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.pending = {}  # last write queued for each path
+        self.errors = []
+
+    def __getstate__(self):
+        # threads are not picklable; pending writes stay with the original
+        return {name: self.__dict__[name] for name in ('storage', 'n_uploaders', 'max_pending', 'retries', 'retry_delay')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.start()
+
+    def enqueue(self, path, mode, content):
+        self.slots.acquire()
+        with self.lock:
+            previous = self.pending.get(path)
+            # a worker runs the previous write of the path before this one: it was queued first, so it is not waiting
+            self.pending[path] = self.executor.submit(self.upload_content, path, mode, content, previous)
+
+    def upload_content(self, path, mode, content, previous):
+        try:
+            if previous is not None:
+                previous.result()  # a write after a failed one is not applied either
+            offset = self.length(path) if 'a' in mode else None
+            for attempt in range(self.retries + 1):
+                try:
+                    if attempt > 0 and offset is not None and self.appended(path, offset, len(content)):
+                        return  # the failed attempt reached the file after all
+                    with self.storage.open(path, mode) as f:
+                        f.write(content)
+                    return
+                except Exception:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        except Exception as e:
+            with self.lock:
+                self.errors.append('{} ({}): {}'.format(path, mode, e))
+            raise
+        finally:
+            self.slots.release()
+
+    def length(self, path):
+        return self.storage.info(path)['length'] if self.storage.exists(path) else 0
+
+    def appended(self, path, offset, n_bytes):
+        ''' Whether an append of n_bytes at offset reached the file; raises if only part of it did '''
+        length = self.length(path)
+        if length not in (offset, offset + n_bytes):
+            raise IOError('{} of {} bytes appended at offset {}'.format(length - offset, n_bytes, offset))
+        return length != offset
+
+    def wait(self, path=None):
+        ''' Wait for the pending writes of a path and of the files under it, or of all paths '''
+        with self.lock:
+            if path is None:
+                pending = list(self.pending.items())
+            else:
+                folder = path.strip('/')
+                pending = [(key, future) for key, future in self.pending.items()
+                           if folder == '' or key.strip('/') == folder or key.strip('/').startswith(folder + '/')]
+        for key, future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass  # reported by flush
+            with self.lock:
+                if self.pending.get(key) is future:
+                    del self.pending[key]
+
+    def flush(self):
+        self.wait()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise IOError('Failed to write {} file(s):\n{}'.format(len(errors), '\n'.join(errors)))
+        self.storage.flush()
+
+    def open(self, path, mode='rb', blocksize=2 ** 25):
+        if 'r' not in mode:
+            return PendingFile(self, path, mode)
+        self.wait(path)
+        return self.storage.open(path, mode, blocksize=blocksize)
+
+    def exists(self, path):
+        self.wait(path)
+        return self.storage.exists(path)
+
+    def info(self, path):
+        self.wait(path)
+        return self.storage.info(path)
+
+    def ls(self, path):
+        self.wait(path)
+        return self.storage.ls(path)
+
+    def walk(self, path):
+        self.wait(path)
+        return self.storage.walk(path)
+
+    def mkdir(self, path):
+        self.storage.mkdir(path)
+
+    def rm(self, path, recursive=False):
+        self.wait(path)
+        self.storage.rm(path, recursive=recursive)
+
+    def download(self, rpath, lpath):
+        self.wait(rpath)
+        self.storage.download(rpath, lpath)
+
+    def upload(self, lpath, rpath):
+        self.wait(rpath)
+        self.storage.upload(lpath, rpath)
+
+    def reconnect(self):
+        self.storage.reconnect()
+
+
+def connect(environ=os.environ):
+    ''' Create the storage configured by the environment '''
+    backend = environ.get('STORAGE_BACKEND', 'adl').lower()
+    if backend == 'local':
+        return LocalStorage(environ.get('STORAGE_ROOT', '.'))
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend != 'adl':
+        raise ValueError('Unknown storage backend: {}'.format(backend))
+    return ADLStorage(environ['DATALAKESTORE_NAME'], environ['TENANT_ID'], environ['CLIENT_ID'], environ['CLIENT_SECRET'])
@@ -0,0 +1,70 @@
+#Tests of the webjobs, run from the webjobs folder with: python -m pytest tests
+#The webjobs import storage from the shared folder, as they do from their deployment archive (package_webjobs.py).
+
+import os, sys
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import pytest
+
+webjobs_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ['shared', 'Simulator', 'Evaluation']:
+    sys.path.insert(0, os.path.join(webjobs_folder, folder))
+
+import storage
+
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    ''' Storage in memory, returned by storage.connect() for the duration of the test '''
+    adl = storage.MemoryStorage()
+    monkeypatch.setattr(storage, 'connect', lambda environ=os.environ: adl)
+    return adl
+
+
+@pytest.fixture(scope='session')
+def simulator():
+    ''' The simulator module, imported without options (it reads the command line when imported) '''
+    argv = sys.argv
+    sys.argv = ['Simulator.py']
+    try:
+        import Simulator
+    finally:
+        sys.argv = argv
+    return Simulator
+
+
+@pytest.fixture
+def configurations():
+    ''' Policy configuration of the simulator runs: the simulated policy alone '''
+    return pd.DataFrame({'InventoryPolicyName': ['Sim'], 'DirectoryName': ['sim'], 'ActiveFlag': [1]})
+
+
+@pytest.fixture
+def simulate_day(simulator, configurations, monkeypatch):
+    ''' Run of the simulator on a date against the given storage, for the given stores (all by default) '''
+    def simulate(adl, date, store_ids=None):
+        monkeypatch.setattr(storage, 'connect', lambda environ=os.environ: adl)
+        description = simulator.AttributeDescription(date, configurations)
+        description.get_prices()
+        description.get_demand()
+        if store_ids is None:
+            store_ids = description.demand_df['StoreID'].unique()
+        simulator.run_stores(description, store_ids, 1)
+        return description
+    return simulate
+
+
+@pytest.fixture
+def stored_files():
+    ''' Content of every file of a MemoryStorage. Snapshots are compared by their arrays, without the modification
+        times of the orders files (write counters of the storage) '''
+    def files(adl):
+        content = {}
+        for name, data in adl.files.items():
+            if name.endswith('.npz'):
+                state = np.load(BytesIO(data), allow_pickle=False)
+                data = dict((array, state[array].tolist()) for array in state.files if array != 'OrderFileTime')
+            content[name] = data
+        return content
+    return files
@@ -0,0 +1,124 @@
+#Matching of sales to orders in the evaluation (OfflineEval.match_sales_to_orders and compute_metric), checked against
+#the row by row matching the evaluation used before, on random sales and orders.
+
+import numpy as np
+import pandas as pd
+
+import OfflineEval
+
+policies = ['Sim', 'sS', 's_Q']
+base_time = np.datetime64('2017-01-01T00:00:00')
+
+
+def random_orders(rng, n_orders, products, order_policies):
+    return pd.DataFrame({'PolicyID': rng.choice(order_policies, n_orders),
+                         'StoreID': '1',
+                         'ProductID': rng.choice(products, n_orders),
+                         'SupplierID': '1',
+                         'Quantity': rng.randint(-1, 5, n_orders),
+                         'OrderTimestamp': base_time,
+                         'ETA': base_time + rng.randint(0, 6, n_orders).astype('timedelta64[h]') * 12,
+                         'ConfidenceInterval': 0,
+                         'Fulfilled': False},
+                        columns=['PolicyID', 'StoreID', 'ProductID', 'SupplierID', 'Quantity', 'OrderTimestamp', 'ETA',
+                                 'ConfidenceInterval', 'Fulfilled'])
+
+
+def random_sales(rng, n_sales, products, sale_policies=None):
+    ''' Sales of one unit and spoilages (price 0) of several units; times and ETAs collide on purpose '''
+    spoilage = rng.rand(n_sales) < 0.25
+    sales = pd.DataFrame({'TransactionDateTime': base_time + rng.randint(0, 8, n_sales).astype('timedelta64[h]') * 12,
+                          'StoreID': 1,
+                          'ProductID': rng.choice(products, n_sales),
+                          'Units': np.where(spoilage, rng.randint(1, 6, n_sales), 1),
+                          'Price': np.where(spoilage, 0.0, rng.randint(1, 9, n_sales).astype(float))},
+                         columns=['TransactionDateTime', 'StoreID', 'ProductID', 'Units', 'Price'])
+    if sale_policies is not None:
+        sales.insert(0, 'PolicyID', rng.choice(sale_policies, n_sales))
+    return sales
+
+
+def reference_matching(sales, orders):
+    '''
+    The matching of the original evaluation: every sale, in time order and for every policy, takes one unit from the
+    first order by ETA of the same product that arrived before the sale and still has units left; a spoilage clears
+    up to its units from that order. Sales with a PolicyID are only matched to the orders of their policy.
+    Return the matched rows (sale, policy, ETA of the order, spoilage) and the remaining quantity of every order.
+    '''
+    orders = orders.sort_values(['PolicyID', 'ETA'], kind='mergesort')
+    quantity = orders['Quantity'].to_dict()
+    rows = []
+    for _, sale in sales.sort_values('TransactionDateTime', kind='mergesort').iterrows():
+        spoilage = sale['Price'] == 0
+        for policy_id in orders['PolicyID'].unique():
+            if 'PolicyID' in sales.columns and sale['PolicyID'] != policy_id:
+                continue
+            for index, order in orders.loc[orders['PolicyID'] == policy_id].iterrows():
+                if order['ProductID'] == sale['ProductID'] and quantity[index] > 0 and sale['TransactionDateTime'] > order['ETA']:
+                    quantity[index] = max(quantity[index] - sale['Units'], 0) if spoilage else quantity[index] - 1
+                    rows.append((sale['TransactionDateTime'], sale['ProductID'], sale['Units'], sale['Price'],
+                                 policy_id, order['ETA'], spoilage))
+                    break
+    return rows, [quantity[index] for index in sorted(quantity)]
+
+
+def matched_rows(sales_orders):
+    return list(zip(sales_orders['TransactionDateTime'], sales_orders['ProductID'], sales_orders['Units'],
+                    sales_orders['Price'], sales_orders['PolicyID'], sales_orders['OrderETA'], sales_orders['Spoilage']))
+
+
+def reference_metric(rows):
+    ''' Metric and total revenue of every policy from the matched rows, as the original evaluation computed them '''
+    metric, revenue = {}, {}
+    for sale_time, product_id, units, price, policy_id, eta, spoilage in rows:
+        days_to_sale = max((sale_time - pd.Timestamp(pd.Timestamp(eta).date())) / pd.Timedelta('1 days'), 1)
+        if spoilage:
+            days_to_sale *= units
+        metric[policy_id] = metric.get(policy_id, 0) + price / days_to_sale
+        revenue[policy_id] = revenue.get(policy_id, 0) + price
+    return metric, revenue
+
+
+def test_matching_is_the_matching_of_the_original_loop():
+    rng = np.random.RandomState(0)
+    for trial in range(100):
+        products = ['{}_1'.format(brand) for brand in range(1, rng.randint(2, 5))]
+        orders = random_orders(rng, rng.randint(0, 25), products, policies[:rng.randint(1, 4)])
+        sales = random_sales(rng, rng.randint(1, 40), products)
+        sales_orders, remaining = OfflineEval.match_sales_to_orders(sales, orders)
+        rows, quantity = reference_matching(sales, orders)
+        assert matched_rows(sales_orders) == rows, trial
+        assert remaining.tolist() == quantity, trial
+
+
+def test_policy_sales_are_matched_to_the_orders_of_their_policy():
+    rng = np.random.RandomState(1)
+    for trial in range(100):
+        products = ['{}_1'.format(brand) for brand in range(1, rng.randint(2, 5))]
+        order_policies = policies[:rng.randint(1, 4)]
+        orders = random_orders(rng, rng.randint(0, 25), products, order_policies)
+        # sales of a policy without orders are left out
+        sales = random_sales(rng, rng.randint(1, 40), products, order_policies + ['Unknown'])
+        sales_orders, remaining = OfflineEval.match_sales_to_orders(sales, orders)
+        rows, quantity = reference_matching(sales, orders)
+        assert matched_rows(sales_orders) == rows, trial
+        assert remaining.tolist() == quantity, trial
+
+
+def test_metric_is_the_metric_of_the_original_loop():
+    rng = np.random.RandomState(2)
+    for trial in range(100):
+        products = ['{}_1'.format(brand) for brand in range(1, rng.randint(2, 5))]
+        orders = random_orders(rng, rng.randint(1, 25), products, policies[:rng.randint(1, 4)])
+        sales = random_sales(rng, rng.randint(1, 40), products)
+        metrics_df, orders_temp, sales_orders = OfflineEval.compute_metric(sales, orders)
+        rows, quantity = reference_matching(sales, orders)
+        assert orders_temp['Quantity'].tolist() == quantity, trial
+        if len(rows) == 0:
+            assert metrics_df is None, trial
+            continue
+        metric, revenue = reference_metric(rows)
+        assert metrics_df['PolicyID'].tolist() == sorted(orders['PolicyID'].unique()), trial
+        for policy_id, policy_metric, policy_revenue in zip(metrics_df['PolicyID'], metrics_df['Metric'], metrics_df['TotalRevenue']):
+            assert np.isclose(policy_metric, metric.get(policy_id, 0)), trial
+            assert np.isclose(policy_revenue, revenue.get(policy_id, 0)), trial
@@ -0,0 +1,35 @@
+#Keyed prices of the simulator (Simulator.sample_prices): the price of a product in a store on a date is a function of
+#its key, drawn from a truncated normal distribution between the cost and the MSRP of the product.
+
+import warnings
+
+import numpy as np
+
+
+def price_keys(simulator, n_keys):
+    return simulator.key_hash(1, np.arange(n_keys) % 7, np.arange(n_keys), np.full(n_keys, 17175))
+
+
+def test_prices_are_between_cost_and_msrp(simulator):
+    cost = np.linspace(1, 20, 1000)
+    msrp = cost * 1.5
+    prices = simulator.sample_prices(cost, msrp, price_keys(simulator, 1000))
+    assert ((prices >= np.round(cost, 2)) & (prices <= np.round(msrp, 2))).all()
+
+
+def test_prices_are_a_function_of_their_keys(simulator):
+    cost, msrp = np.full(1000, 2.), np.full(1000, 5.)
+    keys = price_keys(simulator, 1000)
+    prices = simulator.sample_prices(cost, msrp, keys)
+    assert np.array_equal(simulator.sample_prices(cost[::-1], msrp[::-1], keys[::-1]), prices[::-1])
+    assert np.array_equal(simulator.sample_prices(cost[:10], msrp[:10], keys[:10]), prices[:10])
+
+
+def test_keyed_draws_raise_no_warnings(simulator):
+    # the hashes wrap around modulo 2 ** 64 on purpose
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        keys = price_keys(simulator, 1000)
+        simulator.keyed_normal(keys, 3)
+        simulator.sample_prices(np.full(1000, 2.), np.full(1000, 5.), keys)
+        simulator.mix_hash(np.uint64(2 ** 64 - 1))
@@ -0,0 +1,84 @@
+#Random streams of the simulator (Simulator.random_stream): every purpose, store and date draws from its own stream,
+#derived from the root seed recorded in the hierarchy, so that a store-day can be simulated again in isolation.
+
+import warnings
+
+import numpy as np
+
+import storage
+
+first_date = '2017-01-10 00:00:00'
+second_date = '2017-01-11 00:00:00'
+
+
+def test_same_keys_give_the_same_draws(simulator):
+    date = np.datetime64('2017-01-10', 'D').tolist()
+    first = simulator.random_stream(1, 'events', '3', date).random_sample(100)
+    second = simulator.random_stream(1, 'events', '3', date).random_sample(100)
+    assert np.array_equal(first, second)
+
+
+def test_every_key_gives_its_own_stream(simulator):
+    date = np.datetime64('2017-01-10', 'D').tolist()
+    next_date = np.datetime64('2017-01-11', 'D').tolist()
+    keys = [(1, 'events', '3', date), (2, 'events', '3', date), (1, 'arrivals', '3', date),
+            (1, 'events', '4', date), (1, 'events', '3', next_date), (1, 'events', '3'), (1, 'events')]
+    draws = [tuple(simulator.random_stream(*key).random_sample(4)) for key in keys]
+    assert len(set(draws)) == len(keys)
+
+
+def test_streams_keep_their_draws(simulator):
+    # draws of the streams as first released: a change of the hashing would change every simulated store-day
+    first = simulator.random_stream(1, 'events', '1', np.datetime64('2017-01-09', 'D').tolist()).random_sample(5)
+    assert np.allclose(first, [0.9531614009753101, 0.02428538950497483, 0.20494752178090503, 0.48525164142347366,
+                               0.5786983708209451], rtol=0, atol=1e-15)
+    second = simulator.random_stream(2, 'check', '4', np.datetime64('2017-01-10', 'D').tolist()).random_sample(5)
+    assert np.allclose(second, [0.8397280907614284, 0.05124492416372706, 0.5163222132628766, 0.3786109801531402,
+                                0.3930751914669952], rtol=0, atol=1e-15)
+
+
+def test_streams_raise_no_warnings(simulator):
+    date = np.datetime64('2017-01-10', 'D').tolist()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for purpose in ['hierarchy', 'arrivals', 'events', 'receipts', 'check']:
+            for store_id in range(1, 51):
+                simulator.random_stream(2 ** 64 - 1, purpose, str(store_id), date).random_sample()
+
+
+def test_store_day_does_not_depend_on_the_other_stores(simulate_day, stored_files):
+    all_stores = storage.MemoryStorage()
+    simulate_day(all_stores, first_date)
+    expected = stored_files(all_stores)
+
+    # the same stores in the reverse order
+    reverse_order = storage.MemoryStorage()
+    simulate_day(reverse_order, first_date, [str(store_id) for store_id in range(6, 0, -1)])
+    assert stored_files(reverse_order) == expected
+
+    # one store on its own
+    one_store = storage.MemoryStorage()
+    simulate_day(one_store, first_date, ['3'])
+    files = stored_files(one_store)
+    assert 'rawdata/sales_store3_2017_01_10_00_00_00.csv' in files
+    assert 'rawdata/sales_store4_2017_01_10_00_00_00.csv' not in files
+    assert all(expected[name] == content for name, content in files.items())
+
+
+def test_root_seed_is_kept_by_the_hierarchy(simulator, simulate_day, stored_files, monkeypatch):
+    first_seed = storage.MemoryStorage()
+    simulate_day(first_seed, first_date)
+
+    monkeypatch.setattr(simulator, 'random_seed', 2)
+    second_seed = storage.MemoryStorage()
+    description = simulate_day(second_seed, first_date)
+    assert description.hierarchy['RandomSeed'] == 2
+    assert second_seed.files['publicparameters/stores.csv'] != first_seed.files['publicparameters/stores.csv']
+    simulate_day(second_seed, second_date)
+
+    # later runs draw from the recorded seed, whatever the seed option
+    recorded_seed = storage.MemoryStorage()
+    simulate_day(recorded_seed, first_date)
+    monkeypatch.setattr(simulator, 'random_seed', 1)
+    simulate_day(recorded_seed, second_date)
+    assert stored_files(recorded_seed) == stored_files(second_seed)
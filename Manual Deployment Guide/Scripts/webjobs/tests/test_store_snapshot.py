@@ -0,0 +1,81 @@
+#Snapshots of the stores (Store.save_state and load_state): a run restores every store from the snapshot written at the
+#end of the previous run, and reads again the orders files written since by other jobs.
+
+import pandas as pd
+
+import storage
+
+dates = ['2017-01-{} 00:00:00'.format(day) for day in range(10, 15)]
+store_id = '2'
+
+
+def restore_store(simulator, configurations, date):
+    ''' Store as the run of the simulator on a date creates it, before it simulates anything '''
+    description = simulator.AttributeDescription(date, configurations)
+    description.get_prices()
+    description.get_demand()
+    return simulator.Store(description.for_store(store_id), store_id)
+
+
+def run_store(simulator, configurations, date):
+    ''' Simulate the store on a date and return it after its snapshot is written '''
+    store = restore_store(simulator, configurations, date)
+    store.run()
+    store.save_state()
+    store.adl.flush()
+    return store
+
+
+def assert_same_state(store, restored):
+    assert list(restored.product_ids) == list(store.product_ids)
+    assert restored.inventory.policies == store.inventory.policies
+    for batches, restored_batches in zip(store.inventory.batches(), restored.inventory.batches()):
+        assert batches.tolist() == restored_batches.tolist()
+    assert restored.backorders == store.backorders
+    pd.testing.assert_frame_equal(restored.orders.to_frame().reset_index(drop=True), store.orders.to_frame().reset_index(drop=True))
+
+
+def test_store_is_restored_from_its_snapshot(simulator, configurations, memory_storage):
+    for date in dates[:-1]:
+        store = run_store(simulator, configurations, date)
+    assert len(store.inventory.batches()[0]) > 0
+    assert len(store.backorders) > 0
+    assert_same_state(store, restore_store(simulator, configurations, dates[-1]))
+
+
+def test_snapshot_of_another_date_is_ignored(simulator, configurations, memory_storage):
+    store = run_store(simulator, configurations, dates[0])
+    first_date = pd.to_datetime(dates[1]) - pd.to_timedelta('1 days')
+    assert store.load_state(first_date) is not None
+    assert store.load_state(first_date + pd.to_timedelta('1 days')) is None
+    assert store.load_state(first_date - pd.to_timedelta('1 days')) is None
+
+
+def test_orders_file_written_since_is_read_again(simulator, configurations, memory_storage):
+    for date in dates[:2]:
+        store = run_store(simulator, configurations, date)
+
+    # an inventory optimization job orders more of a product
+    file_name = 'orders/sim/orders_{}.csv'.format(store_id)
+    with memory_storage.open(file_name, 'rb') as f:
+        orders = pd.read_csv(f)
+    orders = pd.concat([orders, orders.iloc[-1:].assign(Quantity=orders['Quantity'].iloc[-1] + 7)])
+    with memory_storage.open(file_name, 'wb') as f:
+        f.write(orders.to_csv(index=False).encode('utf-8'))
+
+    restored = restore_store(simulator, configurations, dates[2])
+    assert len(restored.orders) == len(store.orders) + 1
+    assert restored.orders.to_frame()['Quantity'].tolist()[-1] == orders['Quantity'].iloc[-1]
+
+
+def test_daily_runs_write_what_a_backfill_writes(simulator, configurations, simulate_day, stored_files):
+    daily = storage.MemoryStorage()
+    for date in dates[:3]:
+        simulate_day(daily, date)
+
+    backfill = storage.MemoryStorage()
+    simulate_day(backfill, dates[0])
+    # the stores are restored from their snapshots once, then kept in memory
+    description = simulator.AttributeDescription(dates[1], configurations)
+    simulator.backfill(description, dates[2], 1)
+    assert stored_files(backfill) == stored_files(daily)